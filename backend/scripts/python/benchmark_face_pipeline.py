@@ -0,0 +1,380 @@
+"""Reproducible timing benchmark for the face pipeline.
+
+Times detect_faces_advanced, extract_advanced_embeddings, compare_faces_advanced
+and assess_quality_advanced on a fixed local corpus, per image and per detection
+profile, and prints machine-readable JSON with latency percentiles.
+
+The default corpus is generated once (seeded, so every run on a box sees the
+same pixels) under backend/cache/benchmark_corpus: single faces, group photos,
+12MP images and faceless scenes. --corpus points at a real image folder instead;
+its sub-folder names become the categories.
+
+    python benchmark_face_pipeline.py --output bench.json
+    python benchmark_face_pipeline.py --profiles fast --operations detect quality --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import platform
+import contextlib
+
+try:
+    import numpy as np
+except ImportError:
+    print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
+    sys.exit(1)
+
+import simple_face_processor_v2 as pipeline
+
+
+BENCHMARK_VERSION = 1
+
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cache', 'benchmark_corpus')
+
+# Generated corpus: (category, name, (width, height), faces). Bump CORPUS_SEED to change the pixels.
+CORPUS_SEED = 20240611
+CORPUS_SPEC = [
+    ('single_face', 'single_640', (640, 480), 1),
+    ('single_face', 'single_1600', (1600, 1200), 1),
+    ('group', 'group_1600', (1600, 1200), 6),
+    ('large_12mp', 'single_12mp', (4000, 3000), 1),
+    ('large_12mp', 'group_12mp', (4000, 3000), 8),
+    ('faceless', 'scene_1600', (1600, 1200), 0),
+    ('faceless', 'scene_12mp', (4000, 3000), 0),
+]
+
+OPERATIONS = ('detect', 'extract', 'compare', 'quality')
+
+# 'thorough' runs every rotated/brightened variant at full size; opt in with --profiles
+DEFAULT_PROFILES = ('fast', 'balanced')
+
+PERCENTILES = (50, 90, 99)
+
+# compare_faces_advanced calls timed per embedding length
+COMPARE_PAIRS = 200
+
+# A p50 this much slower (faster) than the baseline is reported as a regression (improvement)
+DEFAULT_TOLERANCE = 0.10
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+class FacePipelineBenchmark:
+    """Runs the timed operations and collects one result row per (operation, profile, image)"""
+
+    def __init__(self, processor, repeats=3, stages=False, log_stream=None):
+        self.processor = processor
+        self.log_stream = log_stream or sys.stderr
+        self.repeats = max(1, int(repeats))
+        self.stages = stages
+        self.results = []
+        self.embeddings = {}
+
+    # ------------------------------------------------------------------ corpus
+
+    def generate_corpus(self, corpus_dir):
+        """Write the synthetic corpus (once) and return its image entries"""
+        os.makedirs(corpus_dir, exist_ok=True)
+        manifest_path = os.path.join(corpus_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('seed') == CORPUS_SEED and all(os.path.exists(os.path.join(corpus_dir, entry['file']))
+                                                          for entry in manifest['images']):
+                return [dict(entry, path=os.path.join(corpus_dir, entry['file'])) for entry in manifest['images']]
+
+        images = []
+        for index, (category, name, size, faces) in enumerate(CORPUS_SPEC):
+            image = synthetic_image(size, faces, np.random.default_rng(CORPUS_SEED + index))
+            file_name = f'{name}.jpg'
+            pipeline.cv2.imwrite(os.path.join(corpus_dir, file_name), image, [pipeline.cv2.IMWRITE_JPEG_QUALITY, 92])
+            images.append({'file': file_name, 'name': name, 'category': category,
+                           'width': size[0], 'height': size[1], 'drawn_faces': faces})
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({'seed': CORPUS_SEED, 'images': images}, f, indent=2)
+        return [dict(entry, path=os.path.join(corpus_dir, entry['file'])) for entry in images]
+
+    def load_corpus(self, corpus_dir):
+        """Image entries of a real corpus folder (sub-folders are categories)"""
+        images = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir, '**', '*'), recursive=True)):
+            if not path.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            image = pipeline.cv2.imread(path, pipeline.cv2.IMREAD_UNCHANGED)
+            if image is None:
+                continue
+            relative = os.path.relpath(path, corpus_dir)
+            category = os.path.dirname(relative) or 'uncategorized'
+            images.append({'file': relative, 'name': os.path.splitext(relative)[0], 'category': category,
+                           'width': int(image.shape[1]), 'height': int(image.shape[0]), 'path': path})
+        return images
+
+    # ------------------------------------------------------------------ timing
+
+    def time_calls(self, call):
+        """Run call() repeats times; returns (wall ms list, cpu ms list, last result, stage means)"""
+        wall, cpu, stage_totals = [], [], {}
+        result = None
+        for _ in range(self.repeats):
+            profiler = pipeline.StageProfiler() if self.stages else None
+            self.processor.profiler = profiler
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                result = call()
+            finally:
+                self.processor.profiler = None
+            wall.append((time.perf_counter() - wall_start) * 1000)
+            cpu.append((time.process_time() - cpu_start) * 1000)
+            if profiler is not None:
+                for name, entry in profiler.report()['stages'].items():
+                    stage_totals[name] = stage_totals.get(name, 0.0) + entry['wall_ms']
+        stage_means = {name: round(total / self.repeats, 3) for name, total in stage_totals.items()}
+        return wall, cpu, result, stage_means
+
+    def record(self, operation, profile, image, wall, cpu, stages=None, **extra):
+        row = {
+            'operation': operation,
+            'profile': profile,
+            'image': image['name'] if image else None,
+            'category': image['category'] if image else None,
+            'megapixels': round(image['width'] * image['height'] / 1e6, 2) if image else None,
+            'runs': len(wall),
+            'wall_ms': summarize(wall),
+            'cpu_ms': summarize(cpu)
+        }
+        row.update(extra)
+        if stages:
+            row['stages_ms'] = stages
+        self.results.append(row)
+        print(f"[BENCH] {operation:<8} {profile or '-':<9} {row['image'] or '-':<14} "
+              f"p50={row['wall_ms']['p50']:.1f}ms p90={row['wall_ms']['p90']:.1f}ms", file=self.log_stream, flush=True)
+        return row
+
+    def run(self, images, operations, profiles):
+        for image in images:
+            if 'quality' in operations:
+                wall, cpu, result, stages = self.time_calls(lambda: self.processor.assess_quality_advanced(image['path']))
+                self.record('quality', None, image, wall, cpu, stages, success=bool(result.get('success')),
+                            quality_score=result.get('quality_score'))
+
+            for profile in profiles:
+                if 'detect' in operations:
+                    wall, cpu, result, stages = self.time_calls(
+                        lambda: self.processor.detect_faces_advanced(image['path'], profile=profile))
+                    self.record('detect', profile, image, wall, cpu, stages, faces=result.get('face_count', 0))
+
+                if 'extract' in operations:
+                    wall, cpu, result, stages = self.time_calls(
+                        lambda: self.processor.extract_advanced_embeddings(image['path'], profile=profile))
+                    self.record('extract', profile, image, wall, cpu, stages, faces=result.get('face_count', 0))
+                    for entry in result.get('embeddings', []):
+                        self.embeddings.setdefault(len(entry['embedding']), []).append(entry['embedding'])
+
+        if 'compare' in operations:
+            self.run_compare()
+
+    def run_compare(self):
+        """compare_faces_advanced on pairs of extracted embeddings (seeded random vectors when none)"""
+        rng = np.random.default_rng(CORPUS_SEED)
+        sets = {length: vectors for length, vectors in self.embeddings.items() if len(vectors) >= 2}
+        source = 'extracted'
+        if not sets:
+            # Same length as real extract_embeddings output, non-negative like its features
+            sets = {4371: list(np.abs(rng.normal(size=(16, 4371))))}
+            source = 'synthetic'
+
+        for length, vectors in sorted(sets.items()):
+            # Lists, as the CLI and serve mode hand them over after JSON decoding
+            vectors = [np.asarray(vector, dtype=np.float64).tolist() for vector in vectors]
+            first = rng.integers(0, len(vectors), COMPARE_PAIRS)
+            second = (first + rng.integers(1, len(vectors), COMPARE_PAIRS)) % len(vectors)
+            wall, cpu, failures = [], [], 0
+            for _ in range(self.repeats):
+                for a, b in zip(first, second):
+                    wall_start, cpu_start = time.perf_counter(), time.process_time()
+                    result = self.processor.compare_faces_advanced(vectors[a], vectors[b])
+                    wall.append((time.perf_counter() - wall_start) * 1000)
+                    cpu.append((time.process_time() - cpu_start) * 1000)
+                    failures += not result.get('success')
+            self.record('compare', None, None, wall, cpu, embedding_length=int(length), embeddings=source,
+                        failures=failures)
+
+
+def synthetic_image(size, faces, rng):
+    """Seeded BGR test image: textured background with drawn frontal faces"""
+    cv2 = pipeline.cv2
+    width, height = size
+    # Smooth low-frequency background plus a few objects, so faceless scenes still have structure
+    base = rng.uniform(40, 200, (6, 8, 3)).astype(np.float32)
+    image = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(12):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        w, h = int(rng.integers(width // 20, width // 5)), int(rng.integers(height // 20, height // 5))
+        cv2.rectangle(image, (x, y), (x + w, y + h), tuple(float(c) for c in rng.uniform(30, 220, 3)), -1)
+
+    if faces:
+        columns = int(np.ceil(np.sqrt(faces * width / height)))
+        rows = int(np.ceil(faces / columns))
+        cell_w, cell_h = width / columns, height / rows
+        face_size = 0.55 * min(cell_w, cell_h) if faces > 1 else 0.4 * min(width, height)
+        for i in range(faces):
+            cx = (i % columns + 0.5) * cell_w + rng.uniform(-0.1, 0.1) * cell_w
+            cy = (i // columns + 0.5) * cell_h + rng.uniform(-0.1, 0.1) * cell_h
+            draw_face(image, cx, cy, face_size * rng.uniform(0.85, 1.1), rng)
+
+    image += rng.normal(0, 6, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def draw_face(image, cx, cy, size, rng):
+    """Frontal face drawing: skin oval, brows, eyes, nose shadow and mouth"""
+    cv2 = pipeline.cv2
+    skin = tuple(float(c) for c in np.array([140, 170, 210]) * rng.uniform(0.7, 1.05))
+    dark = (35.0, 35.0, 45.0)
+    s = size
+
+    def point(dx, dy):
+        return (int(round(cx + dx * s)), int(round(cy + dy * s)))
+
+    def axes(ax, ay):
+        return (max(1, int(round(ax * s))), max(1, int(round(ay * s))))
+
+    cv2.ellipse(image, point(0, -0.05), axes(0.42, 0.55), 0, 0, 360, dark, -1)          # hair
+    cv2.ellipse(image, point(0, 0.05), axes(0.36, 0.48), 0, 0, 360, skin, -1)           # face
+    for side in (-1, 1):
+        cv2.ellipse(image, point(side * 0.14, -0.12), axes(0.09, 0.025), 0, 180, 360, dark, max(1, int(s * 0.025)))
+        cv2.ellipse(image, point(side * 0.14, -0.04), axes(0.075, 0.04), 0, 0, 360, (235.0, 235.0, 235.0), -1)
+        cv2.circle(image, point(side * 0.14, -0.04), max(1, int(s * 0.03)), dark, -1)
+    shadow = tuple(c * 0.8 for c in skin)
+    cv2.ellipse(image, point(0, 0.1), axes(0.05, 0.1), 0, 0, 360, shadow, -1)           # nose
+    cv2.ellipse(image, point(0, 0.27), axes(0.12, 0.04), 0, 0, 360, (70.0, 70.0, 150.0), -1)  # mouth
+    x1, y1 = point(-0.5, -0.65)
+    x2, y2 = point(0.5, 0.65)
+    y1, y2, x1, x2 = max(0, y1), min(image.shape[0], y2), max(0, x1), min(image.shape[1], x2)
+    kernel = max(3, int(s * 0.03) | 1)
+    image[y1:y2, x1:x2] = cv2.GaussianBlur(image[y1:y2, x1:x2], (kernel, kernel), 0)
+
+def summarize(values):
+    """min/mean/max and percentiles in ms"""
+    values = np.asarray(values, dtype=np.float64)
+    summary = {'min': round(float(values.min()), 3), 'mean': round(float(values.mean()), 3)}
+    for q in PERCENTILES:
+        summary[f'p{q}'] = round(float(np.percentile(values, q)), 3)
+    summary['max'] = round(float(values.max()), 3)
+    return summary
+
+def result_key(row):
+    return (row['operation'], row['profile'], row['image'], row.get('embedding_length'))
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """p50 ratio against a previous benchmark JSON for every row both runs share"""
+    previous = {result_key(row): row for row in baseline.get('results', [])}
+    rows, regressions, improvements = [], 0, 0
+    for row in results:
+        old = previous.get(result_key(row))
+        if old is None or not old['wall_ms']['p50']:
+            continue
+        ratio = row['wall_ms']['p50'] / old['wall_ms']['p50']
+        status = 'regression' if ratio > 1 + tolerance else 'improvement' if ratio < 1 - tolerance else 'unchanged'
+        regressions += status == 'regression'
+        improvements += status == 'improvement'
+        rows.append({
+            'operation': row['operation'], 'profile': row['profile'], 'image': row['image'],
+            'embedding_length': row.get('embedding_length'),
+            'baseline_p50_ms': old['wall_ms']['p50'], 'p50_ms': row['wall_ms']['p50'],
+            'ratio': round(ratio, 3), 'status': status
+        })
+    return {'tolerance': tolerance, 'regressions': regressions, 'improvements': improvements, 'rows': rows}
+
+def machine_info(processor):
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': pipeline.cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'detection_workers': processor.detection_workers
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the face pipeline on a fixed local corpus')
+    parser.add_argument('--corpus', help='Folder of real images (sub-folders = categories); default: generated corpus')
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR, help='Where the generated corpus is written')
+    parser.add_argument('--images', nargs='+', help='Only these corpus images (names without extension)')
+    parser.add_argument('--categories', nargs='+', help='Only images of these categories')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--profiles', nargs='+', choices=sorted(pipeline.DETECTION_PROFILES), default=list(DEFAULT_PROFILES))
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per operation, profile and image')
+    parser.add_argument('--detection-workers', type=int, help='Detection threads per image (default: processor default)')
+    parser.add_argument('--stages', action='store_true', help='Add mean per-stage wall ms (--profile timings) to every row')
+    parser.add_argument('--baseline', help='Earlier benchmark JSON to compare p50 latencies against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Relative p50 change reported as regression/improvement')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='Keep the pipeline debug output on stderr')
+    args = parser.parse_args()
+
+    # The pipeline logs every step to stderr; only the [BENCH] lines stay visible by default
+    log_stream = sys.stderr
+    devnull = open(os.devnull, 'w')
+    quiet = contextlib.nullcontext if args.verbose else lambda: contextlib.redirect_stderr(devnull)
+
+    with quiet():
+        processor = pipeline.AdvancedFaceProcessor()
+    if args.detection_workers:
+        processor.detection_workers = max(1, args.detection_workers)
+    benchmark = FacePipelineBenchmark(processor, repeats=args.repeats, stages=args.stages, log_stream=log_stream)
+
+    if args.corpus:
+        corpus_dir = os.path.abspath(args.corpus)
+        images = benchmark.load_corpus(corpus_dir)
+    else:
+        corpus_dir = os.path.abspath(args.corpus_dir)
+        images = benchmark.generate_corpus(corpus_dir)
+    if args.images:
+        images = [image for image in images if image['name'] in args.images]
+    if args.categories:
+        images = [image for image in images if image['category'] in args.categories]
+    if not images and set(args.operations) != {'compare'}:
+        print(json.dumps({'success': False, 'error': f'No images in corpus {corpus_dir}'}))
+        sys.exit(1)
+
+    started = time.perf_counter()
+    with quiet():
+        # Untimed warm-up: first-call costs (thread pool, lazy tables) stay out of the numbers
+        if images:
+            processor.detect_faces_advanced(images[0]['path'], profile=args.profiles[0])
+        benchmark.run(images, args.operations, args.profiles)
+
+    report = {
+        'success': True,
+        'benchmark': 'face_pipeline',
+        'version': BENCHMARK_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': machine_info(processor),
+        'config': {
+            'corpus': corpus_dir,
+            'generated_corpus': not args.corpus,
+            'corpus_seed': CORPUS_SEED if not args.corpus else None,
+            'operations': args.operations,
+            'profiles': args.profiles,
+            'repeats': benchmark.repeats,
+            'images': [{key: image[key] for key in ('name', 'category', 'width', 'height')} for image in images]
+        },
+        'duration_s': round(time.perf_counter() - started, 2),
+        'results': benchmark.results
+    }
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            report['comparison'] = compare_with_baseline(benchmark.results, json.load(f), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,729 @@
+"""Golden-output conformance checks for the optimized face pipeline paths.
+
+Two kinds of checks, both on a fixed corpus (the benchmark's generated images,
+seeded synthetic boxes and embeddings, plus the JSON embedding cache when present):
+
+    side by side   every fast path in CHECKS runs next to its reference
+                   implementation (the frozen pre-optimization loops below, or the
+                   plain code path it shortcuts); drift is reported per function
+                   against the tolerance declared in TOLERANCES
+    golden files   --record writes the pipeline outputs (boxes, embeddings, quality
+                   scores, similarities) to JSON; --golden compares a later run with
+                   it, so drift between commits is caught too; --golden without a file
+                   uses DEFAULT_GOLDEN_FILE, recorded for the generated corpus
+
+Match decisions use the thresholds the Node service applies to compare results
+(DECISION_THRESHOLDS); any flipped decision fails its check whatever the drift.
+Exit status is 1 when a check fails.
+
+    python conformance_face_pipeline.py
+    python conformance_face_pipeline.py --golden
+    python conformance_face_pipeline.py --record golden.json
+    python conformance_face_pipeline.py --golden golden.json --checks similarity_batch nms
+"""
+import os
+import sys
+import json
+import glob
+import math
+import time
+import argparse
+import contextlib
+
+try:
+    import numpy as np
+except ImportError:
+    print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
+    sys.exit(1)
+
+import simple_face_processor_v2 as pipeline
+from benchmark_face_pipeline import FacePipelineBenchmark, DEFAULT_CORPUS_DIR
+from embedding_store import DEFAULT_JSON_CACHE_DIR
+
+
+CONFORMANCE_VERSION = 1
+
+CONFORMANCE_SEED = 7
+
+# Largest allowed absolute difference per compared quantity (0 = bit-identical)
+TOLERANCES = {
+    'iou': 1e-12,
+    'grouping': 0,
+    'nms': 0,
+    'lbp_codes': 0,
+    'similarity': 1e-9,
+    'sharpness': 1e-9,
+    'boxes_px': 0,
+    'embedding': 1e-9,
+    'quality': 1e-6,
+    # Proxy mode estimates rather than reproduces the metrics (see QUALITY_PROXY_DIMENSION)
+    'quality_proxy': 10.0,
+    # Reduced decode detects on a smaller image: boxes as a fraction of the original longest side
+    'reduced_decode': 0.01,
+    # Large image vs its working-size copy: boxes as a fraction of the original longest side
+    'working_scale': 0.01,
+}
+
+# (similarity, confidence) pairs a match needs, as used by deepFaceService.ts
+DECISION_THRESHOLDS = ((0.55, 0.5), (0.65, 0.6))
+
+# Side-by-side checks in run order; each maps to a ConformanceSuite.check_<name> method
+CHECKS = (
+    'iou_matrix',
+    'detection_grouping',
+    'nms',
+    'lbp_codes',
+    'similarity_stats',
+    'similarity_early_reject',
+    'similarity_batch',
+    'frequency_sharpness',
+    'sharpness_context',
+    'quality_context',
+    'quality_proxy',
+    'reduced_decode',
+    'working_scale',
+    'detection_threads',
+    'analyze_image',
+)
+
+# Golden pipeline outputs skip the large_12mp category unless --categories asks for it (quality takes ~30s each)
+GOLDEN_CATEGORIES = ('single_face', 'group', 'faceless')
+GOLDEN_PROFILE = 'fast'
+
+# Golden outputs of the generated corpus (GOLDEN_CATEGORIES, GOLDEN_PROFILE); re-record with
+# --record when a change is meant to alter pipeline outputs
+DEFAULT_GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conformance_golden.json')
+
+# Embeddings per length taken from the JSON cache, and synthetic 4371-d ones
+EMBEDDING_SAMPLE = 24
+
+
+def reference_grouping(processor, detections, sources, overlap_threshold=0.35):
+    """improved_detection_grouping before vectorization (per-pair calculate_overlap)"""
+    grouped = []
+    used = set()
+    for i, det1 in enumerate(detections):
+        if i in used:
+            continue
+        group_detections = [det1]
+        group_sources = [sources[i]]
+        used.add(i)
+        for j, det2 in enumerate(detections):
+            if j in used or i == j:
+                continue
+            overlap = processor.calculate_overlap(det1[:4], det2[:4])
+            adaptive_threshold = overlap_threshold
+            if sources[i].split('_')[0] == sources[j].split('_')[0]:
+                adaptive_threshold += 0.1
+            if len(det1) > 4 and len(det2) > 4:
+                avg_confidence = (det1[4] + det2[4]) / 2
+                if avg_confidence > 0.7:
+                    adaptive_threshold -= 0.05
+            if overlap > adaptive_threshold:
+                group_detections.append(det2)
+                group_sources.append(sources[j])
+                used.add(j)
+        if len(group_detections) > 0:
+            grouped.append((group_detections, group_sources))
+    return grouped
+
+def reference_nms(processor, detections, img_shape, overlap_threshold=0.4):
+    """apply_advanced_nms before vectorization (pop-and-filter loop)"""
+    if not detections:
+        return []
+    scored_detections = []
+    for detection in detections:
+        if len(detection) >= 5:
+            x, y, w, h, confidence = detection[:5]
+            size_score = processor.calculate_size_score(w, h, img_shape)
+            position_score = processor.calculate_position_score(x, y, w, h, img_shape)
+            aspect_score = processor.calculate_aspect_score(w, h)
+            composite_score = confidence * 0.5 + size_score * 0.2 + position_score * 0.2 + aspect_score * 0.1
+            scored_detections.append((detection, composite_score))
+    scored_detections.sort(key=lambda x: x[1], reverse=True)
+    keep = []
+    while scored_detections:
+        current_detection, current_score = scored_detections.pop(0)
+        keep.append(current_detection)
+        remaining = []
+        for detection, score in scored_detections:
+            overlap = processor.calculate_overlap(current_detection[:4], detection[:4])
+            adaptive_threshold = overlap_threshold
+            if abs(current_score - score) > 0.3:
+                adaptive_threshold += 0.1
+            if overlap < adaptive_threshold:
+                remaining.append((detection, score))
+        scored_detections = remaining
+    return keep
+
+def reference_lbp_codes(face_img, radius, n_points):
+    """Circular LBP codes of the interior pixels, per-pixel loop as originally written"""
+    h, w = face_img.shape[:2]
+    codes = np.zeros((h - 2 * radius, w - 2 * radius), dtype=np.uint32)
+    for i in range(radius, h - radius):
+        for j in range(radius, w - radius):
+            center = face_img[i, j]
+            code = 0
+            for p in range(n_points):
+                angle = 2 * math.pi * p / n_points
+                x = int(j + radius * math.cos(angle))
+                y = int(i + radius * math.sin(angle))
+                if 0 <= x < w and 0 <= y < h:
+                    if face_img[y, x] >= center:
+                        code |= (1 << p)
+            codes[i - radius, j - radius] = code
+    return codes
+
+def reference_frequency_energy(gray_img):
+    """(high-frequency, total) magnitude from the full fft2 and the per-pixel mask loop"""
+    magnitude_spectrum = np.abs(np.fft.fftshift(np.fft.fft2(gray_img)))
+    h, w = gray_img.shape
+    center_y, center_x = h // 2, w // 2
+    high_freq_mask = np.zeros((h, w))
+    for y in range(h):
+        for x in range(w):
+            distance = np.sqrt((y - center_y)**2 + (x - center_x)**2)
+            if distance > min(h, w) * 0.3:
+                high_freq_mask[y, x] = 1
+    return np.sum(magnitude_spectrum * high_freq_mask), np.sum(magnitude_spectrum)
+
+def match_decisions(similarity, confidence):
+    """One boolean per DECISION_THRESHOLDS entry"""
+    return tuple(similarity > s and confidence > c for s, c in DECISION_THRESHOLDS)
+
+
+class CheckResult:
+    """Accumulates drift, structural mismatches and timing for one check"""
+
+    def __init__(self, name, reference, candidate, tolerance):
+        self.name = name
+        self.reference = reference
+        self.candidate = candidate
+        self.tolerance = tolerance
+        self.cases = 0
+        self.max_drift = 0.0
+        self.drift_sum = 0.0
+        self.drift_count = 0
+        self.mismatches = 0
+        self.examples = []
+        self.reference_seconds = 0.0
+        self.candidate_seconds = 0.0
+
+    def timed(self, side, call):
+        start = time.perf_counter()
+        result = call()
+        elapsed = time.perf_counter() - start
+        if side == 'reference':
+            self.reference_seconds += elapsed
+        else:
+            self.candidate_seconds += elapsed
+        return result
+
+    def values(self, reference, candidate, case=None):
+        """Numeric comparison; shape differences count as a mismatch"""
+        self.cases += 1
+        reference = np.asarray(reference, dtype=np.float64)
+        candidate = np.asarray(candidate, dtype=np.float64)
+        if reference.shape != candidate.shape:
+            self.mismatch(case, f'shape {reference.shape} != {candidate.shape}')
+            return
+        if reference.size == 0:
+            return
+        drift = np.abs(reference - candidate)
+        drift = np.where(np.isnan(reference) & np.isnan(candidate), 0.0, drift)
+        drift = np.where(np.isnan(drift), np.inf, drift)
+        worst = float(drift.max())
+        self.drift_sum += float(drift.sum())
+        self.drift_count += drift.size
+        if worst > self.max_drift:
+            self.max_drift = worst
+        if worst > self.tolerance:
+            self.add_example(case, f'drift {worst:.3g}')
+
+    def same(self, reference, candidate, case=None):
+        """Structural comparison (groups, kept boxes, decisions): must be equal"""
+        self.cases += 1
+        if reference != candidate:
+            self.mismatch(case, 'differs')
+
+    def mismatch(self, case, detail):
+        self.mismatches += 1
+        self.add_example(case, detail)
+
+    def add_example(self, case, detail):
+        if len(self.examples) < 5:
+            self.examples.append({'case': case, 'detail': detail})
+
+    @property
+    def passed(self):
+        return self.mismatches == 0 and self.max_drift <= self.tolerance
+
+    def report(self):
+        return {
+            'check': self.name,
+            'reference': self.reference,
+            'candidate': self.candidate,
+            'cases': self.cases,
+            'tolerance': self.tolerance,
+            'max_abs_drift': self.max_drift,
+            'mean_abs_drift': self.drift_sum / self.drift_count if self.drift_count else 0.0,
+            'mismatches': self.mismatches,
+            'passed': self.passed,
+            'reference_ms': round(self.reference_seconds * 1000, 3),
+            'candidate_ms': round(self.candidate_seconds * 1000, 3),
+            'speedup': round(self.reference_seconds / self.candidate_seconds, 2) if self.candidate_seconds > 0 else None,
+            'examples': self.examples
+        }
+
+
+class ConformanceSuite:
+    """Side-by-side and golden-output checks on one processor"""
+
+    def __init__(self, processor, images, cache_dir=None):
+        self.processor = processor
+        self.images = images
+        self.cache_dir = cache_dir or DEFAULT_JSON_CACHE_DIR
+        self._embeddings = None
+
+    # ------------------------------------------------------------------ corpus
+
+    def random_detections(self, rng, count, img_shape=(1200, 1600)):
+        """Seeded raw detections clustered around a few faces, with detector sources"""
+        h, w = img_shape
+        centers = rng.uniform([0.1 * w, 0.1 * h], [0.9 * w, 0.9 * h], (max(1, count // 8), 2))
+        detections, sources = [], []
+        for _ in range(count):
+            cx, cy = centers[rng.integers(0, len(centers))] + rng.normal(0, 12, 2)
+            size = rng.uniform(40, 160)
+            detections.append([int(cx - size / 2), int(cy - size / 2), int(size), int(size * rng.uniform(0.9, 1.25)),
+                               float(rng.uniform(0.3, 0.98))])
+            detector = ('cascade', 'template', 'contour', 'dnn')[rng.integers(0, 4)]
+            variant = pipeline.DETECTION_VARIANT_ORDER[rng.integers(0, len(pipeline.DETECTION_VARIANT_ORDER))]
+            sources.append(f'{detector}_{variant}')
+        return detections, sources
+
+    def embedding_sets(self):
+        """{length: [vectors]} from the JSON cache plus seeded 4371-d vectors with near duplicates"""
+        if self._embeddings is None:
+            sets = {}
+            for path in sorted(glob.glob(os.path.join(self.cache_dir, '*.json'))):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                for vector in data.get('embeddings', []):
+                    bucket = sets.setdefault(len(vector), [])
+                    if len(bucket) < EMBEDDING_SAMPLE:
+                        bucket.append([float(value) for value in vector])
+
+            rng = np.random.default_rng(CONFORMANCE_SEED)
+            people = np.abs(rng.normal(size=(EMBEDDING_SAMPLE // 3, 4371)))
+            synthetic = []
+            for person in people:
+                for noise in (0.0, 0.05, 0.3):
+                    synthetic.append(np.abs(person + rng.normal(0, noise, person.size)).tolist())
+            sets[4371] = synthetic
+            self._embeddings = {length: vectors for length, vectors in sets.items() if len(vectors) >= 2}
+        return self._embeddings
+
+    def embedding_pairs(self):
+        for length, vectors in sorted(self.embedding_sets().items()):
+            for i in range(len(vectors)):
+                for j in range(i + 1, len(vectors)):
+                    yield f'{length}d:{i}-{j}', vectors[i], vectors[j]
+
+    def face_patches(self):
+        """Grayscale patches for LBP: corpus face regions (or image centres), 40x40"""
+        patches = []
+        for image in self.images:
+            context, _ = self.processor.create_image_context(image['path'])
+            if context is None:
+                continue
+            gray = context.gray
+            h, w = gray.shape
+            patches.append((image['name'], pipeline.cv2.resize(gray[h // 3:2 * h // 3, w // 3:2 * w // 3], (40, 40))))
+        return patches
+
+    # ------------------------------------------------------------------ side by side
+
+    def check_iou_matrix(self):
+        check = CheckResult('iou_matrix', 'calculate_overlap', 'calculate_overlap_matrix', TOLERANCES['iou'])
+        rng = np.random.default_rng(CONFORMANCE_SEED)
+        for case in range(20):
+            boxes_a, _ = self.random_detections(rng, 40)
+            boxes_b, _ = self.random_detections(rng, 30)
+            reference = check.timed('reference', lambda: [[self.processor.calculate_overlap(a[:4], b[:4]) for b in boxes_b]
+                                                         for a in boxes_a])
+            candidate = check.timed('candidate', lambda: self.processor.calculate_overlap_matrix(
+                np.array(boxes_a)[:, :4], np.array(boxes_b)[:, :4]))
+            check.values(reference, candidate, case)
+        return check
+
+    def check_detection_grouping(self):
+        check = CheckResult('detection_grouping', 'reference_grouping (loop)', 'improved_detection_grouping', TOLERANCES['grouping'])
+        rng = np.random.default_rng(CONFORMANCE_SEED + 1)
+        for case in range(30):
+            detections, sources = self.random_detections(rng, int(rng.integers(5, 120)))
+            reference = check.timed('reference', lambda: reference_grouping(self.processor, detections, sources))
+            candidate = check.timed('candidate', lambda: self.processor.improved_detection_grouping(detections, sources))
+            check.same([(list(map(list, d)), list(s)) for d, s in reference],
+                       [(list(map(list, d)), list(s)) for d, s in candidate], case)
+        return check
+
+    def check_nms(self):
+        check = CheckResult('nms', 'reference_nms (loop)', 'apply_advanced_nms', TOLERANCES['nms'])
+        rng = np.random.default_rng(CONFORMANCE_SEED + 2)
+        for case in range(30):
+            detections, _ = self.random_detections(rng, int(rng.integers(5, 120)))
+            reference = check.timed('reference', lambda: reference_nms(self.processor, detections, (1200, 1600)))
+            candidate = check.timed('candidate', lambda: self.processor.apply_advanced_nms(detections, (1200, 1600)))
+            check.same([list(d) for d in reference], [list(d) for d in candidate], case)
+        return check
+
+    def check_lbp_codes(self):
+        check = CheckResult('lbp_codes', 'reference_lbp_codes (per-pixel loop)', 'compute_lbp_codes', TOLERANCES['lbp_codes'])
+        for name, patch in self.face_patches():
+            for radius, n_points in ((1, 8), (2, 16), (3, 24)):
+                reference = check.timed('reference', lambda: reference_lbp_codes(patch, radius, n_points))
+                candidate = check.timed('candidate', lambda: self.processor.compute_lbp_codes(patch, radius, n_points))
+                check.values(reference, candidate, f'{name}:r{radius}p{n_points}')
+        return check
+
+    def compare_pair(self, a, b, *stats, **kwargs):
+        # compare_faces_advanced logs every call; keep the reference loops quiet
+        with contextlib.redirect_stderr(DEVNULL):
+            return self.processor.compare_faces_advanced(a, b, *stats, **kwargs)
+
+    def check_similarity_stats(self):
+        """Precomputed embedding statistics must not change any score"""
+        check = CheckResult('similarity_stats', 'compare_faces_advanced', 'compare_faces_advanced + stats',
+                            TOLERANCES['similarity'])
+        stats = {}
+        for case, a, b in self.embedding_pairs():
+            for vector in (a, b):
+                if id(vector) not in stats:
+                    stats[id(vector)] = self.processor.compute_embedding_stats(vector)
+            reference = check.timed('reference', lambda: self.compare_pair(a, b, early_reject=False))
+            candidate = check.timed('candidate', lambda: self.compare_pair(a, b, stats[id(a)], stats[id(b)], early_reject=False))
+            check.values([reference['similarity'], reference['confidence']],
+                         [candidate['similarity'], candidate['confidence']], case)
+            check.same(match_decisions(reference['similarity'], reference['confidence']),
+                       match_decisions(candidate['similarity'], candidate['confidence']), case)
+        return check
+
+    def check_similarity_early_reject(self):
+        """Early rejection may only skip pairs whose full score is 0 anyway"""
+        check = CheckResult('similarity_early_reject', 'compare_faces_advanced', 'compare_faces_advanced early_reject',
+                            TOLERANCES['similarity'])
+        for case, a, b in self.embedding_pairs():
+            reference = check.timed('reference', lambda: self.compare_pair(a, b, early_reject=False))
+            candidate = check.timed('candidate', lambda: self.compare_pair(a, b, early_reject=True))
+            check.values([reference['similarity'], reference['confidence']],
+                         [candidate['similarity'], candidate['confidence']], case)
+            check.same(match_decisions(reference['similarity'], reference['confidence']),
+                       match_decisions(candidate['similarity'], candidate['confidence']), case)
+        return check
+
+    def check_similarity_batch(self):
+        """similarity_matrix must reproduce every pairwise score"""
+        check = CheckResult('similarity_batch', 'compare_faces_advanced', 'similarity_matrix', TOLERANCES['similarity'])
+        for length, vectors in sorted(self.embedding_sets().items()):
+            reference = check.timed('reference', lambda: [[self.compare_pair(a, b, early_reject=False) for b in vectors]
+                                                         for a in vectors])
+            candidate = check.timed('candidate', lambda: self.processor.similarity_matrix(vectors, vectors))
+            if not candidate.get('success'):
+                check.mismatch(f'{length}d', candidate.get('error'))
+                continue
+            for i in range(len(vectors)):
+                for j in range(len(vectors)):
+                    case = f'{length}d:{i}-{j}'
+                    ref, sim, conf = reference[i][j], candidate['similarity'][i][j], candidate['confidence'][i][j]
+                    check.values([ref['similarity'], ref['confidence']], [sim, conf], case)
+                    check.same(match_decisions(ref['similarity'], ref['confidence']), match_decisions(sim, conf), case)
+        return check
+
+    def check_frequency_sharpness(self):
+        """Uncapped high-frequency ratio (x1000, as in frequency_sharpness) on odd and even shapes"""
+        check = CheckResult('frequency_sharpness', 'reference_frequency_energy (fft2 + mask loop)',
+                            'frequency_energy (rfft2 + cached mask)', TOLERANCES['sharpness'])
+        for name, patch in self.face_patches():
+            for h, w in ((40, 40), (39, 40), (40, 37), (31, 33)):
+                sample = patch[:h, :w]
+                reference = check.timed('reference', lambda: reference_frequency_energy(sample))
+                candidate = check.timed('candidate', lambda: self.processor.frequency_energy(sample))
+                check.values(reference[0] / reference[1] * 1000, candidate[0] / candidate[1] * 1000, f'{name}:{h}x{w}')
+        for image in self.images:
+            context, _ = self.processor.create_image_context(image['path'])
+            if context is None or context.gray.size > 1000000:
+                continue
+            reference = check.timed('reference', lambda: reference_frequency_energy(context.gray))
+            candidate = check.timed('candidate', lambda: self.processor.frequency_energy(context.gray))
+            check.values(reference[0] / reference[1] * 1000, candidate[0] / candidate[1] * 1000, image['name'])
+        return check
+
+    def check_sharpness_context(self):
+        check = CheckResult('sharpness_context', 'calculate_enhanced_sharpness', 'calculate_enhanced_sharpness + ImageContext',
+                            TOLERANCES['sharpness'])
+        for image in self.images:
+            context, _ = self.processor.create_image_context(image['path'])
+            if context is None:
+                continue
+            gray = context.gray
+            reference = check.timed('reference', lambda: self.processor.calculate_enhanced_sharpness(gray))
+            candidate = check.timed('candidate', lambda: self.processor.calculate_enhanced_sharpness(gray, context))
+            keys = sorted(reference)
+            check.same(keys, sorted(candidate), image['name'])
+            check.values([reference[key] for key in keys], [candidate.get(key, np.nan) for key in keys], image['name'])
+        return check
+
+    def check_quality_context(self):
+        """Quality helpers reading shared ImageContext maps vs computing their own"""
+        check = CheckResult('quality_context', 'quality helpers', 'quality helpers + ImageContext', TOLERANCES['quality'])
+        for image in self.images:
+            context, _ = self.processor.create_image_context(image['path'])
+            if context is None:
+                continue
+            gray = context.gray
+
+            def helpers(shared):
+                metrics = dict(self.processor.calculate_multi_scale_contrast(gray, shared))
+                metrics['noise'] = self.processor.estimate_noise(gray, shared)
+                metrics['detail'] = self.processor.assess_detail_quality(gray, shared)
+                weights = self.processor.calculate_adaptive_quality_weights(metrics, gray, shared)
+                return [metrics[key] for key in sorted(metrics)] + [weights[key] for key in sorted(weights)]
+
+            reference = check.timed('reference', lambda: helpers(None))
+            candidate = check.timed('candidate', lambda: helpers(context))
+            check.values(reference, candidate, image['name'])
+        return check
+
+    def check_quality_proxy(self):
+        """Quality score on bounded proxies vs the full resolution (images larger than the proxy only)"""
+        check = CheckResult('quality_proxy', 'assess_quality_advanced', 'assess_quality_advanced proxy',
+                            TOLERANCES['quality_proxy'])
+        for image in self.images:
+            reference = check.timed('reference', lambda: self.processor.assess_quality_advanced(image['path']))
+            candidate = check.timed('candidate', lambda: self.processor.assess_quality_advanced(image['path'], proxy=True))
+            if 'quality_proxy' in candidate:
+                check.values(reference['quality_score'], candidate['quality_score'], image['name'])
+        return check
+
+    def check_reduced_decode(self):
+        """Face boxes from a reduced decode vs the full decode, in original pixels (reduced images only)"""
+        check = CheckResult('reduced_decode', 'detect_faces_advanced', 'detect_faces_advanced reduced_decode',
+                            TOLERANCES['reduced_decode'])
+        for image in self.images:
+            reduction, original_shape = self.processor.plan_reduced_decode(image['path'], pipeline.REDUCED_DECODE_DIMENSION)
+            if reduction == 1:
+                continue
+            reference = check.timed('reference', lambda: self.processor.detect_faces_advanced(
+                image['path'], profile=GOLDEN_PROFILE))
+            candidate = check.timed('candidate', lambda: self.processor.detect_faces_advanced(
+                image['path'], profile=GOLDEN_PROFILE, reduced_decode=pipeline.REDUCED_DECODE_DIMENSION))
+            check.same(len(reference['faces']), len(candidate['faces']), image['name'])
+            if len(reference['faces']) == len(candidate['faces']):
+                # Ranking may change with the resolution, the boxes may not
+                longest = max(original_shape[:2])
+                check.values(np.array(sorted(face_boxes(reference['faces']))) / longest,
+                             np.array(sorted(face_boxes(candidate['faces']))) / longest, image['name'])
+        return check
+
+    def check_working_scale(self):
+        """Boxes of an image over the working size vs its working-size copy scaled up (large images only)
+        
+        The fast profile only detects on the working copy, which is the same pixels either way,
+        so the boxes must land in original pixels whatever the image size.
+        """
+        check = CheckResult('working_scale', 'detect_faces_advanced (working-size copy)', 'detect_faces_advanced',
+                            TOLERANCES['working_scale'])
+        for image in self.images:
+            context, _ = self.processor.create_image_context(image['path'])
+            if context is None or context.working_scale == 1.0:
+                continue
+            scale = context.working_scale
+            small = pipeline.ImageContext(context.working, source=image['path'])
+            reference = check.timed('reference', lambda: self.processor.detect_faces_advanced(
+                image['path'], context=small, profile=GOLDEN_PROFILE))
+            candidate = check.timed('candidate', lambda: self.processor.detect_faces_advanced(
+                image['path'], context=context, profile=GOLDEN_PROFILE))
+            check.same(len(reference['faces']), len(candidate['faces']), image['name'])
+            if len(reference['faces']) == len(candidate['faces']):
+                longest = max(context.shape[:2])
+                check.values(np.array(sorted(face_boxes(reference['faces']))) / scale / longest,
+                             np.array(sorted(face_boxes(candidate['faces']))) / longest, image['name'])
+        return check
+
+    def check_detection_threads(self):
+        """Threaded variant detection must give the serial boxes"""
+        check = CheckResult('detection_threads', 'detect_faces_advanced (1 worker)', 'detect_faces_advanced (4 workers)',
+                            TOLERANCES['boxes_px'])
+        workers = self.processor.detection_workers
+        try:
+            for image in self.images:
+                self.processor.detection_workers = 1
+                reference = check.timed('reference', lambda: self.processor.detect_faces_advanced(image['path'], profile='balanced'))
+                self.processor.detection_workers = 4
+                candidate = check.timed('candidate', lambda: self.processor.detect_faces_advanced(image['path'], profile='balanced'))
+                check.same(len(reference['faces']), len(candidate['faces']), image['name'])
+                if len(reference['faces']) == len(candidate['faces']):
+                    check.values(face_boxes(reference['faces']), face_boxes(candidate['faces']), image['name'])
+        finally:
+            self.processor.detection_workers = workers
+        return check
+
+    def check_analyze_image(self):
+        """analyze (one decode) vs extract_embeddings followed by quality"""
+        check = CheckResult('analyze_image', 'extract_advanced_embeddings + assess_quality_advanced', 'analyze_image',
+                            TOLERANCES['embedding'])
+        for image in self.images:
+            def separate():
+                return (self.processor.extract_advanced_embeddings(image['path'], profile=GOLDEN_PROFILE),
+                        self.processor.assess_quality_advanced(image['path']))
+            extraction, quality = check.timed('reference', separate)
+            analysis = check.timed('candidate', lambda: self.processor.analyze_image(image['path'], profile=GOLDEN_PROFILE))
+            check.same([entry['region'] for entry in extraction['embeddings']],
+                       [entry['region'] for entry in analysis['embeddings']], image['name'])
+            if len(extraction['embeddings']) == len(analysis['embeddings']):
+                check.values([entry['embedding'] for entry in extraction['embeddings']],
+                             [entry['embedding'] for entry in analysis['embeddings']], image['name'])
+            check.same(quality, analysis['quality'], image['name'])
+        return check
+
+    def run_checks(self, names):
+        reports = []
+        for name in names:
+            started = time.perf_counter()
+            check = getattr(self, f'check_{name}')()
+            report = check.report()
+            reports.append(report)
+            print(f"[CONFORMANCE] {name:<24} {'ok  ' if report['passed'] else 'FAIL'} cases={report['cases']} "
+                  f"max_drift={report['max_abs_drift']:.3g} mismatches={report['mismatches']} "
+                  f"speedup={report['speedup']} ({time.perf_counter() - started:.1f}s)", file=LOG_STREAM, flush=True)
+        return reports
+
+    # ------------------------------------------------------------------ golden outputs
+
+    def golden_outputs(self, profile=GOLDEN_PROFILE):
+        """Pipeline outputs per corpus image plus pairwise similarities of the extracted faces"""
+        outputs = {'profile': profile, 'images': {}, 'similarities': {}}
+        embeddings = []
+        for image in self.images:
+            detection = self.processor.detect_faces_advanced(image['path'], profile=profile)
+            extraction = self.processor.extract_advanced_embeddings(image['path'], profile=profile)
+            quality = self.processor.assess_quality_advanced(image['path'])
+            outputs['images'][image['name']] = {
+                'boxes': face_boxes(detection.get('faces', [])),
+                'embeddings': {str(entry['face_id']): entry['embedding'] for entry in extraction.get('embeddings', [])},
+                'quality_score': quality.get('quality_score'),
+                'quality_metrics': quality.get('detailed_metrics', {})
+            }
+            embeddings.extend((f"{image['name']}:{entry['face_id']}", entry['embedding'])
+                              for entry in extraction.get('embeddings', []))
+        for i, (name_a, a) in enumerate(embeddings):
+            for name_b, b in embeddings[i + 1:]:
+                result = self.compare_pair(a, b)
+                outputs['similarities'][f'{name_a}|{name_b}'] = [result['similarity'], result['confidence']]
+        return outputs
+
+    def compare_golden(self, golden, current):
+        """Per-output CheckResults of a run against recorded golden outputs (images of this run only)"""
+        boxes = CheckResult('golden_boxes', 'golden', 'current', TOLERANCES['boxes_px'])
+        embeddings = CheckResult('golden_embeddings', 'golden', 'current', TOLERANCES['embedding'])
+        quality = CheckResult('golden_quality', 'golden', 'current', TOLERANCES['quality'])
+        similarity = CheckResult('golden_similarity', 'golden', 'current', TOLERANCES['similarity'])
+
+        for name, expected in golden['images'].items():
+            actual = current['images'].get(name)
+            if actual is None:
+                continue
+            boxes.same(len(expected['boxes']), len(actual['boxes']), name)
+            if len(expected['boxes']) == len(actual['boxes']):
+                boxes.values(expected['boxes'], actual['boxes'], name)
+            embeddings.same(sorted(expected['embeddings']), sorted(actual['embeddings']), name)
+            for face_id, vector in expected['embeddings'].items():
+                if face_id in actual['embeddings']:
+                    embeddings.values(vector, actual['embeddings'][face_id], f'{name}:{face_id}')
+            keys = sorted(expected['quality_metrics'])
+            quality.same(keys, sorted(actual['quality_metrics']), name)
+            quality.values([expected['quality_score']] + [expected['quality_metrics'][key] for key in keys],
+                           [actual['quality_score']] + [actual['quality_metrics'].get(key, np.nan) for key in keys], name)
+
+        for pair, (sim, conf) in golden['similarities'].items():
+            if any(face.split(':')[0] not in current['images'] for face in pair.split('|')):
+                continue
+            if pair not in current['similarities']:
+                similarity.mismatch(pair, 'pair missing')
+                continue
+            new_sim, new_conf = current['similarities'][pair]
+            similarity.values([sim, conf], [new_sim, new_conf], pair)
+            similarity.same(match_decisions(sim, conf), match_decisions(new_sim, new_conf), pair)
+        return [boxes, embeddings, quality, similarity]
+
+
+def face_boxes(faces):
+    return [[face['x'], face['y'], face['width'], face['height']] for face in faces]
+
+# [CONFORMANCE] progress lines stay on the real stderr while the pipeline logs are muted
+LOG_STREAM = sys.stderr
+DEVNULL = open(os.devnull, 'w')
+
+def main():
+    parser = argparse.ArgumentParser(description='Conformance of optimized face pipeline paths against reference outputs')
+    parser.add_argument('--checks', nargs='+', choices=CHECKS, help='Side-by-side checks to run (default: all)')
+    parser.add_argument('--skip-checks', action='store_true', help='Only run the golden-output comparison/recording')
+    parser.add_argument('--record', help='Write golden pipeline outputs to this file')
+    parser.add_argument('--golden', nargs='?', const=DEFAULT_GOLDEN_FILE,
+                        help='Compare pipeline outputs with this golden file (default when given without a file: '
+                             'conformance_golden.json)')
+    parser.add_argument('--corpus', help='Folder of real images (default: the generated benchmark corpus)')
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR, help='Where the generated corpus is written')
+    parser.add_argument('--categories', nargs='+',
+                        help=f"Corpus categories to use (generated corpus default: {' '.join(GOLDEN_CATEGORIES)})")
+    parser.add_argument('--cache-dir', help='JSON embedding cache used for the similarity checks')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='Keep the pipeline debug output on stderr')
+    args = parser.parse_args()
+
+    quiet = contextlib.nullcontext if args.verbose else lambda: contextlib.redirect_stderr(DEVNULL)
+
+    with quiet():
+        processor = pipeline.AdvancedFaceProcessor()
+        corpus = FacePipelineBenchmark(processor)
+        images = corpus.load_corpus(os.path.abspath(args.corpus)) if args.corpus else \
+            corpus.generate_corpus(os.path.abspath(args.corpus_dir))
+        categories = args.categories or (None if args.corpus else GOLDEN_CATEGORIES)
+        if categories:
+            images = [image for image in images if image['category'] in categories]
+        suite = ConformanceSuite(processor, images, args.cache_dir)
+
+        report = {'success': True, 'version': CONFORMANCE_VERSION, 'images': [image['name'] for image in images],
+                  'tolerances': TOLERANCES, 'decision_thresholds': DECISION_THRESHOLDS, 'checks': []}
+        if not args.skip_checks:
+            report['checks'] = suite.run_checks(args.checks or CHECKS)
+
+        if args.record or args.golden:
+            current = suite.golden_outputs()
+            if args.record:
+                with open(args.record, 'w', encoding='utf-8') as f:
+                    json.dump(dict(current, version=CONFORMANCE_VERSION), f)
+                report['recorded'] = os.path.abspath(args.record)
+            if args.golden:
+                with open(args.golden, 'r', encoding='utf-8') as f:
+                    golden = json.load(f)
+                for check in suite.compare_golden(golden, current):
+                    report['checks'].append(check.report())
+                    print(f"[CONFORMANCE] {check.name:<24} {'ok  ' if check.passed else 'FAIL'} cases={check.cases} "
+                          f"max_drift={check.max_drift:.3g} mismatches={check.mismatches}", file=LOG_STREAM, flush=True)
+
+    report['passed'] = all(check['passed'] for check in report['checks'])
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    sys.exit(0 if report['passed'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+"""Persistent approximate nearest-neighbour index over face embeddings.
+
+IVF (inverted file) layout on NumPy: every row is assigned to the nearest of
+nlist k-means centroids (cosine), a search only scans the nprobe closest lists
+and the best candidates are re-ranked exactly with EmbeddingComparator.
+
+On-disk layout of an index directory:
+    index.json        dim, committed row count, centroids/list offsets info
+    vectors.f32       raw float32 rows, append-only (memory-mapped for search)
+    norms.f32         float32 L2 norm per row, append-only
+    assignments.i32   int32 list id per row (-1 before the first training)
+    entries.jsonl     one {"row", "id", "meta"} line per add, {"remove": id} per delete
+    centroids.npy     float32 unit centroids, written by rebuild
+
+Rows below 'trained_rows' are stored grouped by list (rebuild compacts and sorts
+them), later inserts are appended and searched through their assignment. Only
+rows counted in index.json are visible, so a crash between appends never
+exposes a half-written row. One writer at a time is assumed.
+"""
+import os
+import sys
+import json
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
+    sys.exit(1)
+
+from face_similarity import EmbeddingComparator
+
+
+INDEX_FORMAT_VERSION = 1
+
+# Default index location, next to the per-image JSON embedding cache
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cache', 'face_index')
+
+# Below this many rows the index stays flat (exact scan); reaching it trains the lists
+IVF_MIN_TRAIN_ROWS = 1024
+
+# Rebuild automatically once the index grew this many times past its last training
+IVF_REBUILD_GROWTH = 4
+
+# k-means trains on at most this many sampled rows per list
+KMEANS_SAMPLES_PER_LIST = 64
+KMEANS_ITERATIONS = 12
+
+DEFAULT_NPROBE = 8
+
+# Candidates (per requested result) passed from the cosine scan to exact re-ranking
+RERANK_CANDIDATES_PER_RESULT = 4
+MIN_RERANK_CANDIDATES = 16
+
+# Rows handled per chunk when scanning, assigning or rewriting vectors
+ROW_CHUNK = 4096
+
+
+class FaceEmbeddingIndex:
+    """IVF index stored in one directory; see the module docstring for the layout"""
+
+    def __init__(self, path=None, comparator=None):
+        self.path = os.path.abspath(path or DEFAULT_INDEX_PATH)
+        self.comparator = comparator or EmbeddingComparator()
+        self.load()
+
+    # ------------------------------------------------------------------ storage
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        """(Re)read the index files; missing files mean an empty index"""
+        meta = {}
+        if os.path.exists(self.file('index.json')):
+            with open(self.file('index.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version', INDEX_FORMAT_VERSION) != INDEX_FORMAT_VERSION:
+                raise ValueError(f"Unsupported index format version {meta.get('version')}")
+
+        self.dim = meta.get('dim')
+        self.rows = int(meta.get('rows', 0))
+        self.trained_rows = int(meta.get('trained_rows', 0))
+        self.next_id = int(meta.get('next_id', 0))
+        self.list_offsets = np.asarray(meta.get('list_offsets', []), dtype=np.int64)
+        self.signature = self.file_signature()
+
+        self.map_rows()
+
+        self.centroids = None
+        if self.list_offsets.size and os.path.exists(self.file('centroids.npy')):
+            self.centroids = np.load(self.file('centroids.npy'))
+
+        # Replay the entry log: row -> id/meta, id -> live row
+        self.ids = [None] * self.rows
+        self.metas = [None] * self.rows
+        self.id_to_row = {}
+        if os.path.exists(self.file('entries.jsonl')):
+            with open(self.file('entries.jsonl'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line after a crash
+                        continue
+                    if 'remove' in entry:
+                        row = self.id_to_row.pop(entry['remove'], None)
+                        if row is not None:
+                            self.ids[row] = None
+                            self.metas[row] = None
+                    elif entry.get('row', self.rows) < self.rows:
+                        row = entry['row']
+                        previous = self.id_to_row.get(entry['id'])
+                        if previous is not None:
+                            self.ids[previous] = None
+                            self.metas[previous] = None
+                        self.ids[row] = entry['id']
+                        self.metas[row] = entry.get('meta')
+                        self.id_to_row[entry['id']] = row
+
+        self.alive = np.array([row_id is not None for row_id in self.ids], dtype=bool)
+        self.build_tail_lists()
+
+    def map_rows(self):
+        """Memory-map the committed vectors and read the per-row arrays"""
+        if self.rows and self.dim:
+            self.vectors = np.memmap(self.file('vectors.f32'), dtype=np.float32, mode='r',
+                                     shape=(self.rows, self.dim))
+            self.norms = np.fromfile(self.file('norms.f32'), dtype=np.float32, count=self.rows)
+            self.assignments = np.fromfile(self.file('assignments.i32'), dtype=np.int32, count=self.rows)
+        else:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            self.norms = np.zeros(0, dtype=np.float32)
+            self.assignments = np.zeros(0, dtype=np.int32)
+
+    def file_signature(self):
+        """Identifies the committed state, so cached instances can notice other writers"""
+        try:
+            stat = os.stat(self.file('index.json'))
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def build_tail_lists(self):
+        """Group rows appended after the last training by their list"""
+        self.tail_lists = {}
+        tail = np.arange(self.trained_rows, self.rows)
+        if tail.size == 0:
+            return
+        tail_assignments = self.assignments[self.trained_rows:self.rows]
+        order = np.argsort(tail_assignments, kind='stable')
+        lists, starts = np.unique(tail_assignments[order], return_index=True)
+        for list_id, rows in zip(lists, np.split(tail[order], starts[1:])):
+            self.tail_lists[int(list_id)] = rows
+
+    def write_meta(self):
+        """Commit the row count and list layout (atomic replace of index.json)"""
+        meta = {
+            'version': INDEX_FORMAT_VERSION,
+            'dim': self.dim,
+            'rows': self.rows,
+            'trained_rows': self.trained_rows,
+            'next_id': self.next_id,
+            'nlist': int(self.list_offsets.size - 1) if self.list_offsets.size else 0,
+            'list_offsets': self.list_offsets.tolist()
+        }
+        temp_path = self.file('index.json.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.file('index.json'))
+        self.signature = self.file_signature()
+
+    @property
+    def trained(self):
+        return self.centroids is not None and self.list_offsets.size > 1
+
+    @property
+    def live_count(self):
+        return int(self.alive.sum())
+
+    # ------------------------------------------------------------------ updates
+
+    def add(self, vectors, ids=None, metas=None):
+        """Append embeddings; an id already present is replaced. Returns the result dict"""
+        try:
+            rows = [np.asarray(vector, dtype=np.float32).ravel() for vector in vectors]
+            if not rows:
+                return {'success': False, 'error': 'No embeddings to add'}
+            dim = self.dim or rows[0].size
+            bad = [i for i, row in enumerate(rows) if row.size != dim or not np.all(np.isfinite(row))]
+            if bad:
+                return {'success': False, 'error': f'Embeddings must be finite with {dim} dimensions (bad rows: {bad[:10]})'}
+
+            ids = list(ids) if ids is not None else [None] * len(rows)
+            metas = list(metas) if metas is not None else [None] * len(rows)
+            for i, row_id in enumerate(ids):
+                if row_id is None:
+                    ids[i] = str(self.next_id)
+                    self.next_id += 1
+                else:
+                    ids[i] = str(row_id)
+
+            matrix = np.vstack(rows)
+            norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+            if self.trained:
+                assignments = self.assign_lists(matrix, norms)
+            else:
+                assignments = np.full(len(rows), -1, dtype=np.int32)
+
+            os.makedirs(self.path, exist_ok=True)
+            self.dim = dim
+            first_row = self.rows
+            for name, values in (('vectors.f32', matrix), ('norms.f32', norms), ('assignments.i32', assignments)):
+                self.append_array(name, values, first_row)
+            with open(self.file('entries.jsonl'), 'a', encoding='utf-8') as f:
+                for offset, (row_id, meta) in enumerate(zip(ids, metas)):
+                    f.write(json.dumps({'row': first_row + offset, 'id': row_id, 'meta': meta}) + '\n')
+
+            self.rows += len(rows)
+            self.write_meta()
+
+            # Update the in-memory tables instead of replaying the whole entry log
+            self.map_rows()
+            self.ids.extend(ids)
+            self.metas.extend(metas)
+            alive = np.ones(len(rows), dtype=bool)
+            for offset, row_id in enumerate(ids):
+                previous = self.id_to_row.get(row_id)
+                if previous is not None and previous >= first_row:
+                    # Same id twice in this batch: the last one wins
+                    alive[previous - first_row] = False
+                elif previous is not None:
+                    self.ids[previous] = None
+                    self.metas[previous] = None
+                    self.alive[previous] = False
+                self.id_to_row[row_id] = first_row + offset
+            for offset in np.flatnonzero(~alive):
+                self.ids[first_row + offset] = None
+                self.metas[first_row + offset] = None
+            self.alive = np.concatenate([self.alive, alive])
+            self.build_tail_lists()
+
+            rebuilt = False
+            if (not self.trained and self.live_count >= IVF_MIN_TRAIN_ROWS) or \
+                    (self.trained and self.rows >= IVF_REBUILD_GROWTH * max(self.trained_rows, 1)):
+                self.rebuild()
+                rebuilt = True
+
+            return {
+                'success': True,
+                'added': len(rows),
+                'ids': ids,
+                'size': self.live_count,
+                'rebuilt': rebuilt
+            }
+
+        except Exception as e:
+            return {'success': False, 'error': f'Index add error: {str(e)}'}
+
+    def append_array(self, name, values, first_row):
+        """Append rows to a raw file, first dropping bytes past the committed rows"""
+        values = np.ascontiguousarray(values)
+        row_bytes = values.itemsize * (values.shape[1] if values.ndim > 1 else 1)
+        path = self.file(name)
+        with open(path, 'ab') as f:
+            if f.tell() != first_row * row_bytes:
+                f.truncate(first_row * row_bytes)
+            f.write(values.tobytes())
+
+    def remove(self, ids):
+        """Delete embeddings by id (tombstones until the next rebuild)"""
+        try:
+            removed, missing = [], []
+            for row_id in dict.fromkeys(str(row_id) for row_id in ids):
+                (removed if row_id in self.id_to_row else missing).append(row_id)
+            if removed:
+                with open(self.file('entries.jsonl'), 'a', encoding='utf-8') as f:
+                    for row_id in removed:
+                        f.write(json.dumps({'remove': row_id}) + '\n')
+            for row_id in removed:
+                row = self.id_to_row.pop(row_id)
+                self.ids[row] = None
+                self.metas[row] = None
+                self.alive[row] = False
+            if removed:
+                self.write_meta()
+            return {'success': True, 'removed': removed, 'missing': missing, 'size': self.live_count}
+
+        except Exception as e:
+            return {'success': False, 'error': f'Index remove error: {str(e)}'}
+
+    def rebuild(self, nlist=None, seed=0):
+        """Compact away deleted rows, retrain the lists and store rows grouped by list"""
+        try:
+            live_rows = np.flatnonzero(self.alive)
+            count = live_rows.size
+            if count == 0:
+                self.reset_files()
+                return {'success': True, 'size': 0, 'nlist': 0}
+
+            if nlist is None:
+                nlist = int(round(math.sqrt(count))) if count >= IVF_MIN_TRAIN_ROWS else 1
+            nlist = max(1, min(int(nlist), count))
+
+            rng = np.random.default_rng(seed)
+            sample_size = min(count, nlist * KMEANS_SAMPLES_PER_LIST)
+            sample_rows = np.sort(rng.choice(live_rows, sample_size, replace=False))
+            centroids = spherical_kmeans(self.unit_rows(sample_rows), nlist, rng)
+
+            assignments = np.empty(count, dtype=np.int32)
+            for start in range(0, count, ROW_CHUNK):
+                chunk = live_rows[start:start + ROW_CHUNK]
+                assignments[start:start + ROW_CHUNK] = nearest_centroids(self.unit_rows(chunk), centroids)
+            order = np.argsort(assignments, kind='stable')
+            new_rows = live_rows[order]
+            sorted_assignments = assignments[order]
+            list_offsets = np.searchsorted(sorted_assignments, np.arange(nlist + 1)).astype(np.int64)
+
+            # Write the compacted files next to the old ones, then swap them in
+            with open(self.file('vectors.f32.tmp'), 'wb') as f:
+                for start in range(0, count, ROW_CHUNK):
+                    f.write(np.ascontiguousarray(self.vectors[new_rows[start:start + ROW_CHUNK]]).tobytes())
+            self.norms[new_rows].tofile(self.file('norms.f32.tmp'))
+            sorted_assignments.tofile(self.file('assignments.i32.tmp'))
+            with open(self.file('entries.jsonl.tmp'), 'w', encoding='utf-8') as f:
+                for new_row, old_row in enumerate(new_rows):
+                    f.write(json.dumps({'row': new_row, 'id': self.ids[old_row], 'meta': self.metas[old_row]}) + '\n')
+            with open(self.file('centroids.npy.tmp'), 'wb') as f:
+                np.save(f, centroids.astype(np.float32))
+
+            # Release the memory map before replacing its file
+            self.vectors = None
+            for name in ('vectors.f32', 'norms.f32', 'assignments.i32', 'entries.jsonl', 'centroids.npy'):
+                os.replace(self.file(name + '.tmp'), self.file(name))
+
+            self.rows = count
+            self.trained_rows = count
+            self.list_offsets = list_offsets
+            self.write_meta()
+            self.load()
+
+            sizes = np.diff(list_offsets)
+            print(f"Index rebuilt: {count} rows in {nlist} lists (largest {int(sizes.max())})", file=sys.stderr)
+            return {
+                'success': True,
+                'size': count,
+                'nlist': nlist,
+                'largest_list': int(sizes.max()),
+                'empty_lists': int((sizes == 0).sum())
+            }
+
+        except Exception as e:
+            return {'success': False, 'error': f'Index rebuild error: {str(e)}'}
+
+    def reset_files(self):
+        """Empty the index but keep its id counter"""
+        self.vectors = None
+        for name in ('vectors.f32', 'norms.f32', 'assignments.i32', 'entries.jsonl', 'centroids.npy'):
+            if os.path.exists(self.file(name)):
+                os.remove(self.file(name))
+        self.rows = 0
+        self.trained_rows = 0
+        self.list_offsets = np.zeros(0, dtype=np.int64)
+        self.write_meta()
+        self.load()
+
+    # ------------------------------------------------------------------ k-means
+
+    def unit_rows(self, rows):
+        """Rows as unit vectors (zero rows stay zero)"""
+        return unit_vectors(np.asarray(self.vectors[rows], dtype=np.float32), self.norms[rows])
+
+    def assign_lists(self, matrix, norms):
+        return nearest_centroids(unit_vectors(matrix, norms), self.centroids)
+
+    # ------------------------------------------------------------------ search
+
+    def search(self, queries, top_k=10, nprobe=None, rerank=True, min_similarity=None):
+        """Top-k matches per query: cosine over the probed lists, then exact re-ranking"""
+        try:
+            if self.live_count == 0:
+                return {'success': False, 'error': 'Index is empty'}
+            top_k = max(1, int(top_k or 10))
+            nprobe = max(1, int(nprobe or DEFAULT_NPROBE))
+
+            results = []
+            for qi, query in enumerate(queries):
+                query = np.asarray(query, dtype=np.float32).ravel()
+                if query.size != self.dim:
+                    return {'success': False, 'error': f'Query {qi} has {query.size} dimensions, index has {self.dim}'}
+
+                rows, scores, lists_probed, scanned = self.scan(query, nprobe)
+                keep = min(rows.size, max(top_k * RERANK_CANDIDATES_PER_RESULT, MIN_RERANK_CANDIDATES) if rerank else top_k)
+                if keep < rows.size:
+                    best = np.argpartition(-scores, keep - 1)[:keep]
+                    rows, scores = rows[best], scores[best]
+                order = np.argsort(-scores, kind='stable')
+                rows, scores = rows[order], scores[order]
+
+                matches = [{'id': self.ids[row], 'meta': self.metas[row], 'cosine': float(score)}
+                           for row, score in zip(rows, scores)]
+                if rerank and matches:
+                    matches = self.rerank(query, rows, matches)
+                if min_similarity is not None:
+                    matches = [m for m in matches if m.get('similarity', m['cosine']) >= min_similarity]
+
+                results.append({
+                    'query_index': qi,
+                    'candidates_scanned': scanned,
+                    'lists_probed': lists_probed,
+                    'matches': matches[:top_k]
+                })
+
+            return {'success': True, 'size': self.live_count, 'results': results}
+
+        except Exception as e:
+            return {'success': False, 'error': f'Index search error: {str(e)}'}
+
+    def scan(self, query, nprobe):
+        """(live rows, cosine scores, probed list count, scanned rows) for the candidate lists"""
+        query_norm = float(np.linalg.norm(query)) or 1.0
+        if self.trained:
+            centroid_scores = self.centroids @ query
+            nprobe = min(nprobe, len(self.centroids))
+            probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            segments = [np.arange(self.list_offsets[list_id], self.list_offsets[list_id + 1]) for list_id in probed]
+            segments += [self.tail_lists[int(list_id)] for list_id in probed if int(list_id) in self.tail_lists]
+            lists_probed = int(probed.size)
+        else:
+            segments = [np.arange(self.rows)]
+            lists_probed = 0
+
+        all_rows, all_scores = [], []
+        for rows in segments:
+            if rows.size == 0:
+                continue
+            if rows[-1] - rows[0] + 1 == rows.size:
+                # Contiguous list: score the memory-mapped slab without gathering
+                block = self.vectors[rows[0]:rows[-1] + 1]
+            else:
+                block = self.vectors[rows]
+            for start in range(0, rows.size, ROW_CHUNK):
+                dots = np.asarray(block[start:start + ROW_CHUNK]) @ query
+                norms = self.norms[rows[start:start + ROW_CHUNK]]
+                all_scores.append(dots / (np.where(norms > 0, norms, 1.0) * query_norm))
+                all_rows.append(rows[start:start + ROW_CHUNK])
+
+        if not all_rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), lists_probed, 0
+        rows = np.concatenate(all_rows)
+        scores = np.concatenate(all_scores)
+        live = self.alive[rows]
+        return rows[live], scores[live], lists_probed, int(rows.size)
+
+    def rerank(self, query, rows, matches):
+        """Exact compare_faces_advanced scores (batched) for the cosine candidates"""
+        gallery = np.asarray(self.vectors[np.sort(rows)], dtype=np.float64)
+        position = {row: i for i, row in enumerate(np.sort(rows))}
+        comparison = self.comparator.compare_many([query.astype(np.float64)], list(gallery))
+        if not comparison.get('success'):
+            raise ValueError(comparison.get('error', 'Re-ranking failed'))
+
+        by_row = {}
+        for match in comparison['results'][0]['matches']:
+            by_row[match['gallery_index']] = match
+        ranked = []
+        for row, match in zip(rows, matches):
+            exact = by_row[position[row]]
+            match.update({
+                'similarity': exact['similarity'],
+                'distance': exact['distance'],
+                'confidence': exact['confidence']
+            })
+            ranked.append(match)
+        # Stable: equal exact scores keep the cosine order
+        ranked.sort(key=lambda m: -m['similarity'])
+        return ranked
+
+    def info(self):
+        sizes = np.diff(self.list_offsets) if self.trained else np.zeros(0)
+        return {
+            'success': True,
+            'path': self.path,
+            'dim': self.dim,
+            'size': self.live_count,
+            'rows': self.rows,
+            'trained_rows': self.trained_rows,
+            'nlist': int(sizes.size),
+            'largest_list': int(sizes.max()) if sizes.size else 0
+        }
+
+
+def unit_vectors(matrix, norms=None):
+    """Rows scaled to unit length (zero rows stay zero)"""
+    if norms is None:
+        norms = np.linalg.norm(matrix, axis=1)
+    return matrix / np.where(norms > 0, norms, 1.0)[:, None]
+
+def nearest_centroids(unit_matrix, centroids):
+    """Index of the most cosine-similar centroid per unit row"""
+    return np.argmax(unit_matrix @ centroids.T, axis=1).astype(np.int32)
+
+def spherical_kmeans(sample, nlist, rng, iterations=KMEANS_ITERATIONS):
+    """k-means on unit vectors with cosine assignment; returns unit centroids"""
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(sample, centroids)
+        order = np.argsort(labels, kind='stable')
+        present, starts = np.unique(labels[order], return_index=True)
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1)
+        centroids[present] = sums / np.where(norms > 0, norms, 1.0)[:, None]
+
+        # Re-seed lists that lost every member
+        empty = np.setdiff1d(np.arange(nlist), present)
+        if empty.size:
+            centroids[empty] = sample[rng.choice(len(sample), empty.size, replace=False)]
+    return centroids
+
+
+# Open indexes by path, so serve mode keeps the memory maps and entry table warm
+_open_indexes = {}
+
+def open_index(path=None, comparator=None):
+    """Cached FaceEmbeddingIndex for a path, reloaded when another writer committed"""
+    key = os.path.abspath(path or DEFAULT_INDEX_PATH)
+    index = _open_indexes.get(key)
+    if index is None:
+        index = FaceEmbeddingIndex(key, comparator)
+        _open_indexes[key] = index
+    elif index.signature != index.file_signature():
+        index.load()
+    return index
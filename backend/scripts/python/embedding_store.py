@@ -0,0 +1,410 @@
+"""Memory-mapped binary embedding store.
+
+Replaces reading one pretty-printed JSON file per image: embeddings live in
+contiguous float32 matrices (one shard per dimension, since the cache mixes
+lengths) and a fixed-size binary table maps every row to its image hash, face
+and shard offset. Loading a gallery is one np.fromfile for the table plus a
+memory map per shard, with no text parsing.
+
+On-disk layout of a store directory (g = generation, bumped by compact):
+    store.json             committed table size and rows per shard
+    table.<g>.bin          TABLE_DTYPE records, append-only (deleted flag set in place)
+    vectors.<g>.<dim>.f32  raw float32 rows of one dimension, append-only
+    images.<g>.jsonl       per-image metadata log (imageUrl, qualityScore, ...)
+
+Only rows counted in store.json are visible, so a crash during an append never
+exposes a partial row; compact writes the next generation and switches to it
+with one atomic replace of store.json. One writer at a time is assumed.
+"""
+import os
+import sys
+import json
+import glob
+
+try:
+    import numpy as np
+except ImportError:
+    print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
+    sys.exit(1)
+
+
+STORE_FORMAT_VERSION = 1
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STORE_PATH = os.path.join(SCRIPT_DIR, '..', '..', 'cache', 'embedding_store')
+DEFAULT_JSON_CACHE_DIR = os.path.join(SCRIPT_DIR, '..', '..', 'cache', 'embeddings')
+
+# Cache files imported per commit
+IMPORT_BATCH_IMAGES = 1000
+
+# One record per stored face; 'offset' is the row inside the shard of that dimension
+TABLE_DTYPE = np.dtype([
+    ('image_hash', 'S32'),
+    ('face_id', '<i4'),
+    ('dim', '<i4'),
+    ('offset', '<i8'),
+    ('deleted', 'u1'),
+])
+
+
+class EmbeddingStore:
+    """Append-only float32 embedding shards plus a binary row table"""
+
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or DEFAULT_STORE_PATH)
+        self.load()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def table_file(self, generation=None):
+        return self.file(f'table.{self.generation if generation is None else generation}.bin')
+
+    def shard_file(self, dim, generation=None):
+        return self.file(f'vectors.{self.generation if generation is None else generation}.{int(dim)}.f32')
+
+    def images_file(self, generation=None):
+        return self.file(f'images.{self.generation if generation is None else generation}.jsonl')
+
+    def load(self):
+        """(Re)read the committed table and map every shard; missing files mean an empty store"""
+        meta = {}
+        if os.path.exists(self.file('store.json')):
+            with open(self.file('store.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version', STORE_FORMAT_VERSION) != STORE_FORMAT_VERSION:
+                raise ValueError(f"Unsupported store format version {meta.get('version')}")
+
+        self.generation = int(meta.get('generation', 0))
+        self.table_rows = int(meta.get('table_rows', 0))
+        self.shard_rows = {int(dim): int(rows) for dim, rows in meta.get('shards', {}).items()}
+
+        if self.table_rows:
+            self.table = np.fromfile(self.table_file(), dtype=TABLE_DTYPE, count=self.table_rows)
+        else:
+            self.table = np.zeros(0, dtype=TABLE_DTYPE)
+        self.shards = {
+            dim: np.memmap(self.shard_file(dim), dtype=np.float32, mode='r', shape=(rows, dim))
+            for dim, rows in self.shard_rows.items() if rows
+        }
+        # Image metadata is only parsed when someone asks for it
+        self._images = None
+        self.signature = self.file_signature()
+
+    def file_signature(self):
+        """Identifies the committed state, so cached instances can notice other writers"""
+        try:
+            stat = os.stat(self.file('store.json'))
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def write_meta(self, generation=None):
+        """Commit the table size and shard row counts (atomic replace of store.json)"""
+        meta = {
+            'version': STORE_FORMAT_VERSION,
+            'generation': self.generation if generation is None else generation,
+            'table_rows': self.table_rows,
+            'shards': {str(dim): rows for dim, rows in self.shard_rows.items()}
+        }
+        temp_path = self.file('store.json.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.file('store.json'))
+
+    @property
+    def images(self):
+        """image hash -> metadata, replayed from the image log"""
+        if self._images is None:
+            self._images = {}
+            if os.path.exists(self.images_file()):
+                with open(self.images_file(), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        if 'remove' in entry:
+                            self._images.pop(entry['remove'], None)
+                        else:
+                            self._images[entry['imageHash']] = entry
+        return self._images
+
+    def live_rows(self, image_hashes=None):
+        """Table positions of non-deleted rows, optionally only for some images"""
+        live = self.table['deleted'] == 0
+        if image_hashes is not None:
+            wanted = np.array([h.encode('ascii') for h in image_hashes], dtype='S32')
+            live &= np.isin(self.table['image_hash'], wanted)
+        return np.flatnonzero(live)
+
+    def has_image(self, image_hash):
+        return self.live_rows([image_hash]).size > 0
+
+    # ------------------------------------------------------------------ updates
+
+    def add_image(self, image_hash, embeddings, meta=None):
+        """Store the face embeddings of one image, replacing any earlier version of it"""
+        result = self.add_images([(image_hash, embeddings, meta)])
+        if result['success']:
+            result = {'success': True, 'image_hash': str(image_hash), 'added': result['added'], 'replaced': result['replaced']}
+        return result
+
+    def add_images(self, images):
+        """Append (image_hash, embeddings, meta) items in one commit
+
+        New rows are committed before the previous rows of the same images are
+        flagged, so an interrupted replace leaves the old version readable.
+        """
+        try:
+            records, vectors, image_metas = [], [], {}
+            for image_hash, embeddings, meta in images:
+                image_hash = str(image_hash)
+                if len(image_hash.encode('ascii')) > TABLE_DTYPE['image_hash'].itemsize:
+                    return {'success': False, 'error': f'Image hash {image_hash} longer than {TABLE_DTYPE["image_hash"].itemsize} characters'}
+                image_vectors = [np.asarray(e, dtype=np.float32).ravel() for e in embeddings]
+                if not image_vectors or any(v.size == 0 or not np.all(np.isfinite(v)) for v in image_vectors):
+                    return {'success': False, 'error': f'Embeddings of {image_hash} must be non-empty and finite'}
+                if image_hash in image_metas:
+                    # Same image twice in one call: keep the last version only
+                    keep = [i for i, record in enumerate(records) if record[0] != image_hash]
+                    records = [records[i] for i in keep]
+                    vectors = [vectors[i] for i in keep]
+                for face_id, vector in enumerate(image_vectors):
+                    records.append((image_hash, face_id))
+                    vectors.append(vector)
+                image_meta = dict(meta or {})
+                image_meta['imageHash'] = image_hash
+                image_meta['faceCount'] = len(image_vectors)
+                image_metas[image_hash] = image_meta
+            if not records:
+                return {'success': False, 'error': 'No images to add'}
+
+            previous_rows = self.live_rows(list(image_metas))
+            os.makedirs(self.path, exist_ok=True)
+
+            table = np.zeros(len(records), dtype=TABLE_DTYPE)
+            shard_rows = dict(self.shard_rows)
+            for position, ((image_hash, face_id), vector) in enumerate(zip(records, vectors)):
+                dim = vector.size
+                table[position] = (image_hash.encode('ascii'), face_id, dim, shard_rows.get(dim, 0), 0)
+                shard_rows[dim] = shard_rows.get(dim, 0) + 1
+
+            for dim in sorted(set(v.size for v in vectors)):
+                rows = np.vstack([v for v in vectors if v.size == dim])
+                self.append_bytes(self.shard_file(dim), rows, self.shard_rows.get(dim, 0) * dim * 4)
+            self.append_bytes(self.table_file(), table, self.table_rows * TABLE_DTYPE.itemsize)
+            with open(self.images_file(), 'a', encoding='utf-8') as f:
+                for image_meta in image_metas.values():
+                    f.write(json.dumps(image_meta) + '\n')
+
+            self.table_rows += len(records)
+            self.shard_rows = shard_rows
+            self.write_meta()
+            self.load()
+            replaced = self.mark_deleted(previous_rows)
+            return {'success': True, 'images': len(image_metas), 'added': len(records), 'replaced': replaced}
+
+        except Exception as e:
+            return {'success': False, 'error': f'Store add error: {str(e)}'}
+
+    def append_bytes(self, path, values, committed_bytes):
+        """Append after the committed bytes, dropping leftovers of an interrupted write"""
+        with open(path, 'ab') as f:
+            if f.tell() != committed_bytes:
+                f.truncate(committed_bytes)
+            f.write(np.ascontiguousarray(values).tobytes())
+
+    def mark_deleted(self, rows):
+        """Flag table rows as deleted in place; returns how many were flagged"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size:
+            table = np.memmap(self.table_file(), dtype=TABLE_DTYPE, mode='r+', shape=(self.table_rows,))
+            table['deleted'][rows] = 1
+            table.flush()
+            del table
+            self.table['deleted'][rows] = 1
+            # Flags live outside store.json, touch it so cached readers reload
+            self.write_meta()
+            self.signature = self.file_signature()
+        return int(rows.size)
+
+    def remove_images(self, image_hashes):
+        """Delete every face of the given images (space is reclaimed by compact)"""
+        try:
+            image_hashes = [str(h) for h in image_hashes]
+            present = [h for h in dict.fromkeys(image_hashes) if self.has_image(h)]
+            removed_rows = self.mark_deleted(self.live_rows(present))
+            if present:
+                with open(self.images_file(), 'a', encoding='utf-8') as f:
+                    for image_hash in present:
+                        f.write(json.dumps({'remove': image_hash}) + '\n')
+                self._images = None
+            return {
+                'success': True,
+                'removed_images': present,
+                'removed_rows': removed_rows,
+                'missing': [h for h in image_hashes if h not in present]
+            }
+
+        except Exception as e:
+            return {'success': False, 'error': f'Store remove error: {str(e)}'}
+
+    def compact(self):
+        """Rewrite live rows into the next generation and switch to it"""
+        try:
+            live = self.live_rows()
+            next_generation = self.generation + 1
+            table = self.table[live].copy()
+            shard_rows = {}
+            for dim, shard in self.shards.items():
+                in_shard = np.flatnonzero(table['dim'] == dim)
+                if in_shard.size == 0:
+                    continue
+                with open(self.shard_file(dim, next_generation), 'wb') as f:
+                    for start in range(0, in_shard.size, 4096):
+                        chunk = in_shard[start:start + 4096]
+                        f.write(np.ascontiguousarray(shard[table['offset'][chunk]]).tobytes())
+                table['offset'][in_shard] = np.arange(in_shard.size)
+                shard_rows[dim] = int(in_shard.size)
+            table.tofile(self.table_file(next_generation))
+            with open(self.images_file(next_generation), 'w', encoding='utf-8') as f:
+                live_images = set(h.decode('ascii') for h in table['image_hash'])
+                for image_hash, image_meta in self.images.items():
+                    if image_hash in live_images:
+                        f.write(json.dumps(image_meta) + '\n')
+
+            old_files = [self.table_file(), self.images_file()] + [self.shard_file(dim) for dim in self.shard_rows]
+            reclaimed = self.table_rows - int(live.size)
+            self.table_rows = int(live.size)
+            self.shard_rows = shard_rows
+            self.shards = {}
+            self.write_meta(next_generation)
+            for path in old_files:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.load()
+            return {'success': True, 'rows': self.table_rows, 'reclaimed_rows': reclaimed, 'generation': self.generation}
+
+        except Exception as e:
+            return {'success': False, 'error': f'Store compact error: {str(e)}'}
+
+    def import_json_cache(self, cache_dir=None, replace=False):
+        """Import backend/cache/embeddings/*.json; images already stored are skipped unless replace"""
+        try:
+            cache_dir = os.path.abspath(cache_dir or DEFAULT_JSON_CACHE_DIR)
+            stored = set(h.decode('ascii') for h in self.table['image_hash'][self.live_rows()])
+            imported, skipped, failed, pending = 0, 0, [], []
+            paths = sorted(glob.glob(os.path.join(cache_dir, '*.json')))
+            for count, path in enumerate(paths, 1):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        cached = json.load(f)
+                    image_hash = cached.get('imageHash') or os.path.splitext(os.path.basename(path))[0]
+                    if not replace and image_hash in stored:
+                        skipped += 1
+                    else:
+                        embeddings = [e.get('embedding', []) if isinstance(e, dict) else e
+                                      for e in cached.get('embeddings', [])]
+                        meta = {key: value for key, value in cached.items()
+                                if key not in ('embeddings', 'imageHash', 'faceCount')}
+                        pending.append((os.path.basename(path), (image_hash, embeddings, meta)))
+                except Exception as e:
+                    failed.append({'file': os.path.basename(path), 'error': str(e)})
+
+                if len(pending) >= IMPORT_BATCH_IMAGES or (count == len(paths) and pending):
+                    result = self.add_images([item for _, item in pending])
+                    if result['success']:
+                        imported += len(pending)
+                    else:
+                        # Retry one by one so a single bad file does not sink the batch
+                        for name, item in pending:
+                            single = self.add_images([item])
+                            if single['success']:
+                                imported += 1
+                            else:
+                                failed.append({'file': name, 'error': single['error']})
+                    pending = []
+
+            print(f"Imported {imported} cached images into {self.path} ({skipped} already stored, {len(failed)} failed)", file=sys.stderr)
+            return {'success': True, 'imported': imported, 'skipped': skipped, 'failed': failed, 'rows': self.table_rows}
+
+        except Exception as e:
+            return {'success': False, 'error': f'Store import error: {str(e)}'}
+
+    # ------------------------------------------------------------------ reading
+
+    def gallery(self, image_hashes=None):
+        """StoredEmbeddings view of the live rows, usable as a comparison gallery"""
+        return StoredEmbeddings(self, self.live_rows(image_hashes))
+
+    def info(self):
+        live = self.live_rows()
+        return {
+            'success': True,
+            'path': self.path,
+            'generation': self.generation,
+            'rows': int(live.size),
+            'deleted_rows': self.table_rows - int(live.size),
+            'images': int(np.unique(self.table['image_hash'][live]).size),
+            'shards': {str(dim): int((self.table['dim'][live] == dim).sum()) for dim in sorted(self.shard_rows)}
+        }
+
+
+class StoredEmbeddings:
+    """Sequence of stored rows that hands batch comparison whole shard matrices
+
+    Indexing returns one row (a memory-map view); length_buckets() returns each
+    dimension's rows as one matrix, without copying when the shard has no
+    deleted or filtered-out rows.
+    """
+
+    def __init__(self, store, table_rows):
+        self.store = store
+        self.table_rows = table_rows
+        self.records = store.table[table_rows]
+
+    def __len__(self):
+        return int(self.table_rows.size)
+
+    def __getitem__(self, position):
+        record = self.records[position]
+        return self.store.shards[int(record['dim'])][int(record['offset'])]
+
+    def length_buckets(self):
+        """{dim: (positions in this view, float32 matrix of those rows)}"""
+        buckets = {}
+        for dim in np.unique(self.records['dim']):
+            positions = np.flatnonzero(self.records['dim'] == dim)
+            offsets = self.records['offset'][positions]
+            shard = self.store.shards[int(dim)]
+            if offsets.size == shard.shape[0] and np.array_equal(offsets, np.arange(offsets.size)):
+                matrix = shard
+            else:
+                matrix = shard[offsets]
+            buckets[int(dim)] = (positions, matrix)
+        return buckets
+
+    def ids(self, positions=None):
+        """'<imageHash>:<face_id>' per row"""
+        records = self.records if positions is None else self.records[positions]
+        return [f"{h.decode('ascii')}:{int(face)}" for h, face in zip(records['image_hash'], records['face_id'])]
+
+    def describe(self, position):
+        record = self.records[position]
+        return {'image_hash': record['image_hash'].decode('ascii'), 'face_id': int(record['face_id'])}
+
+
+# Open stores by path, so serve mode keeps the table and shard maps warm
+_open_stores = {}
+
+def open_store(path=None):
+    """Cached EmbeddingStore for a path, reloaded when another writer committed"""
+    key = os.path.abspath(path or DEFAULT_STORE_PATH)
+    store = _open_stores.get(key)
+    if store is None:
+        store = EmbeddingStore(key)
+        _open_stores[key] = store
+    elif store.signature != store.file_signature():
+        store.load()
+    return store
@@ -0,0 +1,679 @@
+"""Gallery-wide face clustering on top of the batched comparator.
+
+Faces are split into partitions of similar direction (spherical k-means, rows
+near a partition border join their second partition too). Inside a partition
+every pair is scored with batch_compare_block, i.e. the compare_faces_advanced
+similarity with early rejection, and pairs at or above min_similarity are
+linked. Components of the link graph (single linkage, union-find) are the
+clusters, so the cost grows with n * partition size instead of n^2.
+
+FaceClusterTable keeps the result as persistent person centroids so that new
+uploads are assigned incrementally instead of re-clustering the gallery.
+"""
+import os
+import sys
+import json
+import shutil
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
+    sys.exit(1)
+
+from face_similarity import EmbeddingComparator
+from embedding_index import spherical_kmeans, nearest_centroids, unit_vectors
+
+
+# Pairs at or above this comparator similarity are linked (findSimilarFaces default)
+CLUSTER_MIN_SIMILARITY = 0.65
+
+# Target rows per partition; larger partitions are scored in blocks of this size
+CLUSTER_PARTITION_ROWS = 128
+
+# A row also joins its second partition when that centroid is this close (cosine)
+CLUSTER_BORDER_MARGIN = 0.05
+
+# Members listed as representative faces per cluster
+CLUSTER_REPRESENTATIVES = 3
+
+CLUSTER_TABLE_VERSION = 1
+
+# Default cluster table location, next to the embedding store and index
+DEFAULT_CLUSTERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cache', 'face_clusters')
+
+# Running statistics per cluster; the member vector sum is the same row of sums.<g>.f64
+CLUSTER_DTYPE = np.dtype([
+    ('cluster_id', '<i8'),
+    ('count', '<i8'),
+    ('norm_sq_sum', '<f8'),
+    ('deleted', 'u1'),
+])
+
+# Clusters compared exactly per new face, picked by centroid cosine
+ASSIGN_CANDIDATES = 16
+
+# Rebalance after this many assignments, and at least this fraction of all faces
+CLUSTER_REBALANCE_MIN_ASSIGNED = 1000
+CLUSTER_REBALANCE_FRACTION = 0.1
+
+
+class DisjointSet:
+    """Union-find with path halving and union by size"""
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return False
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return True
+
+    def labels(self):
+        return np.array([self.find(item) for item in range(len(self.parent))], dtype=np.int64)
+
+
+class FaceClusterer:
+    """cluster_faces over embedding lists or stored galleries"""
+
+    def __init__(self, comparator=None):
+        self.comparator = comparator or EmbeddingComparator()
+
+    def cluster_faces(self, embeddings, ids=None, min_similarity=None, min_cluster_size=1,
+                      partition_rows=None, include_centroids=True, seed=0):
+        """Group faces into person clusters
+
+        embeddings is a list of vectors, a 2-D array or a StoredEmbeddings gallery;
+        faces of different lengths are clustered separately (the comparator would
+        truncate them). Clusters smaller than min_cluster_size are reported as
+        unclustered.
+        """
+        try:
+            min_similarity = CLUSTER_MIN_SIMILARITY if min_similarity is None else float(min_similarity)
+            partition_rows = max(2, int(partition_rows or CLUSTER_PARTITION_ROWS))
+            buckets = self.comparator.row_buckets(embeddings)
+            total = len(embeddings)
+            if total == 0:
+                return {'success': False, 'error': 'No embeddings to cluster'}
+            if ids is None:
+                ids = embeddings.ids() if hasattr(embeddings, 'ids') else list(range(total))
+            ids = [position if row_id is None else row_id for position, row_id in enumerate(ids)]
+
+            rng = np.random.default_rng(seed)
+            clusters, unclustered = [], []
+            stats = {'blocks': 0, 'pairs_scored': 0, 'early_rejections': 0, 'links': 0}
+            for length, (positions, matrix) in sorted(buckets.items()):
+                positions = np.asarray(positions)
+                if matrix is None:
+                    X = np.stack([np.asarray(embeddings[i], dtype=np.float64) for i in positions])
+                else:
+                    X = np.asarray(matrix, dtype=np.float64)
+
+                labels = self.link_components(X, min_similarity, partition_rows, rng, stats)
+                for members in self.group_labels(labels):
+                    if len(members) < min_cluster_size:
+                        unclustered.extend(ids[positions[m]] for m in members)
+                        continue
+                    clusters.append(self.describe_cluster(X, members, positions, ids, include_centroids))
+
+            clusters.sort(key=lambda cluster: -cluster['size'])
+            for cluster_id, cluster in enumerate(clusters):
+                cluster['cluster_id'] = cluster_id
+
+            print(f"Clustered {total} faces into {len(clusters)} clusters "
+                  f"({stats['pairs_scored']} pairs scored, {stats['links']} links)", file=sys.stderr)
+            return {
+                'success': True,
+                'face_count': total,
+                'cluster_count': len(clusters),
+                'min_similarity': min_similarity,
+                'clusters': clusters,
+                'unclustered': unclustered,
+                'stats': stats
+            }
+
+        except Exception as e:
+            return {'success': False, 'error': f'Clustering error: {str(e)}'}
+
+    def link_components(self, X, min_similarity, partition_rows, rng, stats):
+        """Component label per row of X (same-length rows)"""
+        n = X.shape[0]
+        disjoint = DisjointSet(n)
+        for partition in self.partition_rows(X, partition_rows, rng):
+            blocks = [partition[start:start + partition_rows] for start in range(0, partition.size, partition_rows)]
+            for i, rows_a in enumerate(blocks):
+                for rows_b in blocks[i:]:
+                    self.link_block(X, rows_a, rows_b, min_similarity, disjoint, stats)
+        return disjoint.labels()
+
+    def partition_rows(self, X, partition_rows, rng):
+        """Row index arrays of overlapping partitions"""
+        n = X.shape[0]
+        if n <= partition_rows:
+            return [np.arange(n)]
+
+        unit = unit_vectors(X.astype(np.float32))
+        nlist = max(2, int(round(n / partition_rows)))
+        sample = unit[rng.choice(n, min(n, nlist * 64), replace=False)]
+        centroids = spherical_kmeans(sample, nlist, rng)
+
+        primary = nearest_centroids(unit, centroids)
+        partitions = [[] for _ in range(nlist)]
+        for start in range(0, n, 8192):
+            scores = unit[start:start + 8192] @ centroids.T
+            best = primary[start:start + 8192]
+            best_scores = scores[np.arange(len(best)), best]
+            scores[np.arange(len(best)), best] = -np.inf
+            second = np.argmax(scores, axis=1)
+            border = scores[np.arange(len(best)), second] >= best_scores - CLUSTER_BORDER_MARGIN
+            rows = np.arange(start, start + len(best))
+            for list_id, row in zip(best, rows):
+                partitions[list_id].append(row)
+            for list_id, row in zip(second[border], rows[border]):
+                partitions[list_id].append(row)
+        return [np.array(sorted(p), dtype=np.int64) for p in partitions if p]
+
+    def link_block(self, X, rows_a, rows_b, min_similarity, disjoint, stats):
+        """Score one block and union every linked pair's components"""
+        block = self.comparator.batch_compare_block(X[rows_a], X[rows_b], reject_below=min_similarity)
+        linked = block['similarity'] >= min_similarity
+        early = block['early_rejected']
+        pairs = linked.size
+        if rows_a is rows_b:
+            # Same rows on both sides: upper triangle only, no self pairs
+            upper = np.triu(np.ones(linked.shape, dtype=bool), 1)
+            linked &= upper
+            early = early & upper
+            pairs = len(rows_a) * (len(rows_a) - 1) // 2
+        stats['blocks'] += 1
+        stats['pairs_scored'] += int(pairs)
+        stats['early_rejections'] += int(early.sum())
+
+        for i, j in zip(*np.nonzero(linked)):
+            if disjoint.union(int(rows_a[i]), int(rows_b[j])):
+                stats['links'] += 1
+
+    def group_labels(self, labels):
+        """Row lists per component label, in first-row order"""
+        order = np.argsort(labels, kind='stable')
+        _, starts = np.unique(labels[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        groups.sort(key=lambda members: members[0])
+        return groups
+
+    def describe_cluster(self, X, members, positions, ids, include_centroids):
+        """Size, member ids, centroid and the faces closest to it"""
+        vectors = X[members]
+        centroid = vectors.mean(axis=0)
+        centroid_norm = np.linalg.norm(centroid)
+        norms = np.linalg.norm(vectors, axis=1)
+        cosine = vectors @ centroid / np.where(norms * centroid_norm > 0, norms * centroid_norm, 1.0)
+        closest = np.argsort(-cosine, kind='stable')[:CLUSTER_REPRESENTATIVES]
+
+        cluster = {
+            'size': int(len(members)),
+            'members': [ids[positions[m]] for m in members],
+            'representatives': [ids[positions[members[i]]] for i in closest],
+            'cohesion': float(cosine.mean())
+        }
+        if include_centroids:
+            cluster['centroid'] = centroid.tolist()
+        return cluster
+
+
+class FaceClusterTable:
+    """Persistent person clusters for incremental assignment
+
+    On-disk layout of a cluster directory (g = generation, bumped by rebalance/seed):
+        clusters.json       dim, committed cluster rows, face and rebalance counters
+        table.<g>.bin       CLUSTER_DTYPE row per cluster (id, size, sum of squared norms)
+        sums.<g>.f64        float64 sum of the member vectors per row (centroid = sum / size)
+        members.<g>.jsonl   {"id", "cluster", "similarity"} per assigned face, {"merge", "into"} per merge
+
+    A new face is only compared with cluster centroids, so assigning costs the
+    same whatever the number of faces behind them. Changed rows are rewritten in
+    place and new ones appended before clusters.json commits the row count. One
+    writer at a time is assumed; rebalance runs on a thread of that writer.
+    """
+
+    def __init__(self, path=None, comparator=None):
+        self.path = os.path.abspath(path or DEFAULT_CLUSTERS_PATH)
+        self.comparator = comparator or EmbeddingComparator()
+        self.lock = threading.RLock()
+        self.rebalance_thread = None
+        self.load()
+
+    # ------------------------------------------------------------------ storage
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def generation_file(self, kind, generation=None):
+        extension = {'table': 'bin', 'sums': 'f64', 'members': 'jsonl'}[kind]
+        return self.file(f'{kind}.{self.generation if generation is None else generation}.{extension}')
+
+    def load(self):
+        """(Re)read the committed clusters; missing files mean an empty table"""
+        meta = {}
+        if os.path.exists(self.file('clusters.json')):
+            with open(self.file('clusters.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version', CLUSTER_TABLE_VERSION) != CLUSTER_TABLE_VERSION:
+                raise ValueError(f"Unsupported cluster table version {meta.get('version')}")
+
+        self.generation = int(meta.get('generation', 0))
+        self.dim = meta.get('dim')
+        self.rows = int(meta.get('rows', 0))
+        self.next_cluster_id = int(meta.get('next_cluster_id', 0))
+        self.faces = int(meta.get('faces', 0))
+        self.assigned_since_rebalance = int(meta.get('assigned_since_rebalance', 0))
+        self.rebalances = int(meta.get('rebalances', 0))
+        self.min_similarity = float(meta.get('min_similarity', CLUSTER_MIN_SIMILARITY))
+
+        if self.rows and self.dim:
+            self.table = np.fromfile(self.generation_file('table'), dtype=CLUSTER_DTYPE, count=self.rows)
+            self.sums = np.fromfile(self.generation_file('sums'), dtype=np.float64,
+                                    count=self.rows * self.dim).reshape(self.rows, self.dim)
+        else:
+            self.table = np.zeros(0, dtype=CLUSTER_DTYPE)
+            self.sums = np.zeros((0, self.dim or 0), dtype=np.float64)
+        self.row_of = {int(cluster_id): row for row, cluster_id in enumerate(self.table['cluster_id'])}
+        self.unit = unit_vectors(self.centroids(np.arange(self.rows))).astype(np.float32)
+        self.signature = self.file_signature()
+
+    def file_signature(self):
+        """Identifies the committed state, so cached instances can notice other writers"""
+        try:
+            stat = os.stat(self.file('clusters.json'))
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def write_meta(self, generation=None):
+        """Commit the row count and counters (atomic replace of clusters.json)"""
+        meta = {
+            'version': CLUSTER_TABLE_VERSION,
+            'generation': self.generation if generation is None else generation,
+            'dim': self.dim,
+            'rows': self.rows,
+            'next_cluster_id': self.next_cluster_id,
+            'faces': self.faces,
+            'assigned_since_rebalance': self.assigned_since_rebalance,
+            'rebalances': self.rebalances,
+            'min_similarity': self.min_similarity
+        }
+        os.makedirs(self.path, exist_ok=True)
+        temp_path = self.file('clusters.json.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self.file('clusters.json'))
+        self.signature = self.file_signature()
+
+    def write_generation(self, generation, table, sums, member_lines, keep_members=False):
+        """Write complete table/sums/members files of a generation (not yet committed)
+
+        keep_members starts the new member log from the current one.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        table.tofile(self.generation_file('table', generation))
+        with open(self.generation_file('sums', generation), 'wb') as f:
+            for start in range(0, len(sums), 4096):
+                f.write(np.ascontiguousarray(sums[start:start + 4096], dtype=np.float64).tobytes())
+        if keep_members and os.path.exists(self.generation_file('members')):
+            shutil.copyfile(self.generation_file('members'), self.generation_file('members', generation))
+        with open(self.generation_file('members', generation), 'a' if keep_members else 'w', encoding='utf-8') as f:
+            for line in member_lines:
+                f.write(json.dumps(line) + '\n')
+
+    def switch_generation(self, generation):
+        """Commit a fully written generation and drop the files of the previous one"""
+        old_files = [self.generation_file(kind) for kind in ('table', 'sums', 'members')]
+        self.write_meta(generation)
+        for path in old_files:
+            if os.path.exists(path) and self.generation != generation:
+                os.remove(path)
+        self.load()
+
+    def commit_rows(self, changed_rows, first_new_row, member_lines):
+        """Rewrite changed rows in place, append rows from first_new_row on, then commit"""
+        os.makedirs(self.path, exist_ok=True)
+        changed_rows = np.asarray(sorted(row for row in changed_rows if row < first_new_row), dtype=np.int64)
+        if changed_rows.size:
+            table = np.memmap(self.generation_file('table'), dtype=CLUSTER_DTYPE, mode='r+', shape=(first_new_row,))
+            table[changed_rows] = self.table[changed_rows]
+            table.flush()
+            sums = np.memmap(self.generation_file('sums'), dtype=np.float64, mode='r+', shape=(first_new_row, self.dim))
+            sums[changed_rows] = self.sums[changed_rows]
+            sums.flush()
+            del table, sums
+        for kind, values, row_bytes in (('table', self.table, CLUSTER_DTYPE.itemsize),
+                                        ('sums', self.sums, self.dim * 8)):
+            with open(self.generation_file(kind), 'ab') as f:
+                if f.tell() != first_new_row * row_bytes:
+                    f.truncate(first_new_row * row_bytes)
+                f.write(np.ascontiguousarray(values[first_new_row:]).tobytes())
+        with open(self.generation_file('members'), 'a', encoding='utf-8') as f:
+            for line in member_lines:
+                f.write(json.dumps(line) + '\n')
+        self.write_meta()
+
+    # ------------------------------------------------------------------ clusters
+
+    def centroids(self, rows):
+        counts = self.table['count'][rows].astype(np.float64)
+        return self.sums[rows] / np.where(counts > 0, counts, 1.0)[:, None]
+
+    @property
+    def live(self):
+        return self.table['deleted'] == 0
+
+    @property
+    def cluster_count(self):
+        return int(self.live.sum())
+
+    def describe_row(self, row):
+        """Size, centroid spread (RMS distance of the members) and id of one cluster"""
+        count = int(self.table['count'][row])
+        mean = self.sums[row] / max(count, 1)
+        spread = self.table['norm_sq_sum'][row] / max(count, 1) - float(mean @ mean)
+        return {
+            'cluster_id': int(self.table['cluster_id'][row]),
+            'size': count,
+            'spread': float(np.sqrt(max(spread, 0.0)))
+        }
+
+    def seed(self, embeddings, ids=None, min_similarity=None, min_cluster_size=1):
+        """Replace the table with a fresh cluster_faces run over a gallery
+
+        Every cluster (singletons included) becomes a centroid, so later uploads can
+        join it; only the returned report applies min_cluster_size.
+        """
+        try:
+            result = FaceClusterer(self.comparator).cluster_faces(embeddings, ids, min_similarity=min_similarity)
+            if not result.get('success'):
+                return result
+            if ids is None:
+                ids = embeddings.ids() if hasattr(embeddings, 'ids') else list(range(len(embeddings)))
+            position_of = {(position if row_id is None else row_id): position for position, row_id in enumerate(ids)}
+
+            # One dimension per table: keep the one with the most faces
+            sizes = {}
+            for cluster in result['clusters']:
+                sizes[len(cluster['centroid'])] = sizes.get(len(cluster['centroid']), 0) + cluster['size']
+            dim = max(sizes, key=sizes.get)
+            kept = [cluster for cluster in result['clusters'] if len(cluster['centroid']) == dim]
+
+            with self.lock:
+                table = np.zeros(len(kept), dtype=CLUSTER_DTYPE)
+                sums = np.zeros((len(kept), dim), dtype=np.float64)
+                member_lines = []
+                for row, cluster in enumerate(kept):
+                    vectors = np.stack([np.asarray(embeddings[position_of[member]], dtype=np.float64)
+                                        for member in cluster['members']])
+                    sums[row] = vectors.sum(axis=0)
+                    table[row] = (row, len(vectors), float(np.einsum('ij,ij->', vectors, vectors)), 0)
+                    cluster['cluster_id'] = row
+                    member_lines.extend({'id': member, 'cluster': row} for member in cluster['members'])
+
+                next_generation = self.generation + 1
+                self.write_generation(next_generation, table, sums, member_lines)
+                self.dim, self.rows, self.next_cluster_id = dim, len(kept), len(kept)
+                self.faces = sum(cluster['size'] for cluster in kept)
+                self.assigned_since_rebalance, self.rebalances = 0, 0
+                self.min_similarity = result['min_similarity']
+                self.switch_generation(next_generation)
+
+            for cluster in result['clusters']:
+                cluster.pop('centroid', None)
+            small = [cluster for cluster in result['clusters'] if cluster['size'] < min_cluster_size]
+            for cluster in small:
+                result['unclustered'].extend(cluster['members'])
+            result['clusters'] = [cluster for cluster in result['clusters'] if cluster['size'] >= min_cluster_size]
+            result['cluster_count'] = len(result['clusters'])
+            result['table'] = self.info()
+            if len(sizes) > 1:
+                result['table']['skipped_dimensions'] = {str(length): count for length, count in sizes.items() if length != dim}
+            return result
+
+        except Exception as e:
+            return {'success': False, 'error': f'Cluster seed error: {str(e)}'}
+
+    def assign(self, vectors, ids=None, min_similarity=None, rebalance=True):
+        """Put each face into its best matching cluster, or open a new one
+
+        Faces are handled in order, so several new faces of one person in a batch
+        end up together. Cost per face is one cosine pass over the centroids plus
+        exact comparator scores for the ASSIGN_CANDIDATES closest ones.
+        """
+        try:
+            rows = [np.asarray(vector, dtype=np.float64).ravel() for vector in vectors]
+            if not rows:
+                return {'success': False, 'error': 'No embeddings to assign'}
+            dim = self.dim or rows[0].size
+            bad = [i for i, row in enumerate(rows) if row.size != dim or not np.all(np.isfinite(row))]
+            if bad:
+                return {'success': False, 'error': f'Embeddings must be finite with {dim} dimensions (bad rows: {bad[:10]})'}
+            ids = list(ids) if ids is not None else [None] * len(rows)
+            threshold = self.min_similarity if min_similarity is None else float(min_similarity)
+
+            with self.lock:
+                try:
+                    assignments = self.assign_rows(rows, ids, dim, threshold)
+                except Exception:
+                    # Drop the half-applied in-memory updates
+                    self.load()
+                    raise
+            rebalance_state = self.start_rebalance() if rebalance and self.rebalance_due() else 'not_due'
+
+            return {
+                'success': True,
+                'assignments': assignments,
+                'new_clusters': sum(1 for assignment in assignments if assignment['new_cluster']),
+                'cluster_count': self.cluster_count,
+                'face_count': self.faces,
+                'rebalance': rebalance_state
+            }
+
+        except Exception as e:
+            return {'success': False, 'error': f'Cluster assign error: {str(e)}'}
+
+    def assign_rows(self, rows, ids, dim, threshold):
+        """assign() under the lock: update the in-memory table, then commit it"""
+        first_new_row = self.rows
+        self.dim = dim
+        if self.sums.shape[1] != dim:
+            self.sums = np.zeros((0, dim), dtype=np.float64)
+            self.unit = np.zeros((0, dim), dtype=np.float32)
+        new_table, new_sums, new_unit = [], [], []
+        changed, assignments, member_lines = set(), [], []
+
+        for row_id, vector in zip(ids, rows):
+            norm_sq = float(vector @ vector)
+            unit = (vector / np.sqrt(norm_sq) if norm_sq > 0 else vector).astype(np.float32)
+            row, similarity = self.best_cluster(vector, unit, threshold, new_table, new_sums, new_unit)
+            new_cluster = row is None
+            if new_cluster:
+                row = first_new_row + len(new_table)
+                new_table.append(np.array([(self.next_cluster_id, 0, 0.0, 0)], dtype=CLUSTER_DTYPE))
+                new_sums.append(np.zeros(dim, dtype=np.float64))
+                new_unit.append(unit)
+                self.next_cluster_id += 1
+
+            if row < first_new_row:
+                record, sums = self.table[row:row + 1], self.sums[row]
+                changed.add(row)
+            else:
+                record, sums = new_table[row - first_new_row], new_sums[row - first_new_row]
+            sums += vector
+            record['count'] += 1
+            record['norm_sq_sum'] += norm_sq
+            centroid_unit = unit_vectors(sums[None, :]).astype(np.float32)[0]
+            if row < first_new_row:
+                self.unit[row] = centroid_unit
+            else:
+                new_unit[row - first_new_row] = centroid_unit
+
+            assignments.append((row_id, row, similarity, new_cluster))
+            member_lines.append({'id': row_id, 'cluster': int(record['cluster_id'][0]),
+                                 'similarity': round(float(similarity), 6)})
+
+        if new_table:
+            self.table = np.concatenate([self.table, np.concatenate(new_table)])
+            self.sums = np.vstack([self.sums, np.vstack(new_sums)])
+            self.unit = np.vstack([self.unit, np.vstack(new_unit)])
+            for offset, record in enumerate(new_table):
+                self.row_of[int(record['cluster_id'][0])] = first_new_row + offset
+        self.rows = len(self.table)
+        self.faces += len(rows)
+        self.assigned_since_rebalance += len(rows)
+        self.commit_rows(changed, first_new_row, member_lines)
+
+        results = []
+        for row_id, row, similarity, new_cluster in assignments:
+            result = {'id': row_id, 'similarity': float(similarity), 'new_cluster': new_cluster}
+            result.update(self.describe_row(row))
+            results.append(result)
+        return results
+
+    def best_cluster(self, vector, unit, threshold, new_table, new_sums, new_unit):
+        """(row, similarity) of the best cluster scoring at least threshold, else (None, best score)"""
+        candidates = np.zeros(0, dtype=np.int64)
+        if self.rows:
+            scores = self.unit @ unit
+            scores[~self.live] = -np.inf
+            count = min(ASSIGN_CANDIDATES, scores.size)
+            candidates = np.argpartition(-scores, count - 1)[:count]
+            candidates = candidates[np.isfinite(scores[candidates])]
+        # Clusters opened earlier in this batch are few, always check them all
+        if new_table:
+            candidates = np.concatenate([candidates, self.rows + np.arange(len(new_table))])
+        if candidates.size == 0:
+            return None, 0.0
+
+        means = np.empty((candidates.size, vector.size), dtype=np.float64)
+        for i, row in enumerate(candidates):
+            if row < self.rows:
+                means[i] = self.sums[row] / max(int(self.table['count'][row]), 1)
+            else:
+                offset = row - self.rows
+                means[i] = new_sums[offset] / max(int(new_table[offset]['count'][0]), 1)
+        similarity = self.comparator.batch_compare_block(vector[None, :], means, reject_below=threshold)['similarity'][0]
+        best = int(np.argmax(similarity))
+        if similarity[best] < threshold:
+            return None, float(similarity[best])
+        return int(candidates[best]), float(similarity[best])
+
+    # ------------------------------------------------------------------ rebalance
+
+    def rebalance_due(self):
+        return self.assigned_since_rebalance >= max(CLUSTER_REBALANCE_MIN_ASSIGNED,
+                                                    CLUSTER_REBALANCE_FRACTION * self.faces)
+
+    def start_rebalance(self):
+        """Run rebalance on a background thread unless one is running already
+
+        The thread is not a daemon: a CLI call prints its result first and the
+        process exits once the rebalance committed.
+        """
+        if self.rebalance_thread is not None and self.rebalance_thread.is_alive():
+            return 'running'
+        self.rebalance_thread = threading.Thread(target=self.rebalance, name='cluster-rebalance')
+        self.rebalance_thread.start()
+        return 'started'
+
+    def rebalance(self, min_similarity=None):
+        """Merge clusters whose centroids drifted together and compact the table
+
+        Centroids are clustered like faces (cluster_faces on the centroid matrix),
+        each linked group folds into its largest member. The scoring runs outside
+        the lock, so assignments continue meanwhile.
+        """
+        try:
+            threshold = self.min_similarity if min_similarity is None else float(min_similarity)
+            with self.lock:
+                live_rows = np.flatnonzero(self.live)
+                cluster_ids = self.table['cluster_id'][live_rows].tolist()
+                centroids = self.centroids(live_rows)
+            if not cluster_ids:
+                return {'success': True, 'merged': 0, 'cluster_count': 0}
+
+            grouped = FaceClusterer(self.comparator).cluster_faces(centroids, cluster_ids, min_similarity=threshold,
+                                                                   min_cluster_size=2, include_centroids=False)
+            if not grouped.get('success'):
+                return grouped
+
+            with self.lock:
+                merges = []
+                for group in grouped['clusters']:
+                    rows = [self.row_of[cluster_id] for cluster_id in group['members']]
+                    target = max(rows, key=lambda row: (self.table['count'][row], -row))
+                    for row in rows:
+                        if row == target:
+                            continue
+                        self.sums[target] += self.sums[row]
+                        self.table['count'][target] += self.table['count'][row]
+                        self.table['norm_sq_sum'][target] += self.table['norm_sq_sum'][row]
+                        self.table['deleted'][row] = 1
+                        merges.append({'merge': int(self.table['cluster_id'][row]),
+                                       'into': int(self.table['cluster_id'][target])})
+
+                keep = np.flatnonzero(self.live)
+                next_generation = self.generation + 1
+                self.write_generation(next_generation, self.table[keep], self.sums[keep], merges, keep_members=True)
+                self.rows = int(keep.size)
+                self.assigned_since_rebalance = 0
+                self.rebalances += 1
+                self.switch_generation(next_generation)
+
+            print(f"Rebalanced clusters: {len(merges)} merged, {self.cluster_count} left", file=sys.stderr)
+            return {'success': True, 'merged': len(merges), 'merges': merges, 'cluster_count': self.cluster_count}
+
+        except Exception as e:
+            return {'success': False, 'error': f'Cluster rebalance error: {str(e)}'}
+
+    def info(self):
+        live_rows = np.flatnonzero(self.live)
+        sizes = self.table['count'][live_rows]
+        return {
+            'success': True,
+            'path': self.path,
+            'dim': self.dim,
+            'cluster_count': int(live_rows.size),
+            'face_count': self.faces,
+            'largest_cluster': int(sizes.max()) if sizes.size else 0,
+            'singletons': int((sizes == 1).sum()),
+            'assigned_since_rebalance': self.assigned_since_rebalance,
+            'rebalance_due': self.rebalance_due(),
+            'rebalances': self.rebalances,
+            'min_similarity': self.min_similarity
+        }
+
+
+# Open cluster tables by path, so serve mode keeps the centroids in memory
+_open_tables = {}
+
+def open_clusters(path=None, comparator=None):
+    """Cached FaceClusterTable for a path, reloaded when another writer committed"""
+    key = os.path.abspath(path or DEFAULT_CLUSTERS_PATH)
+    table = _open_tables.get(key)
+    if table is None:
+        table = FaceClusterTable(key, comparator)
+        _open_tables[key] = table
+    elif table.signature != table.file_signature():
+        with table.lock:
+            table.load()
+    return table
@@ -0,0 +1,1318 @@
+"""Embedding comparison math for the face processor.
+
+Only depends on NumPy so that comparison actions can run without importing
+OpenCV or loading any cascade model.
+"""
+import sys
+import json
+
+try:
+    import numpy as np
+    from numpy import dot, linalg
+except ImportError:
+    print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
+    sys.exit(1)
+
+
+# Metrics of compare_faces_advanced and their ensemble weights, in accumulation order
+BATCH_METRICS = {
+    'cosine': 0.35,
+    'pearson': 0.2,
+    'euclidean': 0.2,
+    'manhattan': 0.1,
+    'chi_square': 0.1,
+    'structural': 0.05,
+}
+
+
+# Gallery rows scored per batch_compare_block call, bounds the float64 working set
+GALLERY_BLOCK_ROWS = 4096
+
+# Above this fraction of needed pairs, element-wise distances use dense blocks
+DENSE_DISTANCE_FRACTION = 0.5
+
+# cross_validate_similarity splits embeddings into this many segments
+CROSS_VALIDATION_SEGMENTS = 5
+
+# Final similarity below SIMILARITY_GATE + threshold_adjustment is zeroed
+SIMILARITY_GATE = 0.42
+
+# Slack on the batch upper bound, whose euclidean term comes from the dot-product
+# identity rather than the exact element-wise distance
+EARLY_REJECT_MARGIN = 1e-9
+
+
+class EmbeddingComparator:
+    """Multi-metric embedding comparison with cross-validation and adaptive adjustments"""
+    
+    def compare_faces_advanced(self, embedding1: list, embedding2: list, stats1=None, stats2=None,
+                               early_reject=True) -> dict:
+        """Advanced face comparison using multiple similarity metrics with cross-validation
+        
+        stats1/stats2 are optional compute_embedding_stats results; they are used
+        when they describe the compared length and recomputed otherwise.
+        With early_reject, pairs that cannot pass the quality gate even with every
+        outlier-masked metric at 1.0 are rejected before the expensive metrics.
+        """
+        try:
+            if not embedding1 or not embedding2:
+                return {
+                    'success': False,
+                    'error': 'Invalid embeddings provided',
+                    'similarity': 0.0,
+                    'distance': 1.0,
+                    'confidence': 0.0
+                }
+            
+            # Ensure embeddings have same length
+            min_len = min(len(embedding1), len(embedding2))
+            emb1 = np.array(embedding1[:min_len])
+            emb2 = np.array(embedding2[:min_len])
+            
+            # Reuse precomputed per-embedding statistics (e.g. a stored gallery side);
+            # without any, each metric computes what it needs as before
+            if stats1 is not None or stats2 is not None:
+                stats1 = self.resolve_embedding_stats(emb1, stats1)
+                stats2 = self.resolve_embedding_stats(emb2, stats2)
+            
+            # ADAPTIVE thresholds based on embedding characteristics
+            adaptive_adjustments = self.calculate_adaptive_adjustments(emb1, emb2, stats1, stats2)
+            quality_threshold = SIMILARITY_GATE + adaptive_adjustments['threshold_adjustment']  # Increased from 0.3
+            
+            # CHEAP-FIRST: euclidean and structural are exact and cheap; the other
+            # metrics are bounded by 1.0, so the bound below is never exceeded
+            euclidean_sim = self.adaptive_euclidean_similarity(emb1, emb2, stats1, stats2)
+            structural_sim = self.structural_similarity(emb1, emb2, stats1, stats2)
+            if early_reject:
+                similarity_bound = self.similarity_upper_bound(euclidean_sim, structural_sim)
+                if similarity_bound * adaptive_adjustments['similarity_boost'] < quality_threshold:
+                    print(f"Early reject: similarity bound {similarity_bound:.3f} below gate {quality_threshold:.3f}", file=sys.stderr)
+                    return {
+                        'success': True,
+                        'similarity': 0.0,
+                        'distance': 1.0,
+                        'confidence': 0.0,
+                        'early_exit': True,
+                        'similarity_bound': float(similarity_bound),
+                        'adaptive_adjustments': adaptive_adjustments
+                    }
+            
+            # CROSS-VALIDATION: Split embeddings and test consistency with stricter checks
+            cross_validation_result = self.cross_validate_similarity(emb1, emb2, stats1, stats2)
+            
+            if not cross_validation_result['is_consistent']:
+                print(f"Cross-validation FAILED: {cross_validation_result['reason']}", file=sys.stderr)
+                return {
+                    'success': True,
+                    'similarity': 0.0,
+                    'distance': 1.0,
+                    'confidence': 0.0,
+                    'cross_validation': cross_validation_result
+                }
+            
+            # Enhanced similarity metrics with robust computation
+            similarities = []
+            
+            # 1. Cosine similarity with multiple normalizations
+            cosine_sim = self.robust_cosine_similarity(emb1, emb2, stats1, stats2)
+            similarities.append(('cosine', cosine_sim, 0.35))  
+            
+            # 2. Pearson correlation with outlier handling
+            pearson_sim = self.robust_pearson_correlation(emb1, emb2, stats1, stats2)
+            similarities.append(('pearson', pearson_sim, 0.2))
+            
+            # 3. Euclidean similarity with adaptive scaling
+            similarities.append(('euclidean', euclidean_sim, 0.2))
+            
+            # 4. Manhattan similarity with outlier rejection
+            manhattan_sim = self.robust_manhattan_similarity(emb1, emb2, stats1, stats2)
+            similarities.append(('manhattan', manhattan_sim, 0.1))
+            
+            # 5. Chi-square similarity for histogram features
+            chi_square_sim = self.robust_chi_square_similarity(emb1, emb2, stats1, stats2)
+            similarities.append(('chi_square', chi_square_sim, 0.1))
+            
+            # 6. Structural similarity (inspired by SSIM)
+            similarities.append(('structural', structural_sim, 0.05))
+            
+            # ADAPTIVE weighted ensemble based on feature quality
+            total_weight = sum(weight for _, _, weight in similarities)
+            weighted_similarity = sum(sim * weight for _, sim, weight in similarities) / total_weight
+            
+            # ENHANCED confidence calculation with outlier detection
+            confidence = self.calculate_enhanced_confidence(similarities, cross_validation_result)
+            
+            # Apply adaptive adjustments
+            final_similarity = weighted_similarity * adaptive_adjustments['similarity_boost']
+            final_confidence = confidence * adaptive_adjustments['confidence_boost']
+            
+            # STRICTER quality gates with higher adaptive thresholds
+            if final_similarity < quality_threshold:
+                final_similarity = 0.0
+                final_confidence = 0.0
+            
+            distance = 1.0 - final_similarity
+            
+            print(f"Advanced similarity metrics: {[(name, sim) for name, sim, _ in similarities]}", file=sys.stderr)
+            print(f"Weighted: {weighted_similarity:.3f}, Confidence: {confidence:.3f}, Final: {final_similarity:.3f}", file=sys.stderr)
+            print(f"Adaptive adjustments: {adaptive_adjustments}", file=sys.stderr)
+            
+            return {
+                'success': True,
+                'similarity': float(max(0.0, min(1.0, final_similarity))),
+                'distance': float(distance),
+                'confidence': float(max(0.0, min(1.0, final_confidence))),
+                'detailed_similarities': {name: float(sim) for name, sim, _ in similarities},
+                'cross_validation': cross_validation_result,
+                'adaptive_adjustments': adaptive_adjustments
+            }
+            
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f"Advanced comparison error: {str(e)}",
+                'similarity': 0.0,
+                'distance': 1.0,
+                'confidence': 0.0
+            }
+    
+    def similarity_upper_bound(self, euclidean_sim, structural_sim):
+        """Weighted ensemble with every metric except euclidean/structural at 1.0"""
+        upper = {name: 1.0 for name in BATCH_METRICS}
+        upper['euclidean'] = euclidean_sim
+        upper['structural'] = structural_sim
+        total_weight = sum(BATCH_METRICS.values())
+        return sum(upper[name] * weight for name, weight in BATCH_METRICS.items()) / total_weight
+
+    def cross_validate_similarity(self, emb1, emb2, stats1=None, stats2=None):
+        """Cross-validation to test consistency of similarity with stricter validation"""
+        try:
+            # Split embeddings into multiple segments to test consistency
+            segments = CROSS_VALIDATION_SEGMENTS  # Increased from 4 to 5 for more robust validation
+            segment_size = len(emb1) // segments
+            
+            if segment_size < 10:  # Too small to split reliably
+                return {
+                    'is_consistent': True,
+                    'reason': 'Embeddings too small for cross-validation',
+                    'variance': 0.0,
+                    'segment_similarities': []
+                }
+            
+            segment_similarities = []
+            
+            for i in range(segments):
+                start_idx = i * segment_size
+                end_idx = (i + 1) * segment_size if i < segments - 1 else len(emb1)
+                
+                seg1 = emb1[start_idx:end_idx]
+                seg2 = emb2[start_idx:end_idx]
+                
+                # Calculate simple cosine similarity for each segment
+                seg_stats1 = stats1['segments'][i] if stats1 else None
+                seg_stats2 = stats2['segments'][i] if stats2 else None
+                seg_sim = self.cosine_similarity(seg1, seg2, seg_stats1, seg_stats2)
+                segment_similarities.append(seg_sim)
+            
+            # Check consistency across segments
+            mean_sim = np.mean(segment_similarities)
+            std_sim = np.std(segment_similarities)
+            variance = std_sim / (mean_sim + 1e-7)  # Coefficient of variation
+            
+            # Additional validation: check if any segment has dramatically different similarity
+            min_sim = min(segment_similarities)
+            max_sim = max(segment_similarities)
+            range_sim = max_sim - min_sim
+            
+            # Stricter consistency criteria
+            is_consistent = True
+            reason = "Consistent across segments"
+            
+            # STRICTER consistency checks
+            if variance > 0.6:  # Reduced from 0.8 - Lower variance threshold for inconsistency
+                is_consistent = False
+                reason = f"High variance across segments: {variance:.3f}"
+            elif std_sim > 0.25:  # Reduced from 0.3 - Lower standard deviation threshold
+                is_consistent = False
+                reason = f"High standard deviation: {std_sim:.3f}"
+            elif range_sim > 0.4:  # Reduced from 0.5 - Lower acceptable range
+                is_consistent = False
+                reason = f"Large similarity range: {range_sim:.3f}"
+            elif mean_sim < 0.3:  # New check - Reject overall low similarity
+                is_consistent = False
+                reason = f"Overall low mean similarity: {mean_sim:.3f}"
+            
+            # Check if minimum similarity is too low compared to mean
+            if is_consistent and min_sim < mean_sim * 0.7:  # New check - Ensure no segment is dramatically worse
+                is_consistent = False
+                reason = f"Outlier segment with low similarity: {min_sim:.3f} vs mean {mean_sim:.3f}"
+            
+            return {
+                'is_consistent': is_consistent,
+                'reason': reason,
+                'variance': float(variance),
+                'segment_similarities': [float(s) for s in segment_similarities],
+                'mean_similarity': float(mean_sim),
+                'std_similarity': float(std_sim)
+            }
+            
+        except Exception as e:
+            return {
+                'is_consistent': False,
+                'reason': f"Cross-validation error: {str(e)}",
+                'variance': 1.0,
+                'segment_similarities': []
+            }
+    
+    def robust_cosine_similarity(self, a, b, stats_a=None, stats_b=None):
+        """Robust cosine similarity với outlier handling"""
+        try:
+            # Remove outliers before calculation
+            a_clean, b_clean = self.remove_embedding_outliers(a, b, 3, stats_a, stats_b)
+            
+            dot_product = dot(a_clean, b_clean)
+            norm_a = linalg.norm(a_clean)
+            norm_b = linalg.norm(b_clean)
+            
+            if norm_a == 0 or norm_b == 0:
+                return 0.0
+            
+            similarity = dot_product / (norm_a * norm_b)
+            
+            # Enhanced normalization với smoother transition
+            normalized_sim = (similarity + 1) / 2
+            
+            # Apply sigmoid-like smoothing để reduce extreme values
+            smoothed_sim = 1 / (1 + np.exp(-10 * (normalized_sim - 0.5)))
+            
+            return max(0.0, min(1.0, smoothed_sim))
+        except:
+            return 0.0
+    
+    def remove_embedding_outliers(self, a, b, threshold=3, stats_a=None, stats_b=None):
+        """Remove outliers từ embeddings using z-score
+        
+        stats_a/stats_b ({'std', 'outliers'} for exactly these vectors and this
+        threshold) skip the z-score computation.
+        """
+        try:
+            if stats_a is not None and stats_b is not None:
+                if stats_a['std'] == 0 or stats_b['std'] == 0:
+                    return a, b
+                mask = np.ones(len(a), dtype=bool)
+                mask[stats_a['outliers']] = False
+                mask[stats_b['outliers']] = False
+            else:
+                # Calculate z-scores
+                a_mean, a_std = np.mean(a), np.std(a)
+                b_mean, b_std = np.mean(b), np.std(b)
+                
+                if a_std == 0 or b_std == 0:
+                    return a, b
+                
+                a_z_scores = np.abs((a - a_mean) / a_std)
+                b_z_scores = np.abs((b - b_mean) / b_std)
+                
+                # Keep only values within threshold standard deviations
+                mask = (a_z_scores < threshold) & (b_z_scores < threshold)
+            
+            if np.sum(mask) < len(a) * 0.5:  # Too many outliers, keep original
+                return a, b
+            
+            return a[mask], b[mask]
+        except:
+            return a, b
+    
+    def robust_pearson_correlation(self, a, b, stats_a=None, stats_b=None):
+        """Robust Pearson correlation với outlier handling"""
+        try:
+            if len(a) < 3 or len(b) < 3:
+                return 0.0
+            
+            # Remove outliers
+            a_clean, b_clean = self.remove_embedding_outliers(a, b, 3, stats_a, stats_b)
+            
+            if len(a_clean) < 3:
+                return 0.0
+            
+            correlation = np.corrcoef(a_clean, b_clean)[0, 1]
+            if np.isnan(correlation):
+                return 0.0
+            
+            # Robust normalization
+            normalized = (correlation + 1) / 2
+            return max(0.0, min(1.0, normalized))
+        except:
+            return 0.0
+    
+    def adaptive_euclidean_similarity(self, a, b, stats_a=None, stats_b=None):
+        """Adaptive Euclidean similarity với scaling"""
+        try:
+            var_a, var_b = (stats_a['var'], stats_b['var']) if stats_a and stats_b else (np.var(a), np.var(b))
+            
+            # Adaptive scaling dựa trên embedding characteristics
+            feature_variance = (var_a + var_b) / 2
+            scale_factor = 1.0 / (1.0 + feature_variance * 0.1)
+            
+            distance = np.sqrt(np.sum((a - b) ** 2))
+            
+            # Adaptive max distance calculation
+            norm_a, norm_b = (stats_a['norm'], stats_b['norm']) if stats_a and stats_b else (np.linalg.norm(a), np.linalg.norm(b))
+            max_distance = norm_a + norm_b
+            
+            if max_distance == 0:
+                return 1.0
+            
+            # Apply adaptive scaling
+            scaled_distance = distance * scale_factor
+            scaled_max = max_distance * scale_factor
+            
+            similarity = 1.0 - (scaled_distance / scaled_max)
+            return max(0.0, min(1.0, similarity))
+        except:
+            return 0.0
+    
+    def robust_manhattan_similarity(self, a, b, stats_a=None, stats_b=None):
+        """Robust Manhattan similarity với outlier rejection"""
+        try:
+            # Remove outliers
+            a_clean, b_clean = self.remove_embedding_outliers(a, b, 3, stats_a, stats_b)
+            
+            distance = np.sum(np.abs(a_clean - b_clean))
+            max_distance = np.sum(np.abs(a_clean)) + np.sum(np.abs(b_clean))
+            
+            if max_distance == 0:
+                return 1.0
+            
+            similarity = 1.0 - (distance / max_distance)
+            return max(0.0, min(1.0, similarity))
+        except:
+            return 0.0
+    
+    def robust_chi_square_similarity(self, a, b, stats_a=None, stats_b=None):
+        """Robust Chi-square similarity with better handling"""
+        try:
+            # Ensure positive values for chi-square
+            epsilon = 1e-10
+            a_pos = np.maximum(np.abs(a), epsilon)
+            b_pos = np.maximum(np.abs(b), epsilon)
+            
+            # Remove extreme outliers before chi-square calculation
+            if stats_a and stats_b:
+                abs_stats_a = {'std': stats_a['abs_std'], 'outliers': stats_a['abs_outliers']}
+                abs_stats_b = {'std': stats_b['abs_std'], 'outliers': stats_b['abs_outliers']}
+            else:
+                abs_stats_a = abs_stats_b = None
+            a_clean, b_clean = self.remove_embedding_outliers(a_pos, b_pos, 2, abs_stats_a, abs_stats_b)
+            
+            chi_square = np.sum(((a_clean - b_clean) ** 2) / (a_clean + b_clean))
+            
+            # Adaptive normalization
+            similarity = 1.0 / (1.0 + chi_square / (len(a_clean) * 0.5))
+            return max(0.0, min(1.0, similarity))
+        except:
+            return 0.0
+    
+    def structural_similarity(self, a, b, stats_a=None, stats_b=None):
+        """Structural similarity inspired by SSIM"""
+        try:
+            # Constants for stability
+            C1, C2, C3 = 1e-4, 1e-4, 1e-4
+            
+            if stats_a and stats_b:
+                mu_a, mu_b = stats_a['mean'], stats_b['mean']
+                var_a, var_b = stats_a['var'], stats_b['var']
+            else:
+                # Mean values
+                mu_a, mu_b = np.mean(a), np.mean(b)
+                
+                # Variances
+                var_a, var_b = np.var(a), np.var(b)
+            
+            # Covariance
+            cov_ab = np.mean((a - mu_a) * (b - mu_b))
+            
+            # SSIM-like formula adapted for 1D embeddings
+            luminance = (2 * mu_a * mu_b + C1) / (mu_a**2 + mu_b**2 + C1)
+            contrast = (2 * np.sqrt(var_a * var_b) + C2) / (var_a + var_b + C2)
+            structure = (cov_ab + C3) / (np.sqrt(var_a * var_b) + C3)
+            
+            ssim = luminance * contrast * structure
+            
+            # Normalize to [0, 1]
+            normalized_ssim = (ssim + 1) / 2
+            return max(0.0, min(1.0, normalized_ssim))
+        except:
+            return 0.0
+    
+    def calculate_enhanced_confidence(self, similarities, cross_validation_result):
+        """Enhanced confidence calculation với multiple factors"""
+        try:
+            sim_values = [sim for _, sim, _ in similarities]
+            
+            if len(sim_values) < 2:
+                return 0.5
+            
+            # Base confidence từ similarity agreement
+            mean_sim = np.mean(sim_values)
+            std_sim = np.std(sim_values)
+            base_confidence = max(0.1, min(1.0, 1.0 - (std_sim * 1.5)))
+            
+            # Cross-validation confidence boost/penalty
+            cv_confidence = 1.0
+            if cross_validation_result['is_consistent']:
+                cv_confidence = 1.2  # Boost for consistency
+            else:
+                cv_confidence = 0.3  # Strong penalty for inconsistency
+            
+            # Agreement confidence (how many metrics agree)
+            high_sim_count = sum(1 for sim in sim_values if sim > 0.6)
+            agreement_confidence = 0.5 + (high_sim_count / len(sim_values)) * 0.5
+            
+            # Combined confidence
+            final_confidence = base_confidence * cv_confidence * agreement_confidence
+            
+            # Quality boost for high average similarity
+            if mean_sim > 0.75:
+                final_confidence *= 1.3
+            elif mean_sim > 0.6:
+                final_confidence *= 1.1
+            elif mean_sim < 0.3:
+                final_confidence *= 0.5
+            
+            return min(1.0, final_confidence)
+        except:
+            return 0.3
+    
+    def calculate_adaptive_adjustments(self, emb1, emb2, stats1=None, stats2=None):
+        """Calculate adaptive adjustments based on embedding characteristics with enhanced differentiation"""
+        try:
+            # Feature quality analysis
+            var1, var2 = (stats1['var'], stats2['var']) if stats1 and stats2 else (np.var(emb1), np.var(emb2))
+            mean_var = (var1 + var2) / 2
+            
+            # Check for variance difference - different people often have different variance patterns
+            var_ratio = min(var1, var2) / (max(var1, var2) + 1e-7)
+            
+            # Embedding magnitude analysis
+            norm1, norm2 = (stats1['norm'], stats2['norm']) if stats1 and stats2 else (np.linalg.norm(emb1), np.linalg.norm(emb2))
+            norm_ratio = min(norm1, norm2) / (max(norm1, norm2) + 1e-7)
+            
+            # Feature distribution analysis
+            if stats1 and stats2:
+                skew1, skew2 = stats1['skewness'], stats2['skewness']
+            else:
+                skew1 = self.calculate_skewness(emb1)
+                skew2 = self.calculate_skewness(emb2)
+            skew_diff = abs(skew1 - skew2)
+            
+            # Feature correlation analysis (new)
+            corr_coef = np.corrcoef(emb1, emb2)[0, 1] if len(emb1) == len(emb2) else 0
+            
+            # Check for consistent differences (new)
+            # Different people often have consistent sign differences across embedding dimensions
+            sign_diff = np.mean(np.sign(emb1) != np.sign(emb2))
+            
+            # Calculate adjustments
+            similarity_boost = 1.0
+            confidence_boost = 1.0
+            threshold_adjustment = 0.0
+            
+            # High variance features might be more distinctive
+            if mean_var > 0.5:
+                similarity_boost *= 1.05  # Reduced boost from 1.1
+                confidence_boost *= 1.05  # Reduced boost from 1.1
+            elif mean_var < 0.1:
+                similarity_boost *= 0.85  # More aggressive penalty (was 0.9)
+            
+            # Variance ratio analysis - different people often have different variance patterns
+            if var_ratio < 0.7:  # Significant variance difference
+                similarity_boost *= 0.9
+                threshold_adjustment += 0.05
+            
+            # Similar norms indicate comparable feature quality
+            if norm_ratio > 0.9:  # Increased from 0.8 - stricter requirement for high similarity
+                confidence_boost *= 1.1  # Reduced from 1.2
+                threshold_adjustment -= 0.03  # Reduced adjustment from -0.05
+            elif norm_ratio < 0.7:  # Increased from 0.5 - more sensitive to norm differences
+                confidence_boost *= 0.6  # More aggressive penalty (was 0.7)
+                threshold_adjustment += 0.1  # Higher threshold for mismatched quality
+            
+            # Similar distributions indicate good alignment
+            if skew_diff < 0.3:  # Reduced from 0.5 - stricter requirement
+                similarity_boost *= 1.1
+            elif skew_diff > 1.0:  # Reduced from 1.5 - more sensitive to distribution differences
+                similarity_boost *= 0.75  # More aggressive penalty (was 0.8)
+                threshold_adjustment += 0.05  # New: increase threshold for different distributions
+            
+            # Correlation coefficient analysis (new)
+            if corr_coef > 0.8:
+                similarity_boost *= 1.1
+                threshold_adjustment -= 0.05
+            elif corr_coef < 0.4:
+                similarity_boost *= 0.8
+                threshold_adjustment += 0.1
+            
+            # Sign difference analysis (new)
+            if sign_diff > 0.4:  # More than 40% of dimensions have different signs
+                similarity_boost *= 0.85
+                threshold_adjustment += 0.1
+            
+            # Apply limits to avoid extreme adjustments
+            similarity_boost = max(0.6, min(1.3, similarity_boost))
+            confidence_boost = max(0.4, min(1.5, confidence_boost))
+            threshold_adjustment = max(-0.15, min(0.25, threshold_adjustment))
+            
+            return {
+                'similarity_boost': float(similarity_boost),
+                'confidence_boost': float(confidence_boost),
+                'threshold_adjustment': float(threshold_adjustment),
+                'feature_variance': float(mean_var),
+                'variance_ratio': float(var_ratio),
+                'norm_ratio': float(norm_ratio),
+                'skew_difference': float(skew_diff),
+                'correlation': float(corr_coef),
+                'sign_difference': float(sign_diff)
+            }
+            
+        except Exception as e:
+            print(f"Adaptive adjustment error: {e}", file=sys.stderr)
+            return {
+                'similarity_boost': 1.0,
+                'confidence_boost': 1.0,
+                'threshold_adjustment': 0.0,
+                'feature_variance': 0.0,
+                'variance_ratio': 1.0,
+                'norm_ratio': 1.0,
+                'skew_difference': 0.0,
+                'correlation': 0.0,
+                'sign_difference': 0.0
+            }
+    
+    def calculate_skewness(self, data):
+        """Calculate skewness of data distribution"""
+        try:
+            mean_val = np.mean(data)
+            std_val = np.std(data)
+            
+            if std_val == 0:
+                return 0.0
+            
+            skewness = np.mean(((data - mean_val) / std_val) ** 3)
+            return skewness
+        except:
+            return 0.0
+
+    # --- Fix: provide simple alias for compatibility ---
+    def cosine_similarity(self, a, b, stats_a=None, stats_b=None):
+        """Alias wrapper to maintain compatibility with older code paths."""
+        return self.robust_cosine_similarity(a, b, stats_a, stats_b)
+    
+    # --- Per-embedding statistics, computed once and reused by every comparison ---
+    
+    def compute_embedding_stats(self, embedding) -> dict:
+        """Statistics the metrics need from one embedding, JSON serialisable
+        
+        Covers mean/std/var/norm/skewness, z-score outliers (threshold 3), the
+        magnitude outliers used by chi-square (threshold 2) and the same per
+        cross-validation segment. Values are computed exactly as the metrics do.
+        """
+        v = np.asarray(embedding, dtype=np.float64)
+        mean, std = np.mean(v), np.std(v)
+        v_abs = np.maximum(np.abs(v), 1e-10)
+        abs_mean, abs_std = np.mean(v_abs), np.std(v_abs)
+        
+        stats = {
+            'length': int(len(v)),
+            'mean': float(mean),
+            'std': float(std),
+            'var': float(np.var(v)),
+            'norm': float(np.linalg.norm(v)),
+            'skewness': float(self.calculate_skewness(v)),
+            'outliers': self.outlier_indices(v, mean, std, 3),
+            'abs_std': float(abs_std),
+            'abs_outliers': self.outlier_indices(v_abs, abs_mean, abs_std, 2),
+            'segments': []
+        }
+        
+        # Same split as cross_validate_similarity
+        segment_size = len(v) // CROSS_VALIDATION_SEGMENTS
+        if segment_size >= 10:
+            for i in range(CROSS_VALIDATION_SEGMENTS):
+                start_idx = i * segment_size
+                end_idx = (i + 1) * segment_size if i < CROSS_VALIDATION_SEGMENTS - 1 else len(v)
+                segment = v[start_idx:end_idx]
+                seg_mean, seg_std = np.mean(segment), np.std(segment)
+                stats['segments'].append({
+                    'std': float(seg_std),
+                    'outliers': self.outlier_indices(segment, seg_mean, seg_std, 3)
+                })
+        
+        return stats
+    
+    def outlier_indices(self, v, mean, std, threshold):
+        """Indices remove_embedding_outliers would drop from v (none when std is 0)"""
+        if std == 0:
+            return []
+        return np.flatnonzero(~(np.abs((v - mean) / std) < threshold)).tolist()
+    
+    def resolve_embedding_stats(self, vector, stats=None):
+        """Use stats when they describe this vector's length, otherwise compute them"""
+        if stats and stats.get('length') == len(vector):
+            return stats
+        return self.compute_embedding_stats(vector)
+
+    # --- Batched comparison: every query against every gallery embedding ---
+    
+    def similarity_matrix(self, queries, gallery, detailed=False, query_stats=None, gallery_stats=None,
+                          early_reject=True) -> dict:
+        """Score all query x gallery pairs at once (same numbers as compare_faces_advanced per pair)
+        
+        query_stats/gallery_stats optionally align compute_embedding_stats results
+        (or None) with the rows. early_reject skips the full ensemble for pairs that
+        provably cannot pass the similarity gate (their scores are 0 either way).
+        """
+        try:
+            query_rows, gallery_rows, error = self.prepare_embedding_sets(queries, gallery)
+            if error:
+                return {'success': False, 'error': error}
+            
+            scores = self.batch_compare(query_rows, gallery_rows, query_stats, gallery_stats, early_reject)
+            result = {
+                'success': True,
+                'query_count': len(query_rows),
+                'gallery_count': len(gallery_rows),
+                'similarity': scores['similarity'].tolist(),
+                'distance': scores['distance'].tolist(),
+                'confidence': scores['confidence'].tolist(),
+                'consistent': scores['consistent'].tolist(),
+                'early_rejected': scores['early_rejected'].tolist(),
+                'early_rejections': int(scores['early_rejected'].sum())
+            }
+            if detailed:
+                result['detailed_similarities'] = {
+                    name: scores[name].tolist() for name in BATCH_METRICS
+                }
+            return result
+        
+        except Exception as e:
+            return {'success': False, 'error': f"Similarity matrix error: {str(e)}"}
+    
+    def compare_many(self, queries, gallery, top_k=None, min_similarity=None, query_stats=None, gallery_stats=None,
+                     early_reject=True) -> dict:
+        """1:N / N:M comparison; returns each query's gallery matches, best first"""
+        try:
+            query_rows, gallery_rows, error = self.prepare_embedding_sets(queries, gallery)
+            if error:
+                return {'success': False, 'error': error}
+            
+            scores = self.batch_compare(query_rows, gallery_rows, query_stats, gallery_stats, early_reject)
+            similarity = scores['similarity']
+            
+            results = []
+            for qi in range(len(query_rows)):
+                # Stable sort keeps gallery order among equal scores
+                order = np.argsort(-similarity[qi], kind='stable')
+                if min_similarity is not None:
+                    order = order[similarity[qi, order] >= min_similarity]
+                if top_k is not None:
+                    order = order[:top_k]
+                results.append({
+                    'query_index': qi,
+                    'matches': [
+                        {
+                            'gallery_index': int(gi),
+                            'similarity': float(similarity[qi, gi]),
+                            'distance': float(scores['distance'][qi, gi]),
+                            'confidence': float(scores['confidence'][qi, gi]),
+                            'detailed_similarities': {name: float(scores[name][qi, gi]) for name in BATCH_METRICS}
+                        }
+                        for gi in order
+                    ]
+                })
+            
+            return {
+                'success': True,
+                'query_count': len(query_rows),
+                'gallery_count': len(gallery_rows),
+                'early_rejections': int(scores['early_rejected'].sum()),
+                'results': results
+            }
+        
+        except Exception as e:
+            return {'success': False, 'error': f"Batch comparison error: {str(e)}"}
+    
+    def prepare_embedding_sets(self, queries, gallery):
+        """Validate both sets; returns (query_rows, gallery_rows, error)"""
+        sets = []
+        for name, rows in (('queries', queries), ('gallery', gallery)):
+            if rows is None or len(rows) == 0:
+                return None, None, f"No {name} embeddings provided"
+            if hasattr(rows, 'length_buckets') or (isinstance(rows, np.ndarray) and rows.ndim == 2):
+                # Matrix sets (e.g. a memory-mapped embedding store) are used in place
+                sets.append(rows)
+                continue
+            converted = []
+            for index, row in enumerate(rows):
+                vector = np.asarray(row, dtype=np.float64).ravel()
+                if vector.size == 0:
+                    return None, None, f"Invalid embedding at {name}[{index}]"
+                converted.append(vector)
+            sets.append(converted)
+        return sets[0], sets[1], None
+    
+    def batch_compare(self, query_rows, gallery_rows, query_stats=None, gallery_stats=None, early_reject=True):
+        """Score matrices for lists of 1-D embeddings (or matrix sets, see row_buckets)
+        
+        Pairs are truncated to their common length like compare_faces_advanced, so
+        rows are bucketed by length and each bucket pair is scored in blocks of at
+        most GALLERY_BLOCK_ROWS gallery rows.
+        """
+        nq, ng = len(query_rows), len(gallery_rows)
+        scores = {name: np.zeros((nq, ng)) for name in BATCH_METRICS}
+        scores['similarity'] = np.zeros((nq, ng))
+        scores['distance'] = np.ones((nq, ng))
+        scores['confidence'] = np.zeros((nq, ng))
+        scores['consistent'] = np.zeros((nq, ng), dtype=bool)
+        scores['early_rejected'] = np.zeros((nq, ng), dtype=bool)
+        
+        query_buckets = self.row_buckets(query_rows)
+        gallery_buckets = self.row_buckets(gallery_rows)
+        for q_len, (q_index, q_matrix) in query_buckets.items():
+            for g_len, (g_index, g_matrix) in gallery_buckets.items():
+                length = min(q_len, g_len)
+                A = self.bucket_matrix(query_rows, q_index, q_matrix, 0, len(q_index), length)
+                stats_a = [query_stats[i] for i in q_index] if query_stats else None
+                for start in range(0, len(g_index), GALLERY_BLOCK_ROWS):
+                    stop = min(start + GALLERY_BLOCK_ROWS, len(g_index))
+                    block_index = g_index[start:stop]
+                    B = self.bucket_matrix(gallery_rows, g_index, g_matrix, start, stop, length)
+                    stats_b = [gallery_stats[i] for i in block_index] if gallery_stats else None
+                    block = self.batch_compare_block(A, B, stats_a, stats_b, early_reject)
+                    for name, values in block.items():
+                        scores[name][np.ix_(q_index, block_index)] = values
+        
+        return scores
+    
+    def row_buckets(self, rows):
+        """{length: (row indices, matrix or None)}
+        
+        Lists are bucketed row by row (matrix None, stacked per block). A 2-D array
+        is one bucket, and objects with length_buckets() (EmbeddingStore galleries)
+        hand over their own per-length matrices.
+        """
+        if hasattr(rows, 'length_buckets'):
+            return rows.length_buckets()
+        if isinstance(rows, np.ndarray) and rows.ndim == 2:
+            return {rows.shape[1]: (np.arange(rows.shape[0]), rows)}
+        return {length: (index, None) for length, index in self.bucket_rows_by_length(rows).items()}
+    
+    def bucket_matrix(self, rows, index, matrix, start, stop, length):
+        """float64 block of bucket rows [start, stop) truncated to length"""
+        if matrix is None:
+            return np.stack([rows[i][:length] for i in index[start:stop]])
+        return np.asarray(matrix[start:stop, :length], dtype=np.float64)
+    
+    def bucket_rows_by_length(self, rows):
+        buckets = {}
+        for index, row in enumerate(rows):
+            buckets.setdefault(len(row), []).append(index)
+        return buckets
+    
+    def batch_compare_block(self, A, B, stats_a=None, stats_b=None, early_reject=True, reject_below=None):
+        """compare_faces_advanced for every row pair of two same-width matrices
+        
+        The cheap terms (adaptive adjustments, structural, euclidean from the plain
+        dot product) come first. With early_reject, pairs whose upper bound cannot
+        pass the similarity gate skip cross-validation and the outlier-masked metrics.
+        reject_below raises that gate for callers that only need pairs scoring at
+        least that much (e.g. clustering links); such pairs are reported as rejected.
+        """
+        d = A.shape[1]
+        nq, ng = A.shape[0], B.shape[0]
+        rows_a = self.batch_row_stats(A, stats_a)
+        rows_b = self.batch_row_stats(B, stats_b)
+        
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # Vector-level statistics shared by several metrics
+            mean_a, mean_b = rows_a['mean'], rows_b['mean']
+            var_a, var_b = rows_a['var'], rows_b['var']
+            norm_a, norm_b = rows_a['norm'], rows_b['norm']
+            A_centered = A - mean_a[:, None]
+            B_centered = B - mean_b[:, None]
+            centered_dot = A_centered @ B_centered.T
+            
+            # 6. Structural similarity (exact, only needs the centered dot product)
+            C1, C2, C3 = 1e-4, 1e-4, 1e-4
+            mu_a, mu_b = mean_a[:, None], mean_b[None, :]
+            va, vb = var_a[:, None], var_b[None, :]
+            cov_ab = centered_dot / d
+            luminance = (2 * mu_a * mu_b + C1) / (mu_a**2 + mu_b**2 + C1)
+            contrast = (2 * np.sqrt(va * vb) + C2) / (va + vb + C2)
+            structure = (cov_ab + C3) / (np.sqrt(va * vb) + C3)
+            structural = np.clip((luminance * contrast * structure + 1) / 2, 0.0, 1.0)
+            
+            # Adaptive adjustments
+            full_correlation = centered_dot / np.sqrt(
+                np.einsum('ij,ij->i', A_centered, A_centered)[:, None] *
+                np.einsum('ij,ij->i', B_centered, B_centered)[None, :]
+            )
+            adjustments = self.batch_adaptive_adjustments(A, B, rows_a, rows_b, full_correlation)
+            similarity_boost, _, threshold_adjustment = adjustments
+            reject_threshold = SIMILARITY_GATE + threshold_adjustment
+            if reject_below is not None:
+                reject_threshold = np.maximum(reject_threshold, reject_below)
+            
+            if early_reject:
+                # Upper bound: euclidean from the plain dot product, structural exact,
+                # every outlier-masked metric at its maximum of 1
+                max_distance = norm_a[:, None] + norm_b[None, :]
+                squared = np.maximum(norm_a[:, None] ** 2 + norm_b[None, :] ** 2 - 2 * (A @ B.T), 0.0)
+                euclidean_bound = np.where(max_distance == 0, 1.0,
+                                           np.clip(1.0 - np.sqrt(squared) / max_distance, 0.0, 1.0))
+                upper = {name: 1.0 for name in BATCH_METRICS}
+                upper['euclidean'] = euclidean_bound
+                upper['structural'] = structural
+                bound = self.batch_weighted_similarity(upper) + EARLY_REJECT_MARGIN
+                early = bound * similarity_boost < reject_threshold
+            else:
+                euclidean_bound = None
+                early = np.zeros((nq, ng), dtype=bool)
+        
+        block = {name: np.zeros((nq, ng)) for name in BATCH_METRICS}
+        block['similarity'] = np.zeros((nq, ng))
+        block['distance'] = np.ones((nq, ng))
+        block['confidence'] = np.zeros((nq, ng))
+        block['consistent'] = np.zeros((nq, ng), dtype=bool)
+        block['early_rejected'] = early
+        
+        # Full ensemble only on the rows and columns that still hold a candidate pair
+        q_keep = np.flatnonzero(~early.all(axis=1))
+        g_keep = np.flatnonzero(~early.all(axis=0))
+        if q_keep.size == 0 or g_keep.size == 0:
+            return block
+        
+        cells = np.ix_(q_keep, g_keep)
+        sub_a = (A, rows_a) if q_keep.size == nq else (A[q_keep], self.batch_rows_subset(rows_a, q_keep))
+        sub_b = (B, rows_b) if g_keep.size == ng else (B[g_keep], self.batch_rows_subset(rows_b, g_keep))
+        full = self.batch_full_ensemble(
+            sub_a[0], sub_b[0], sub_a[1], sub_b[1], structural[cells],
+            [values[cells] for values in adjustments],
+            euclidean_bound[cells] if euclidean_bound is not None else None,
+            reject_threshold[cells]
+        )
+        
+        live = ~early[cells]
+        for name, values in full.items():
+            block[name][cells] = np.where(live, values, block[name][cells])
+        return block
+    
+    def batch_full_ensemble(self, A, B, rows_a, rows_b, structural, adjustments, euclidean_bound=None,
+                            reject_threshold=None):
+        """Cross-validation, the masked metrics and the final gate for a (sub-)block
+        
+        With euclidean_bound (early rejection on), the element-wise metrics only run
+        for consistent pairs that can still reach reject_threshold once cosine and
+        pearson are known.
+        """
+        d = A.shape[1]
+        norm_a, norm_b = rows_a['norm'], rows_b['norm']
+        var_a, var_b = rows_a['var'], rows_b['var']
+        similarity_boost, confidence_boost, threshold_adjustment = adjustments
+        
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # Cross-validation on 5 segments, each with its own outlier removal
+            segments = CROSS_VALIDATION_SEGMENTS
+            segment_size = d // segments
+            if segment_size < 10:
+                consistent = np.ones((A.shape[0], B.shape[0]), dtype=bool)
+            else:
+                segment_sims = []
+                for i in range(segments):
+                    start_idx = i * segment_size
+                    end_idx = (i + 1) * segment_size if i < segments - 1 else d
+                    segment_sums = self.batch_masked_sums(
+                        A[:, start_idx:end_idx], B[:, start_idx:end_idx],
+                        rows_a['segments'][i], rows_b['segments'][i], cosine_only=True
+                    )
+                    segment_sims.append(self.batch_cosine_from_sums(segment_sums))
+                segment_sims = np.stack(segment_sims)
+                
+                mean_sim = np.mean(segment_sims, axis=0)
+                std_sim = np.std(segment_sims, axis=0)
+                variance = std_sim / (mean_sim + 1e-7)
+                min_sim = segment_sims.min(axis=0)
+                range_sim = segment_sims.max(axis=0) - min_sim
+                consistent = ~(
+                    (variance > 0.6) | (std_sim > 0.25) | (range_sim > 0.4) |
+                    (mean_sim < 0.3) | (min_sim < mean_sim * 0.7)
+                )
+            
+            sums = self.batch_masked_sums(A, B, rows_a, rows_b)
+            
+            # 1. Cosine similarity
+            cosine = self.batch_cosine_from_sums(sums)
+            
+            # 2. Pearson correlation on the outlier-free dimensions
+            n = sums['count']
+            cov = sums['centered_ab'] - sums['centered_a'] * sums['centered_b'] / n
+            ss_a = sums['centered_aa'] - sums['centered_a'] ** 2 / n
+            ss_b = sums['centered_bb'] - sums['centered_b'] ** 2 / n
+            correlation = np.clip(cov / np.sqrt(ss_a * ss_b), -1.0, 1.0)
+            pearson = np.clip((correlation + 1) / 2, 0.0, 1.0)
+            pearson = np.where(np.isnan(correlation) | (n < 3), 0.0, pearson)
+            if d < 3:
+                pearson[:] = 0.0
+            
+            late = np.zeros(consistent.shape, dtype=bool)
+            if euclidean_bound is not None:
+                # Second bound: only manhattan and chi-square are still taken at 1
+                upper = {name: 1.0 for name in BATCH_METRICS}
+                upper.update({'cosine': cosine, 'pearson': pearson, 'euclidean': euclidean_bound,
+                              'structural': structural})
+                bound = self.batch_weighted_similarity(upper) + EARLY_REJECT_MARGIN
+                late = consistent & (bound * similarity_boost < reject_threshold)
+                # Inconsistent pairs score 0 whatever their distances are
+                distances = self.batch_needed_distances(A, B, sums, rows_a, rows_b, consistent & ~late)
+            else:
+                distances = self.batch_elementwise_distances(A, B, sums, rows_a['abs'], rows_b['abs'])
+            
+            # 3. Euclidean similarity với adaptive scaling
+            feature_variance = (var_a[:, None] + var_b[None, :]) / 2
+            scale_factor = 1.0 / (1.0 + feature_variance * 0.1)
+            max_distance = norm_a[:, None] + norm_b[None, :]
+            euclidean = 1.0 - (np.sqrt(distances['squared']) * scale_factor) / (max_distance * scale_factor)
+            euclidean = np.where(max_distance == 0, 1.0, np.clip(euclidean, 0.0, 1.0))
+            
+            # 4. Manhattan similarity
+            manhattan = 1.0 - distances['manhattan'] / distances['manhattan_max']
+            manhattan = np.where(distances['manhattan_max'] == 0, 1.0, np.clip(manhattan, 0.0, 1.0))
+            
+            # 5. Chi-square similarity
+            chi_square = 1.0 / (1.0 + distances['chi_square'] / (distances['chi_square_count'] * 0.5))
+            chi_square = np.clip(chi_square, 0.0, 1.0)
+            
+            metrics = {
+                'cosine': cosine, 'pearson': pearson, 'euclidean': euclidean,
+                'manhattan': manhattan, 'chi_square': chi_square, 'structural': structural
+            }
+            
+            weighted_similarity = self.batch_weighted_similarity(metrics)
+            confidence = self.batch_enhanced_confidence(np.stack([metrics[name] for name in BATCH_METRICS]))
+            
+            final_similarity = weighted_similarity * similarity_boost
+            final_confidence = confidence * confidence_boost
+            rejected = final_similarity < SIMILARITY_GATE + threshold_adjustment
+            final_similarity = np.where(rejected, 0.0, final_similarity)
+            final_confidence = np.where(rejected, 0.0, final_confidence)
+            
+            scored = consistent & ~late
+            result = {name: np.where(scored, values, 0.0) for name, values in metrics.items()}
+            result['similarity'] = np.where(scored, np.clip(final_similarity, 0.0, 1.0), 0.0)
+            result['distance'] = np.where(scored, 1.0 - final_similarity, 1.0)
+            result['confidence'] = np.where(scored, np.clip(final_confidence, 0.0, 1.0), 0.0)
+            result['consistent'] = consistent
+            result['early_rejected'] = late
+        
+        return result
+    
+    def batch_needed_distances(self, A, B, sums, rows_a, rows_b, needed, block_elements=1 << 21):
+        """batch_elementwise_distances for the needed pairs only
+        
+        Mostly-needed blocks use the dense slab path; sparse ones gather the
+        needed (query, gallery) row pairs. Other pairs get zero distances and
+        must not be used by the caller.
+        """
+        if needed.mean() > DENSE_DISTANCE_FRACTION:
+            return self.batch_elementwise_distances(A, B, sums, rows_a['abs'], rows_b['abs'])
+        
+        d = A.shape[1]
+        shape = needed.shape
+        squared = np.zeros(shape)
+        manhattan = np.zeros(shape)
+        chi_square = np.zeros(shape)
+        
+        # Chi-square masks as in batch_elementwise_distances
+        epsilon = 1e-10
+        chi_mask_a, chi_mask_b = rows_a['abs']['mask'], rows_b['abs']['mask']
+        chi_count = chi_mask_a @ chi_mask_b.T
+        chi_use_mask = rows_a['abs']['valid'][:, None] & rows_b['abs']['valid'][None, :] & (chi_count >= d * 0.5)
+        mask_a, mask_b = sums['mask_a'], sums['mask_b']
+        
+        qi, gi = np.nonzero(needed)
+        step = max(1, block_elements // d)
+        for start in range(0, qi.size, step):
+            q, g = qi[start:start + step], gi[start:start + step]
+            a, b = A[q], B[g]
+            
+            diff = a - b
+            squared[q, g] = np.einsum('ij,ij->i', diff, diff)
+            np.abs(diff, out=diff)
+            use_mask = sums['use_mask'][q, g]
+            manhattan[q, g] = np.where(use_mask, np.einsum('ij,ij->i', diff * mask_a[q], mask_b[g]), diff.sum(axis=1))
+            
+            pos_a, pos_b = np.maximum(np.abs(a), epsilon), np.maximum(np.abs(b), epsilon)
+            terms = (pos_a - pos_b) ** 2 / (pos_a + pos_b)
+            chi_square[q, g] = np.where(chi_use_mask[q, g],
+                                        np.einsum('ij,ij->i', terms * chi_mask_a[q], chi_mask_b[g]),
+                                        terms.sum(axis=1))
+        
+        return {
+            'squared': squared,
+            'manhattan': manhattan,
+            'manhattan_max': sums['abs_a'] + sums['abs_b'],
+            'chi_square': chi_square,
+            'chi_square_count': np.where(chi_use_mask, chi_count, float(d))
+        }
+    
+    def batch_weighted_similarity(self, metrics):
+        """Weighted ensemble, same accumulation order as the pairwise path"""
+        total_weight = sum(BATCH_METRICS.values())
+        weighted_similarity = 0
+        for name, weight in BATCH_METRICS.items():
+            weighted_similarity = weighted_similarity + metrics[name] * weight
+        return weighted_similarity / total_weight
+    
+    def batch_rows_subset(self, rows, index):
+        """Select rows (by index) of a batch_stats_arrays result"""
+        subset = {key: rows[key][index] for key in ('mask', 'valid', 'mean', 'var', 'norm', 'skewness')}
+        subset['abs'] = {key: rows['abs'][key][index] for key in ('mask', 'valid')}
+        subset['segments'] = [{key: segment[key][index] for key in ('mask', 'valid')} for segment in rows['segments']]
+        return subset
+    
+    def batch_row_stats(self, X, stats_list=None):
+        """Per-row statistics for a block, from stored stats when any row has them"""
+        if stats_list and any(st is not None for st in stats_list):
+            return self.batch_stats_arrays(
+                [self.resolve_embedding_stats(row, st) for row, st in zip(X, stats_list)], X.shape[1]
+            )
+        return self.batch_stats_from_matrix(X)
+    
+    def batch_stats_from_matrix(self, X):
+        """batch_stats_arrays computed directly from the rows (no stored stats)"""
+        d = X.shape[1]
+        
+        def keep_masks(M, threshold):
+            mean, std = M.mean(axis=1, keepdims=True), M.std(axis=1, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mask = np.abs((M - mean) / std) < threshold
+            return {'mask': mask.astype(np.float64), 'valid': std[:, 0] != 0}
+        
+        rows = keep_masks(X, 3)
+        rows['mean'] = X.mean(axis=1)
+        rows['var'] = X.var(axis=1)
+        rows['norm'] = np.linalg.norm(X, axis=1)
+        std = X.std(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (X - rows['mean'][:, None]) / std
+            rows['skewness'] = np.where(std[:, 0] == 0, 0.0, np.mean(z * z * z, axis=1))
+        rows['abs'] = keep_masks(np.maximum(np.abs(X), 1e-10), 2)
+        
+        rows['segments'] = []
+        segment_size = d // CROSS_VALIDATION_SEGMENTS
+        if segment_size >= 10:
+            for i in range(CROSS_VALIDATION_SEGMENTS):
+                start_idx = i * segment_size
+                end_idx = (i + 1) * segment_size if i < CROSS_VALIDATION_SEGMENTS - 1 else d
+                rows['segments'].append(keep_masks(X[:, start_idx:end_idx], 3))
+        return rows
+    
+    def batch_stats_arrays(self, stats_list, d):
+        """Stack per-row embedding stats into arrays and float keep-masks (1 = kept)"""
+        def keep_masks(outlier_lists, stds, width):
+            mask = np.ones((len(outlier_lists), width))
+            for row, outliers in enumerate(outlier_lists):
+                mask[row, outliers] = 0.0
+            return {'mask': mask, 'valid': np.array(stds) != 0}
+        
+        rows = keep_masks([st['outliers'] for st in stats_list], [st['std'] for st in stats_list], d)
+        for key in ('mean', 'var', 'norm', 'skewness'):
+            rows[key] = np.array([st[key] for st in stats_list], dtype=np.float64)
+        rows['abs'] = keep_masks([st['abs_outliers'] for st in stats_list], [st['abs_std'] for st in stats_list], d)
+        
+        rows['segments'] = []
+        segment_size = d // CROSS_VALIDATION_SEGMENTS
+        if segment_size >= 10:
+            for i in range(CROSS_VALIDATION_SEGMENTS):
+                width = segment_size if i < CROSS_VALIDATION_SEGMENTS - 1 else d - i * segment_size
+                rows['segments'].append(keep_masks(
+                    [st['segments'][i]['outliers'] for st in stats_list],
+                    [st['segments'][i]['std'] for st in stats_list], width
+                ))
+        return rows
+    
+    def batch_masked_sums(self, A, B, rows_a, rows_b, cosine_only=False):
+        """Pairwise sums over each pair's outlier-free dimensions (remove_embedding_outliers)
+        
+        Pairs whose combined mask keeps fewer than half the dimensions, or where
+        either side has zero std, fall back to all dimensions like the pairwise path.
+        """
+        d = A.shape[1]
+        mask_a, valid_a = rows_a['mask'], rows_a['valid']
+        mask_b, valid_b = rows_b['mask'], rows_b['valid']
+        
+        count = mask_a @ mask_b.T
+        use_mask = valid_a[:, None] & valid_b[None, :] & (count >= d * 0.5)
+        
+        def pair_sums(left, right):
+            return np.where(use_mask, (left * mask_a) @ (right * mask_b).T, left @ right.T)
+        
+        def query_sums(values):
+            return np.where(use_mask, (values * mask_a) @ mask_b.T, values.sum(axis=1)[:, None])
+        
+        def gallery_sums(values):
+            return np.where(use_mask, mask_a @ (values * mask_b).T, values.sum(axis=1)[None, :])
+        
+        sums = {
+            'use_mask': use_mask,
+            'dot': pair_sums(A, B),
+            'sq_a': query_sums(A * A),
+            'sq_b': gallery_sums(B * B)
+        }
+        if cosine_only:
+            return sums
+        
+        # Pearson is shift invariant, so it works on centered rows for precision
+        A_c = A - rows_a['mean'][:, None]
+        B_c = B - rows_b['mean'][:, None]
+        sums.update({
+            'count': np.where(use_mask, count, float(d)),
+            'abs_a': query_sums(np.abs(A)),
+            'abs_b': gallery_sums(np.abs(B)),
+            'centered_a': query_sums(A_c),
+            'centered_b': gallery_sums(B_c),
+            'centered_ab': pair_sums(A_c, B_c),
+            'centered_aa': query_sums(A_c * A_c),
+            'centered_bb': gallery_sums(B_c * B_c),
+            'mask_a': mask_a,
+            'mask_b': mask_b
+        })
+        return sums
+    
+    def batch_cosine_from_sums(self, sums):
+        """robust_cosine_similarity from pairwise masked sums"""
+        norm_a, norm_b = np.sqrt(sums['sq_a']), np.sqrt(sums['sq_b'])
+        similarity = sums['dot'] / (norm_a * norm_b)
+        normalized_sim = (similarity + 1) / 2
+        smoothed_sim = 1 / (1 + np.exp(-10 * (normalized_sim - 0.5)))
+        return np.where((norm_a == 0) | (norm_b == 0), 0.0, np.clip(smoothed_sim, 0.0, 1.0))
+    
+    def batch_elementwise_distances(self, A, B, sums, abs_rows_a, abs_rows_b, block_elements=1 << 21):
+        """Euclidean, manhattan and chi-square sums, which need every |a_k - b_k|
+        
+        Evaluated on (query block, gallery block, dim) slabs of at most
+        block_elements values to bound memory.
+        """
+        nq, d = A.shape
+        ng = B.shape[0]
+        squared = np.empty((nq, ng))
+        manhattan_full = np.empty((nq, ng))
+        manhattan_masked = np.empty((nq, ng))
+        chi_full = np.empty((nq, ng))
+        chi_masked = np.empty((nq, ng))
+        
+        # Chi-square works on magnitudes with its own (threshold 2) outlier masks
+        epsilon = 1e-10
+        A_pos, B_pos = np.maximum(np.abs(A), epsilon), np.maximum(np.abs(B), epsilon)
+        chi_mask_a, chi_valid_a = abs_rows_a['mask'], abs_rows_a['valid']
+        chi_mask_b, chi_valid_b = abs_rows_b['mask'], abs_rows_b['valid']
+        chi_count = chi_mask_a @ chi_mask_b.T
+        chi_use_mask = chi_valid_a[:, None] & chi_valid_b[None, :] & (chi_count >= d * 0.5)
+        
+        mask_a, mask_b = sums['mask_a'], sums['mask_b']
+        gallery_block = max(1, min(ng, block_elements // d))
+        query_block = max(1, block_elements // (gallery_block * d))
+        
+        for q0 in range(0, nq, query_block):
+            q1 = min(nq, q0 + query_block)
+            for g0 in range(0, ng, gallery_block):
+                g1 = min(ng, g0 + gallery_block)
+                
+                diff = A[q0:q1, None, :] - B[None, g0:g1, :]
+                squared[q0:q1, g0:g1] = np.einsum('ijk,ijk->ij', diff, diff)
+                np.abs(diff, out=diff)
+                manhattan_full[q0:q1, g0:g1] = diff.sum(axis=2)
+                diff *= mask_a[q0:q1, None, :]
+                manhattan_masked[q0:q1, g0:g1] = np.einsum('ijk,jk->ij', diff, mask_b[g0:g1])
+                
+                pos_a, pos_b = A_pos[q0:q1, None, :], B_pos[None, g0:g1, :]
+                terms = (pos_a - pos_b) ** 2 / (pos_a + pos_b)
+                chi_full[q0:q1, g0:g1] = terms.sum(axis=2)
+                terms *= chi_mask_a[q0:q1, None, :]
+                chi_masked[q0:q1, g0:g1] = np.einsum('ijk,jk->ij', terms, chi_mask_b[g0:g1])
+        
+        return {
+            'squared': squared,
+            'manhattan': np.where(sums['use_mask'], manhattan_masked, manhattan_full),
+            'manhattan_max': sums['abs_a'] + sums['abs_b'],
+            'chi_square': np.where(chi_use_mask, chi_masked, chi_full),
+            'chi_square_count': np.where(chi_use_mask, chi_count, float(d))
+        }
+    
+    def batch_enhanced_confidence(self, sim_values):
+        """calculate_enhanced_confidence for consistent pairs; sim_values is (metrics, nq, ng)"""
+        mean_sim = np.mean(sim_values, axis=0)
+        std_sim = np.std(sim_values, axis=0)
+        base_confidence = np.maximum(0.1, np.minimum(1.0, 1.0 - (std_sim * 1.5)))
+        
+        high_sim_count = np.sum(sim_values > 0.6, axis=0)
+        agreement_confidence = 0.5 + (high_sim_count / len(sim_values)) * 0.5
+        
+        final_confidence = base_confidence * 1.2 * agreement_confidence
+        final_confidence = np.where(mean_sim > 0.75, final_confidence * 1.3,
+                           np.where(mean_sim > 0.6, final_confidence * 1.1,
+                           np.where(mean_sim < 0.3, final_confidence * 0.5, final_confidence)))
+        return np.minimum(1.0, final_confidence)
+    
+    def batch_adaptive_adjustments(self, A, B, rows_a, rows_b, correlation):
+        """calculate_adaptive_adjustments for every pair; returns the three boost matrices"""
+        d = A.shape[1]
+        v1, v2 = rows_a['var'][:, None], rows_b['var'][None, :]
+        mean_var = (v1 + v2) / 2
+        var_ratio = np.minimum(v1, v2) / (np.maximum(v1, v2) + 1e-7)
+        n1, n2 = rows_a['norm'][:, None], rows_b['norm'][None, :]
+        norm_ratio = np.minimum(n1, n2) / (np.maximum(n1, n2) + 1e-7)
+        
+        skew_diff = np.abs(rows_a['skewness'][:, None] - rows_b['skewness'][None, :])
+        
+        # Sign agreement as three indicator dot products
+        sign_matches = sum(
+            (A > 0 if s > 0 else A < 0 if s < 0 else A == 0).astype(np.float64) @
+            (B > 0 if s > 0 else B < 0 if s < 0 else B == 0).astype(np.float64).T
+            for s in (1, -1, 0)
+        )
+        sign_diff = (d - sign_matches) / d
+        
+        similarity_boost = np.ones_like(mean_var)
+        confidence_boost = np.ones_like(mean_var)
+        threshold_adjustment = np.zeros_like(mean_var)
+        
+        high_var, low_var = mean_var > 0.5, mean_var < 0.1
+        similarity_boost = np.where(high_var, similarity_boost * 1.05, np.where(low_var, similarity_boost * 0.85, similarity_boost))
+        confidence_boost = np.where(high_var, confidence_boost * 1.05, confidence_boost)
+        
+        cond = var_ratio < 0.7
+        similarity_boost = np.where(cond, similarity_boost * 0.9, similarity_boost)
+        threshold_adjustment = np.where(cond, threshold_adjustment + 0.05, threshold_adjustment)
+        
+        high, low = norm_ratio > 0.9, norm_ratio < 0.7
+        confidence_boost = np.where(high, confidence_boost * 1.1, np.where(low, confidence_boost * 0.6, confidence_boost))
+        threshold_adjustment = np.where(high, threshold_adjustment - 0.03, np.where(low, threshold_adjustment + 0.1, threshold_adjustment))
+        
+        high, low = skew_diff < 0.3, skew_diff > 1.0
+        similarity_boost = np.where(high, similarity_boost * 1.1, np.where(low, similarity_boost * 0.75, similarity_boost))
+        threshold_adjustment = np.where(low, threshold_adjustment + 0.05, threshold_adjustment)
+        
+        high, low = correlation > 0.8, correlation < 0.4
+        similarity_boost = np.where(high, similarity_boost * 1.1, np.where(low, similarity_boost * 0.8, similarity_boost))
+        threshold_adjustment = np.where(high, threshold_adjustment - 0.05, np.where(low, threshold_adjustment + 0.1, threshold_adjustment))
+        
+        cond = sign_diff > 0.4
+        similarity_boost = np.where(cond, similarity_boost * 0.85, similarity_boost)
+        threshold_adjustment = np.where(cond, threshold_adjustment + 0.1, threshold_adjustment)
+        
+        return (
+            np.clip(similarity_boost, 0.6, 1.3),
+            np.clip(confidence_boost, 0.4, 1.5),
+            np.clip(threshold_adjustment, -0.15, 0.25)
+        )
@@ -1,8 +1,17 @@
+import time
+
+# Captured before any heavy import so cold start can be reported per action
+_MODULE_START = time.perf_counter()
+
+import io
 import sys
 import json
 import argparse
 import os
-import urllib.request
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, redirect_stderr
 from pathlib import Path
 import math
 
@@ -13,22 +22,50 @@ except ImportError:
     print(json.dumps({"success": False, "error": "NumPy not installed. Please run: pip install numpy"}))
     sys.exit(1)
 
-try:
-    import cv2
-    from cv2 import (CascadeClassifier, imread, imdecode, IMREAD_COLOR, cvtColor, COLOR_BGR2GRAY, 
-                    ellipse, matchTemplate, TM_CCOEFF_NORMED, calcHist, resize, Laplacian, CV_64F,
-                    HOGDescriptor, equalizeHist, GaussianBlur, Canny, Sobel,
-                    getRotationMatrix2D, warpAffine, INTER_LINEAR, MORPH_ELLIPSE, getStructuringElement,
-                    morphologyEx, MORPH_CLOSE, MORPH_OPEN, dnn)
-except ImportError as e:
-    print(json.dumps({"success": False, "error": f"OpenCV import error: {str(e)}"}))
-    sys.exit(1)
+from face_similarity import EmbeddingComparator
+from embedding_index import open_index
+from embedding_store import open_store
+from face_clustering import FaceClusterer, open_clusters
 
-try:
-    from PIL import Image
-except ImportError:
-    print(json.dumps({"success": False, "error": "Pillow not installed. Please run: pip install Pillow"}))
-    sys.exit(1)
+# OpenCV and Pillow are imported lazily: comparison actions only need NumPy,
+# and importing cv2 dominates their cold-start time.
+cv2 = None
+
+# imread flag per decode reduction, filled in with the OpenCV import
+REDUCED_DECODE_FLAGS = {}
+
+def load_vision_dependencies():
+    """Import OpenCV/Pillow on first use and expose them as module globals"""
+    global cv2, CascadeClassifier, imread, imdecode, IMREAD_COLOR, cvtColor, COLOR_BGR2GRAY
+    global ellipse, matchTemplate, TM_CCOEFF_NORMED, calcHist, resize, Laplacian, CV_64F
+    global HOGDescriptor, equalizeHist, GaussianBlur, Canny, Sobel
+    global getRotationMatrix2D, warpAffine, INTER_LINEAR, MORPH_ELLIPSE, getStructuringElement
+    global morphologyEx, MORPH_CLOSE, MORPH_OPEN, dnn, Image
+    
+    if cv2 is not None:
+        return
+    
+    try:
+        import cv2 as _cv2
+        from cv2 import (CascadeClassifier, imread, imdecode, IMREAD_COLOR, cvtColor, COLOR_BGR2GRAY, 
+                        ellipse, matchTemplate, TM_CCOEFF_NORMED, calcHist, resize, Laplacian, CV_64F,
+                        HOGDescriptor, equalizeHist, GaussianBlur, Canny, Sobel,
+                        getRotationMatrix2D, warpAffine, INTER_LINEAR, MORPH_ELLIPSE, getStructuringElement,
+                        morphologyEx, MORPH_CLOSE, MORPH_OPEN, dnn)
+    except ImportError as e:
+        print(json.dumps({"success": False, "error": f"OpenCV import error: {str(e)}"}))
+        sys.exit(1)
+    
+    try:
+        from PIL import Image
+    except ImportError:
+        print(json.dumps({"success": False, "error": "Pillow not installed. Please run: pip install Pillow"}))
+        sys.exit(1)
+    
+    cv2 = _cv2
+    REDUCED_DECODE_FLAGS.update({
+        1: IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8
+    })
 
 # Add function to load arguments from file
 def load_args_from_file(file_path):
@@ -40,9 +77,312 @@ def load_args_from_file(file_path):
         print(f"Error loading arguments from file: {e}", file=sys.stderr)
         return None
 
-class AdvancedFaceProcessor:
+# Every detection variant in the order detections are merged for the ensemble
+DETECTION_VARIANT_ORDER = [
+    'original', 'enhanced_contrast', 'brighter',
+    'rotated_10', 'rotated_-10', 'rotated_20', 'rotated_-20',
+    'bright_1.2', 'bright_1.4'
+]
+
+# Early-exit stages, ordered by expected yield: well-lit frontal photos are
+# usually settled by the first stage and never need the rotated variants.
+DETECTION_VARIANT_SCHEDULE = [
+    ['original', 'enhanced_contrast'],
+    ['brighter', 'bright_1.2', 'bright_1.4'],
+    ['rotated_10', 'rotated_-10'],
+    ['rotated_20', 'rotated_-20'],
+]
+
+# A stage is "stable" when every face group reaches this ensemble confidence
+# with votes from at least this many distinct variants, or when a stage leaves
+# every ensemble face in place (matched at this IoU)
+EARLY_EXIT_MIN_CONFIDENCE = 0.8
+EARLY_EXIT_MIN_VARIANTS = 2
+EARLY_EXIT_MIN_STAGE_IOU = 0.7
+
+# Detection speed profiles: variants to build, detectors to run, cascades to use
+# (None = all loaded), how many cascade parameter sets to try per variant and
+# whether to stop early once the ensemble is stable.
+DETECTION_PROFILES = {
+    # Interactive gallery uploads
+    'fast': {
+        'variants': ['original', 'enhanced_contrast'],
+        'detectors': ['cascade'],
+        'cascades': ['haarcascade_frontalface_default.xml', 'haarcascade_frontalface_alt2.xml'],
+        'cascade_parameter_sets': 1,
+        'early_exit': True,
+    },
+    'balanced': {
+        'variants': ['original', 'enhanced_contrast', 'brighter'],
+        'detectors': ['cascade', 'template'],
+        'cascades': None,
+        'cascade_parameter_sets': 2,
+        'early_exit': True,
+    },
+    # Exhaustive pipeline for offline re-indexing (historical behaviour)
+    'thorough': {
+        'variants': list(DETECTION_VARIANT_ORDER),
+        'detectors': ['cascade', 'dnn', 'template', 'contour'],
+        'cascades': None,
+        'cascade_parameter_sets': 2,
+        'early_exit': False,
+    },
+}
+DEFAULT_DETECTION_PROFILE = 'thorough'
+
+# Threads used to detect the variants of one image in parallel. Serial by default:
+# the pool is opt-in (--detection-workers) until it is measured on multi-core hosts
+DEFAULT_DETECTION_WORKERS = 1
+
+# frequency_sharpness counts spectrum magnitude outside this radius (fraction of
+# the shorter side, in FFT index units) as high-frequency energy
+FREQUENCY_SHARPNESS_RADIUS = 0.3
+
+# Cached high-frequency masks, one per image shape (an rfft mask of a 12MP image is ~6MB)
+FREQUENCY_MASK_CACHE_SIZE = 8
+
+# Longest side of the quality proxies (--quality-proxy without a value): about 1MP at 4:3.
+# Proxy mode bounds the cost of large originals; what each metric is computed on:
+#   native-scale centre crop (same pixel scale, so the statistic is estimated, not rescaled):
+#     laplacian/sobel/frequency_sharpness, local_contrast, edge_contrast, noise, detail edges/texture
+#   area-downscaled thumbnail (whole frame; scale-normalized: means, ratios, relative blocks):
+#     global_contrast, illumination, face_quality symmetry
+#   original dimensions: detail resolution score, small-image weighting, image_info
+#   not scale-normalized: face_quality eye Laplacian / mouth edges read pixel-scale detail from
+#     the thumbnail and score higher than at full size
+QUALITY_PROXY_DIMENSION = 1152
+
+# Longest side a reduced decode keeps (--reduced-decode without a value): the detection
+# working size, so the working copy is still downscaled from at least this resolution
+REDUCED_DECODE_DIMENSION = 1200
+
+# Quality metric groups in scoring order, with the shared ImageContext intermediates
+# each one reads. Intermediates are computed lazily on first read and cached, so
+# every one is built at most once per image and only when an enabled metric needs it.
+QUALITY_METRICS = {
+    'sharpness': ('laplacian', 'sobel_x', 'sobel_y'),
+    'contrast': ('gray_std', 'local_moments', 'canny'),
+    'illumination': (),
+    'noise': ('laplacian', 'gray_f32', 'noise_estimate'),
+    'face': (),
+    'detail': ('canny', 'local_moments'),
+}
+
+class StageProfiler:
+    """Wall and CPU time per named pipeline stage, collected when --profile is on
+
+    Stages may nest (a parent's time includes its children) and may run on
+    detection worker threads, so the CPU time of a stage is the running thread's
+    own CPU time; the top-level cpu_ms counts every thread of the process.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def record(self, name, wall, cpu):
+        with self.lock:
+            entry = self.stages.setdefault(name, {'calls': 0, 'wall_ms': 0.0, 'cpu_ms': 0.0})
+            entry['calls'] += 1
+            entry['wall_ms'] += wall * 1000
+            entry['cpu_ms'] += cpu * 1000
+
+    def report(self):
+        """The 'timings' block: totals plus {stage: {calls, wall_ms, cpu_ms}} in first-seen order"""
+        with self.lock:
+            stages = {
+                name: {'calls': entry['calls'], 'wall_ms': round(entry['wall_ms'], 3), 'cpu_ms': round(entry['cpu_ms'], 3)}
+                for name, entry in self.stages.items()
+            }
+        return {
+            'wall_ms': round((time.perf_counter() - self.wall_start) * 1000, 3),
+            'cpu_ms': round((time.process_time() - self.cpu_start) * 1000, 3),
+            'stages': stages
+        }
+
+# Shared no-op stage context for calls without a profiler
+_NO_STAGE = nullcontext()
+
+def centre_crop(image, limit):
+    """Centre crop with the image's aspect ratio and at most limit pixels per side (a view)"""
+    h, w = image.shape[:2]
+    if not limit or max(h, w) <= limit:
+        return image
+    scale = limit / max(h, w)
+    crop_h, crop_w = max(1, int(round(h * scale))), max(1, int(round(w * scale)))
+    y0, x0 = (h - crop_h) // 2, (w - crop_w) // 2
+    return image[y0:y0 + crop_h, x0:x0 + crop_w]
+
+class ImageContext:
+    """Decoded image plus derived maps, built once per image and shared by every stage.
+    
+    Derived arrays (grayscale, working copy, Laplacian/Sobel maps, pyramid) are
+    computed on first access and cached, so stages only pay for what they read.
+    """
+    
+    def __init__(self, bgr, source=None, max_working_dimension=1200, original_shape=None):
+        self.bgr = bgr
+        self.source = source
+        self.max_working_dimension = max_working_dimension
+        # Shape of the decoded original when this context is a proxy of it
+        self.original_shape = original_shape or bgr.shape
+        self._cache = {}
+    
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+    
+    def memoize(self, key, compute):
+        """Cache a stage result (e.g. the detection ensemble) for later passes over this image"""
+        return self._cached(key, compute)
+    
+    @property
+    def shape(self):
+        return self.bgr.shape
+    
+    @property
+    def decode_scale(self):
+        """(x, y) factors from decoded pixels to original pixels; (1.0, 1.0) unless decoded reduced"""
+        h, w = self.bgr.shape[:2]
+        return self.original_shape[1] / w, self.original_shape[0] / h
+    
+    def to_original(self, x, y, w, h):
+        """Box in decoded pixels -> box in original pixels (ints)"""
+        if self.original_shape[:2] == self.bgr.shape[:2]:
+            return int(x), int(y), int(w), int(h)
+        scale_x, scale_y = self.decode_scale
+        return (int(round(x * scale_x)), int(round(y * scale_y)),
+                int(round(w * scale_x)), int(round(h * scale_y)))
+    
+    def from_original(self, x, y, w, h):
+        """Box in original pixels -> box in decoded pixels (ints)"""
+        if self.original_shape[:2] == self.bgr.shape[:2]:
+            return int(x), int(y), int(w), int(h)
+        scale_x, scale_y = self.decode_scale
+        return (int(round(x / scale_x)), int(round(y / scale_y)),
+                int(round(w / scale_x)), int(round(h / scale_y)))
+    
+    @property
+    def gray(self):
+        """Full-resolution grayscale"""
+        return self._cached('gray', lambda: cvtColor(self.bgr, COLOR_BGR2GRAY))
+    
+    @property
+    def working_scale(self):
+        """Scale factor from the original image to the working copy (<= 1.0)"""
+        h, w = self.bgr.shape[:2]
+        if max(h, w) > self.max_working_dimension:
+            return self.max_working_dimension / max(h, w)
+        return 1.0
+    
+    @property
+    def working(self):
+        """Detection working copy, limited to max_working_dimension on its longest side"""
+        def compute():
+            scale_factor = self.working_scale
+            if scale_factor < 1.0:
+                return cv2.resize(self.bgr, None, fx=scale_factor, fy=scale_factor)
+            return self.bgr
+        return self._cached('working', compute)
+    
+    @property
+    def working_gray(self):
+        """Grayscale of the working copy"""
+        def compute():
+            if self.working is self.bgr:
+                return self.gray
+            return cvtColor(self.working, COLOR_BGR2GRAY)
+        return self._cached('working_gray', compute)
+    
+    @property
+    def laplacian(self):
+        """Laplacian (CV_64F) of the full-resolution grayscale"""
+        return self._cached('laplacian', lambda: Laplacian(self.gray, CV_64F))
+    
+    @property
+    def sobel_x(self):
+        """Horizontal Sobel gradient (CV_64F, ksize=3) of the full-resolution grayscale"""
+        return self._cached('sobel_x', lambda: Sobel(self.gray, CV_64F, 1, 0, ksize=3))
+    
+    @property
+    def sobel_y(self):
+        """Vertical Sobel gradient (CV_64F, ksize=3) of the full-resolution grayscale"""
+        return self._cached('sobel_y', lambda: Sobel(self.gray, CV_64F, 0, 1, ksize=3))
+    
+    @property
+    def gray_f32(self):
+        """Full-resolution grayscale as float32"""
+        return self._cached('gray_f32', lambda: self.gray.astype(np.float32))
+
+    @property
+    def gray_sq_f32(self):
+        """Squared float32 grayscale (second moments)"""
+        return self._cached('gray_sq_f32', lambda: self.gray_f32**2)
+
+    @property
+    def gray_std(self):
+        """Standard deviation of the grayscale (global contrast)"""
+        return self._cached('gray_std', lambda: std(self.gray))
+
+    def canny(self, threshold1, threshold2):
+        """Canny edge map of the full-resolution grayscale for one threshold pair"""
+        return self._cached(('canny', threshold1, threshold2), lambda: Canny(self.gray, threshold1, threshold2))
+    
+    def local_moments(self, kernel_size):
+        """(local mean, local mean of squares) of the grayscale over a kernel_size box, float32"""
+        def compute():
+            kernel = np.ones((kernel_size, kernel_size)) / (kernel_size * kernel_size)
+            return cv2.filter2D(self.gray_f32, -1, kernel), cv2.filter2D(self.gray_sq_f32, -1, kernel)
+        return self._cached(('local_moments', kernel_size), compute)
+    
+    def quality_proxies(self, limit):
+        """(native-scale centre crop, INTER_AREA thumbnail) contexts bounded by limit
+        
+        The crop keeps the pixel scale, so per-pixel statistics (gradients, local
+        contrast, edges, noise, spectrum) estimate the full-image values; the
+        thumbnail keeps the whole frame for layout statistics (brightness blocks,
+        symmetry, eye/mouth thirds). Both report the original shape. Returns
+        (self, self) when the image already fits.
+        """
+        h, w = self.bgr.shape[:2]
+        if not limit or max(h, w) <= limit:
+            return self, self
+        def compute():
+            crop = ImageContext(centre_crop(self.bgr, limit), self.source, self.max_working_dimension,
+                                self.original_shape)
+            scale = limit / max(h, w)
+            size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+            thumbnail = ImageContext(cv2.resize(self.bgr, size, interpolation=cv2.INTER_AREA), self.source,
+                                     self.max_working_dimension, self.original_shape)
+            return crop, thumbnail
+        return self._cached(('quality_proxies', limit), compute)
+    
+    def pyramid(self, levels=3):
+        """Grayscale Gaussian pyramid [gray, 1/2, 1/4, ...] with levels + 1 entries"""
+        pyramid = self._cache.setdefault('pyramid', [self.gray])
+        while len(pyramid) <= levels and min(pyramid[-1].shape[:2]) >= 2:
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+        return pyramid[:levels + 1]
+
+class AdvancedFaceProcessor(EmbeddingComparator):
+    # StageProfiler of the running --profile request, None otherwise
+    profiler = None
+    
     def __init__(self):
         """Initialize advanced face processor with multiple detection models and feature extractors"""
+        load_vision_dependencies()
+        
         # Load multiple cascade classifiers for robust detection
         self.face_cascades = []
         self.load_cascade_models()
@@ -59,16 +399,40 @@ class AdvancedFaceProcessor:
         self.max_face_size = 1000 # Tăng từ 800 lên 1000
         self.quality_threshold = 0.05  # Giảm từ 0.15 xuống 0.05 để nhận diện mặt kém chất lượng hơn
         
+        # Default detection profile (see DETECTION_PROFILES)
+        self.detection_profile = DEFAULT_DETECTION_PROFILE
+        
+        # LBP histogram mapping ('riu2' compact uniform patterns, or 'full' raw codes)
+        self.lbp_mapping = 'riu2'
+        self._lbp_sampling_cache = {}
+        
+        # High-frequency masks per image shape (see get_frequency_mask)
+        self._frequency_mask_cache = {}
+        
+        # Variants of one image are detected on a bounded thread pool
+        # (OpenCV releases the GIL); 1 = serial
+        self.detection_workers = DEFAULT_DETECTION_WORKERS
+        self._detection_executor = None
+        self._thread_state = threading.local()
+        
         print(f"Initialized AdvancedFaceProcessor with {len(self.face_cascades)} cascade models", file=sys.stderr)
     
     def load_cascade_models(self):
         """Load multiple cascade models for robust face detection"""
+        self.face_cascades = self.create_cascade_models()
+        
+        if not self.face_cascades:
+            print("Warning: No cascade models loaded", file=sys.stderr)
+    
+    def create_cascade_models(self, verbose=True):
+        """Create a fresh list of (cascade, cascade_file) pairs"""
         cascade_files = [
             'haarcascade_frontalface_default.xml',
             'haarcascade_frontalface_alt.xml',
             'haarcascade_frontalface_alt2.xml',
             'haarcascade_profileface.xml'
         ]
+        cascades = []
         
         for cascade_file in cascade_files:
             try:
@@ -76,13 +440,37 @@ class AdvancedFaceProcessor:
                 if os.path.exists(cascade_path):
                     cascade = cv2.CascadeClassifier(cascade_path)
                     if not cascade.empty():
-                        self.face_cascades.append((cascade, cascade_file))
-                        print(f"Loaded cascade: {cascade_file}", file=sys.stderr)
+                        cascades.append((cascade, cascade_file))
+                        if verbose:
+                            print(f"Loaded cascade: {cascade_file}", file=sys.stderr)
             except Exception as e:
                 print(f"Warning: Could not load {cascade_file}: {e}", file=sys.stderr)
         
-        if not self.face_cascades:
-            print("Warning: No cascade models loaded", file=sys.stderr)
+        return cascades
+    
+    def get_thread_cascades(self):
+        """Cascades for the calling thread
+        
+        CascadeClassifier keeps per-call state, so detection worker threads each
+        load their own copy once; the main thread uses self.face_cascades.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.face_cascades
+        cascades = getattr(self._thread_state, 'face_cascades', None)
+        if cascades is None:
+            cascades = self.create_cascade_models(verbose=False)
+            self._thread_state.face_cascades = cascades
+        return cascades
+    
+    def get_detection_executor(self):
+        """Shared thread pool for per-variant detection (None = run serially)"""
+        if self.detection_workers <= 1:
+            return None
+        if self._detection_executor is None:
+            self._detection_executor = ThreadPoolExecutor(
+                max_workers=self.detection_workers, thread_name_prefix='detect'
+            )
+        return self._detection_executor
     
     def load_dnn_model(self):
         """Try to load DNN face detection model"""
@@ -96,16 +484,22 @@ class AdvancedFaceProcessor:
             print(f"Could not load DNN model: {e}", file=sys.stderr)
             self.dnn_net = None
     
-    def load_image(self, img_path: str):
-        """Enhanced image loading with better error handling"""
+    def load_image(self, img_path: str, reduction=1):
+        """Enhanced image loading with better error handling
+        
+        reduction 2, 4 or 8 decodes at that fraction of the size (IMREAD_REDUCED_COLOR_*:
+        libjpeg scales while decoding, so the full-size bitmap is never built).
+        """
         try:
             print(f"Loading image: {img_path}", file=sys.stderr)
+            read_flag = REDUCED_DECODE_FLAGS[reduction]
             
             if img_path.startswith(('http://', 'https://')):
-                # Download from URL
+                # Download from URL (urllib is imported here to keep cold start low)
+                import urllib.request
                 response = urllib.request.urlopen(img_path)
                 image_array = asarray(bytearray(response.read()), dtype=uint8)
-                img = imdecode(image_array, IMREAD_COLOR)
+                img = imdecode(image_array, read_flag)
             else:
                 # Local file
                 img_path = os.path.abspath(os.path.normpath(img_path))
@@ -119,11 +513,11 @@ class AdvancedFaceProcessor:
                 
                 # Try multiple read methods
                 try:
-                    img = imread(img_path, IMREAD_COLOR)
+                    img = imread(img_path, read_flag)
                     if img is None:
                         try:
                             file_bytes = fromfile(img_path, dtype=uint8)
-                            img = imdecode(file_bytes, IMREAD_COLOR)
+                            img = imdecode(file_bytes, read_flag)
                         except Exception:
                             pass
                 except Exception:
@@ -142,88 +536,123 @@ class AdvancedFaceProcessor:
         except Exception as e:
             return None, f"Error loading image: {str(e)}"
     
-    def detect_faces_advanced(self, img_path: str) -> dict:
-        """Enhanced face detection pipeline với multiple algorithms và quality assessment"""
-        print(f"Starting enhanced face detection pipeline for: {img_path}", file=sys.stderr)
+    def stage(self, name):
+        """Timing context for one pipeline stage; a no-op unless a profiler is attached"""
+        profiler = self.profiler
+        return profiler.stage(name) if profiler is not None else _NO_STAGE
+    
+    def plan_reduced_decode(self, img_path: str, max_dimension):
+        """(reduction, original_shape) for decoding img_path with at least max_dimension on its longest side
         
-        # Load image
-        img, error = self.load_image(img_path)
+        Only local JPEGs are decoded reduced (the header is read without decoding);
+        everything else, and images too small to halve, get (1, None).
+        """
+        if max_dimension is True:
+            max_dimension = REDUCED_DECODE_DIMENSION
+        if not max_dimension or img_path.startswith(('http://', 'https://')):
+            return 1, None
+        try:
+            with Image.open(img_path) as image:
+                if image.format != 'JPEG':
+                    return 1, None
+                width, height = image.size
+                # imread applies the EXIF orientation, the header size does not
+                if image.getexif().get(0x0112) in (5, 6, 7, 8):
+                    width, height = height, width
+        except Exception as e:
+            print(f"Could not read image header, decoding at full size: {e}", file=sys.stderr)
+            return 1, None
+        
+        for reduction in (8, 4, 2):
+            if math.ceil(max(width, height) / reduction) >= max_dimension:
+                return reduction, (height, width, 3)
+        return 1, None
+    
+    def create_image_context(self, img_path: str, reduced_decode=None):
+        """Load an image once and wrap it in an ImageContext; returns (context, error)
+        
+        With reduced_decode, large JPEGs are decoded at 1/2, 1/4 or 1/8 scale keeping at
+        least that many pixels on the longest side; the context's original_shape keeps
+        the full size so coordinates can be mapped back (ImageContext.to_original).
+        """
+        with self.stage('load'):
+            reduction, original_shape = self.plan_reduced_decode(img_path, reduced_decode)
+            img, error = self.load_image(img_path, reduction)
         if img is None:
-            print(f"[DEBUG] Could not load image: {error}", file=sys.stderr)
+            return None, error
+        if reduction > 1:
+            print(f"Decoded at 1/{reduction} scale: {img.shape} (original {original_shape})", file=sys.stderr)
+        return ImageContext(img, source=img_path, original_shape=original_shape), None
+    
+    def get_detection_profile(self, profile=None):
+        """Resolve a detection profile name (None = processor default) to (name, settings)"""
+        name = profile or self.detection_profile
+        if name not in DETECTION_PROFILES:
+            raise ValueError(f"Unknown detection profile: {name}")
+        return name, DETECTION_PROFILES[name]
+    
+    def detect_faces_advanced(self, img_path: str, context=None, profile=None, early_exit=None,
+                              reduced_decode=None) -> dict:
+        """Enhanced face detection pipeline với multiple algorithms và quality assessment
+        
+        Face boxes are reported in original pixels, also when the context was decoded reduced.
+        """
+        print(f"Starting enhanced face detection pipeline for: {img_path}", file=sys.stderr)
+        start_time = time.perf_counter()
+        
+        try:
+            profile_name, profile_settings = self.get_detection_profile(profile)
+        except ValueError as e:
             return {
                 'success': False,
-                'error': error or 'Could not load image',
+                'error': str(e),
                 'face_count': 0,
                 'faces': []
             }
         
+        # Load image (or reuse the caller's decoded context)
+        if context is None:
+            context, error = self.create_image_context(img_path, reduced_decode)
+            if context is None:
+                print(f"[DEBUG] Could not load image: {error}", file=sys.stderr)
+                return {
+                    'success': False,
+                    'error': error or 'Could not load image',
+                    'face_count': 0,
+                    'faces': []
+                }
+        img = context.bgr
+        
         try:
-            # Multi-stage preprocessing để improve detection
-            preprocessed_images = self.create_detection_variants(img)
-            # Thử thêm các biến thể xoay và tăng sáng
-            import cv2
-            import numpy as np
-            extra_variants = {}
-            for angle in [10, -10, 20, -20]:
-                (h, w) = img.shape[:2]
-                center = (w // 2, h // 2)
-                M = cv2.getRotationMatrix2D(center, angle, 1.0)
-                rotated = cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
-                extra_variants[f'rotated_{angle}'] = rotated
-            for alpha in [1.2, 1.4]:
-                bright = cv2.convertScaleAbs(img, alpha=alpha, beta=10)
-                extra_variants[f'bright_{alpha}'] = bright
-            preprocessed_images.update(extra_variants)
-
-            all_detections = []
-            detection_sources = []
-            
-            # Stage 1: Multiple detection algorithms trên original và preprocessed images
-            for variant_name, variant_img in preprocessed_images.items():
-                print(f"Running detection on variant: {variant_name}", file=sys.stderr)
-                
-                gray = cvtColor(variant_img, COLOR_BGR2GRAY)
-                
-                # Method 1: Enhanced cascade detection
-                cascade_faces = self.enhanced_cascade_detection(gray, variant_name)
-                all_detections.extend(cascade_faces)
-                detection_sources.extend([f"cascade_{variant_name}"] * len(cascade_faces))
-                
-                # Method 2: DNN detection (if available)
-                dnn_faces = self.enhanced_dnn_detection(variant_img, variant_name)
-                all_detections.extend(dnn_faces)
-                detection_sources.extend([f"dnn_{variant_name}"] * len(dnn_faces))
-                
-                # Method 3: Template-based detection
-                template_faces = self.enhanced_template_detection(gray, variant_name)
-                all_detections.extend(template_faces)
-                detection_sources.extend([f"template_{variant_name}"] * len(template_faces))
-                
-                # Method 4: Contour-based detection
-                contour_faces = self.contour_based_detection(gray, variant_name)
-                all_detections.extend(contour_faces)
-                detection_sources.extend([f"contour_{variant_name}"] * len(contour_faces))
-            
-            print(f"Total raw detections: {len(all_detections)}", file=sys.stderr)
-            
-            # Stage 2: Advanced ensemble và confidence calculation
-            ensemble_faces = self.advanced_ensemble_detection(all_detections, detection_sources, img.shape[:2])
+            if early_exit is None:
+                early_exit = profile_settings.get('early_exit', False)
+            
+            # Stages 1-2 do not depend on the filtering thresholds, so a retry with
+            # relaxed thresholds on the same context reuses them
+            ensemble_key = ('detection_ensemble', profile_name, bool(early_exit))
+            ensemble_faces, skipped_variants = context.memoize(
+                ensemble_key,
+                lambda: self.run_detection_ensemble(context, profile_settings, early_exit)
+            )
             
             # Stage 3: Quality-based filtering và ranking
-            quality_faces = self.quality_based_face_filtering(ensemble_faces, cvtColor(img, COLOR_BGR2GRAY))
+            with self.stage('quality_filter'):
+                quality_faces = self.quality_based_face_filtering(ensemble_faces, context.gray)
             
             # Stage 4: Final validation và selection
-            final_faces = self.final_face_validation(quality_faces, img)
+            with self.stage('validation'):
+                final_faces = self.final_face_validation(quality_faces, img, context.gray)
             
             face_data = []
             for i, face_info in enumerate(final_faces):
                 x, y, w, h, confidence, quality, sharpness, frontal_score = face_info
+                x, y, w, h = context.to_original(x, y, w, h)
                 face_data.append({
                     'face_id': i,
-                    'x': int(x),
-                    'y': int(y),
-                    'width': int(w),
-                    'height': int(h),
+                    'x': x,
+                    'y': y,
+                    'width': w,
+                    'height': h,
                     'confidence': float(confidence),
                     'quality_score': float(quality),
                     'sharpness_score': float(sharpness),
@@ -240,10 +669,18 @@ class AdvancedFaceProcessor:
             if len(face_data) == 0:
                 print(f"[DEBUG] No faces detected after all variants. Params: min_face_size={self.min_face_size}, quality_threshold={self.quality_threshold}", file=sys.stderr)
             
+            latency_ms = (time.perf_counter() - start_time) * 1000
+            print(f"Detection profile '{profile_name}' took {latency_ms:.1f}ms", file=sys.stderr)
+            
             return {
                 'success': True,
                 'face_count': len(face_data),
-                'faces': face_data
+                'faces': face_data,
+                'skipped_variants': skipped_variants,
+                'detection_profile': {
+                    'name': profile_name,
+                    'latency_ms': round(latency_ms, 2)
+                }
             }
             
         except Exception as e:
@@ -256,34 +693,237 @@ class AdvancedFaceProcessor:
                 'faces': []
             }
     
-    def create_detection_variants(self, img):
+    def run_detection_ensemble(self, context, profile_settings, early_exit=False):
+        """Stages 1-2 of detection: raw detections on every scheduled variant, then the ensemble
+        
+        Returns (ensemble_faces, skipped_variants).
+        """
+        img = context.bgr
+        schedule = self.plan_variant_schedule(profile_settings['variants'], early_exit)
+        
+        # Stage 1: Multiple detection algorithms trên original và preprocessed images,
+        # stage by stage in expected-yield order, stopping once the ensemble is stable
+        variant_results = {}
+        skipped_variants = []
+        stage_faces = None
+        for stage_index, stage in enumerate(schedule):
+            # Multi-stage preprocessing để improve detection (only this stage's variants)
+            with self.stage('variants'):
+                stage_images = self.build_detection_variants(context, stage)
+            variant_results.update(self.run_stage_detectors(stage_images, context, profile_settings))
+            
+            if early_exit and stage_index < len(schedule) - 1:
+                stage_detections, stage_sources = self.merge_variant_detections(variant_results)
+                with self.stage('stability_check'):
+                    stable, stage_faces = self.is_detection_ensemble_stable(
+                        stage_detections, stage_sources, img.shape[:2], stage_faces
+                    )
+                if stable:
+                    skipped_variants = [name for later in schedule[stage_index + 1:] for name in later]
+                    print(f"Ensemble stable after stage {stage_index + 1}, skipping variants: {skipped_variants}", file=sys.stderr)
+                    break
+        
+        all_detections, detection_sources = self.merge_variant_detections(variant_results)
+        
+        print(f"Total raw detections: {len(all_detections)}", file=sys.stderr)
+        
+        # Stage 2: Advanced ensemble và confidence calculation
+        with self.stage('ensemble'):
+            ensemble_faces = self.advanced_ensemble_detection(all_detections, detection_sources, img.shape[:2])
+        
+        return ensemble_faces, skipped_variants
+    
+    def build_detection_variants(self, context, variant_names=None):
+        """Build the requested detection variants in canonical order"""
+        variant_names = list(variant_names or DETECTION_VARIANT_ORDER)
+        variants = self.create_detection_variants(context.bgr, context, variant_names)
+        
+        # Thử thêm các biến thể xoay và tăng sáng (on the full-size image)
+        img = context.bgr
+        for name in variant_names:
+            if name.startswith('rotated_'):
+                angle = int(name[len('rotated_'):])
+                (h, w) = img.shape[:2]
+                center = (w // 2, h // 2)
+                M = cv2.getRotationMatrix2D(center, angle, 1.0)
+                variants[name] = cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            elif name.startswith('bright_'):
+                alpha = float(name[len('bright_'):])
+                variants[name] = cv2.convertScaleAbs(img, alpha=alpha, beta=10)
+        
+        # Keep canonical order so ensemble grouping sees detections in a stable sequence
+        return {name: variants[name] for name in DETECTION_VARIANT_ORDER if name in variants}
+    
+    def plan_variant_schedule(self, variant_names, early_exit=False):
+        """Group the requested variants into stages; one stage when early exit is off"""
+        if not early_exit:
+            return [[name for name in DETECTION_VARIANT_ORDER if name in variant_names]]
+        
+        schedule = []
+        for stage in DETECTION_VARIANT_SCHEDULE:
+            stage_variants = [name for name in stage if name in variant_names]
+            if stage_variants:
+                schedule.append(stage_variants)
+        return schedule
+    
+    def merge_variant_detections(self, variant_results):
+        """Concatenate per-variant (detections, sources) in canonical variant order"""
+        detections = []
+        sources = []
+        for name in DETECTION_VARIANT_ORDER:
+            if name in variant_results:
+                variant_detections, variant_sources = variant_results[name]
+                detections.extend(variant_detections)
+                sources.extend(variant_sources)
+        return detections, sources
+    
+    def is_detection_ensemble_stable(self, detections, sources, img_shape, previous_faces=None):
+        """Check whether the detections so far already agree on every face
+        
+        Stable means either every multi-vote group is confident and seen by several
+        variants, or the latest stage left the ensemble faces unchanged.
+        Returns (stable, ensemble_faces) so the caller can compare the next stage.
+        """
+        if not detections:
+            return False, []
+        
+        try:
+            ensemble_faces = self.advanced_ensemble_detection(detections, sources, img_shape)
+            if not ensemble_faces:
+                return False, ensemble_faces
+            
+            # Agreement across variants: no face rests on a single variant or low confidence
+            agreed = True
+            for group_detections, group_sources in self.improved_detection_grouping(detections, sources):
+                if len(group_detections) >= 2:
+                    ensemble_face = self.calculate_weighted_ensemble_face(group_detections, group_sources)
+                    variants = {source.split('_', 1)[1] for source in group_sources if '_' in source}
+                    if ensemble_face[4] < EARLY_EXIT_MIN_CONFIDENCE or len(variants) < EARLY_EXIT_MIN_VARIANTS:
+                        agreed = False
+                        break
+                elif len(group_detections[0]) >= 5 and group_detections[0][4] > 0.75:
+                    # A lone high-confidence detection would still become a face: not settled
+                    agreed = False
+                    break
+            if agreed:
+                return True, ensemble_faces
+            
+            # Agreement across stages: the last stage neither added nor moved a face
+            if previous_faces is None or len(previous_faces) != len(ensemble_faces):
+                return False, ensemble_faces
+            overlaps = self.calculate_overlap_matrix(np.array(ensemble_faces)[:, :4], np.array(previous_faces)[:, :4])
+            stable = bool(np.all(overlaps.max(axis=1) >= EARLY_EXIT_MIN_STAGE_IOU))
+            return stable, ensemble_faces
+        
+        except Exception as e:
+            print(f"Ensemble stability check error: {e}", file=sys.stderr)
+            return False, []
+    
+    def run_stage_detectors(self, stage_images, context, profile_settings):
+        """Run detectors on every variant of a stage, in parallel when a pool is configured
+        
+        Returns {variant_name: (detections, sources)}; callers merge in canonical
+        order, so the result does not depend on which thread finishes first.
+        """
+        executor = self.get_detection_executor() if len(stage_images) > 1 else None
+        if executor is None:
+            return {
+                variant_name: self.run_variant_detectors(variant_name, variant_img, context, profile_settings)
+                for variant_name, variant_img in stage_images.items()
+            }
+        
+        futures = {
+            variant_name: executor.submit(self.run_variant_detectors, variant_name, variant_img, context, profile_settings)
+            for variant_name, variant_img in stage_images.items()
+        }
+        return {variant_name: future.result() for variant_name, future in futures.items()}
+    
+    def run_variant_detectors(self, variant_name, variant_img, context, profile_settings):
+        """Run the profile's detectors on one variant; returns (detections, sources)"""
+        print(f"Running detection on variant: {variant_name}", file=sys.stderr)
+        detectors = profile_settings['detectors']
+        detections = []
+        sources = []
+        
+        if variant_name == 'original' and variant_img is context.working:
+            gray = context.working_gray
+        else:
+            gray = cvtColor(variant_img, COLOR_BGR2GRAY)
+        
+        # Method 1: Enhanced cascade detection
+        if 'cascade' in detectors:
+            with self.stage(f'detect.{variant_name}.cascade'):
+                cascade_faces = self.enhanced_cascade_detection(
+                    gray, variant_name,
+                    cascade_names=profile_settings.get('cascades'),
+                    parameter_set_count=profile_settings.get('cascade_parameter_sets')
+                )
+            detections.extend(cascade_faces)
+            sources.extend([f"cascade_{variant_name}"] * len(cascade_faces))
+        
+        # Method 2: DNN detection (if available)
+        if 'dnn' in detectors:
+            with self.stage(f'detect.{variant_name}.dnn'):
+                dnn_faces = self.enhanced_dnn_detection(variant_img, variant_name)
+            detections.extend(dnn_faces)
+            sources.extend([f"dnn_{variant_name}"] * len(dnn_faces))
+        
+        # Method 3: Template-based detection
+        if 'template' in detectors:
+            with self.stage(f'detect.{variant_name}.template'):
+                template_faces = self.enhanced_template_detection(gray, variant_name)
+            detections.extend(template_faces)
+            sources.extend([f"template_{variant_name}"] * len(template_faces))
+        
+        # Method 4: Contour-based detection
+        if 'contour' in detectors:
+            with self.stage(f'detect.{variant_name}.contour'):
+                contour_faces = self.contour_based_detection(gray, variant_name)
+            detections.extend(contour_faces)
+            sources.extend([f"contour_{variant_name}"] * len(contour_faces))
+        
+        # Working-copy variants are detected downscaled: boxes back to decoded-image pixels,
+        # the space of the full-size variants, filtering, validation and face crops
+        if variant_img.shape[:2] != context.shape[:2]:
+            scale = 1.0 / context.working_scale
+            detections = [
+                (int(round(d[0] * scale)), int(round(d[1] * scale)),
+                 int(round(d[2] * scale)), int(round(d[3] * scale))) + tuple(d[4:])
+                for d in detections
+            ]
+        
+        return detections, sources
+    
+    def create_detection_variants(self, img, context=None, variant_names=None):
         """Create multiple detection variants - optimized for performance"""
         variants = {}
+        wanted = set(variant_names or ('original', 'enhanced_contrast', 'brighter'))
         
         try:
             # Limit image size to prevent memory issues
-            h, w = img.shape[:2]
-            max_dimension = 1200  # Reduced from unlimited
+            if context is None:
+                context = ImageContext(img)
+            if context.working_scale < 1.0:
+                print(f"Resized image to: {context.working.shape}", file=sys.stderr)
+            img = context.working
             
-            if max(h, w) > max_dimension:
-                scale_factor = max_dimension / max(h, w)
-                img = cv2.resize(img, None, fx=scale_factor, fy=scale_factor)
-                print(f"Resized image to: {img.shape}", file=sys.stderr)
-            
-            # Original image
-            variants['original'] = img.copy()
+            # Original image (the working copy is shared read-only, no copy needed)
+            if 'original' in wanted:
+                variants['original'] = img
             
             # Enhanced contrast variant only (most effective)
-            lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-            lab[:,:,0] = cv2.equalizeHist(lab[:,:,0])
-            enhanced = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
-            variants['enhanced_contrast'] = enhanced
+            if 'enhanced_contrast' in wanted:
+                lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+                lab[:,:,0] = cv2.equalizeHist(lab[:,:,0])
+                enhanced = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+                variants['enhanced_contrast'] = enhanced
             
             # Only one brightness variant (most balanced)
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            hsv_bright = hsv.copy()
-            hsv_bright[:,:,2] = cv2.add(hsv_bright[:,:,2], 20)  # Reduced from 30
-            variants['brighter'] = cv2.cvtColor(hsv_bright, cv2.COLOR_HSV2BGR)
+            if 'brighter' in wanted:
+                hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+                hsv_bright = hsv.copy()
+                hsv_bright[:,:,2] = cv2.add(hsv_bright[:,:,2], 20)  # Reduced from 30
+                variants['brighter'] = cv2.cvtColor(hsv_bright, cv2.COLOR_HSV2BGR)
             
             print(f"Created {len(variants)} optimized detection variants", file=sys.stderr)
             
@@ -299,11 +939,17 @@ class AdvancedFaceProcessor:
         table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
         return cv2.LUT(image, table)
     
-    def enhanced_cascade_detection(self, gray_img, variant_name):
-        """Enhanced cascade detection với conservative parameters"""
+    def enhanced_cascade_detection(self, gray_img, variant_name, cascade_names=None, parameter_set_count=None):
+        """Enhanced cascade detection với conservative parameters
+        
+        cascade_names limits which loaded cascades run (None = all) and
+        parameter_set_count how many of the parameter sets are tried (None = all).
+        """
         detections = []
         
-        for cascade, cascade_name in self.face_cascades:
+        for cascade, cascade_name in self.get_thread_cascades():
+            if cascade_names is not None and cascade_name not in cascade_names:
+                continue
             try:
                 # More conservative parameters - ít detection hơn nhưng chính xác hơn
                 if 'enhanced' in variant_name or 'gamma' in variant_name:
@@ -319,7 +965,7 @@ class AdvancedFaceProcessor:
                         {'scaleFactor': 1.2, 'minNeighbors': 6, 'minSize': (50, 50), 'maxSize': (250, 250)},
                     ]
                 
-                for params in parameter_sets:
+                for params in parameter_sets[:parameter_set_count]:
                     faces = cascade.detectMultiScale(gray_img, **params)
                     for (x, y, w, h) in faces:
                         # Enhanced confidence calculation
@@ -699,7 +1345,8 @@ class AdvancedFaceProcessor:
                         ensemble_faces.append(detection)
             
             # Apply advanced NMS
-            final_faces = self.apply_advanced_nms(ensemble_faces, img_shape)
+            with self.stage('nms'):
+                final_faces = self.apply_advanced_nms(ensemble_faces, img_shape)
             
             print(f"Ensemble: {len(detections)} -> {len(grouped_detections)} groups -> {len(final_faces)} final faces", file=sys.stderr)
             
@@ -710,45 +1357,47 @@ class AdvancedFaceProcessor:
             return []
     
     def improved_detection_grouping(self, detections, sources, overlap_threshold=0.35):
-        """Improved detection grouping với source awareness"""
+        """Improved detection grouping với source awareness (vectorized IoU matrix)"""
         grouped = []
-        used = set()
+        n = len(detections)
+        if n == 0:
+            return grouped
+        
+        boxes = np.array([det[:4] for det in detections], dtype=np.float64)
+        overlaps = self.calculate_overlap_matrix(boxes, boxes)
+        
+        # Detection type prefix (cascade/template/contour/...) encoded as ints
+        source_types = [source.split('_')[0] for source in sources]
+        type_codes = {name: code for code, name in enumerate(dict.fromkeys(source_types))}
+        source_codes = np.array([type_codes[name] for name in source_types])
         
-        for i, det1 in enumerate(detections):
-            if i in used:
+        confidences = np.array([det[4] if len(det) > 4 else np.nan for det in detections], dtype=np.float64)
+        
+        used = np.zeros(n, dtype=bool)
+        
+        for i in range(n):
+            if used[i]:
                 continue
             
-            group_detections = [det1]
-            group_sources = [sources[i]]
-            used.add(i)
+            used[i] = True
             
-            for j, det2 in enumerate(detections):
-                if j in used or i == j:
-                    continue
-                
-                # Calculate overlap
-                overlap = self.calculate_overlap(det1[:4], det2[:4])
-                
-                # Adaptive overlap threshold based on detection sources
-                adaptive_threshold = overlap_threshold
-                
-                # Lower threshold for same-source detections
-                if sources[i].split('_')[0] == sources[j].split('_')[0]:
-                    adaptive_threshold += 0.1
-                
-                # Higher confidence detections get more generous grouping
-                if len(det1) > 4 and len(det2) > 4:
-                    avg_confidence = (det1[4] + det2[4]) / 2
-                    if avg_confidence > 0.7:
-                        adaptive_threshold -= 0.05
-                
-                if overlap > adaptive_threshold:
-                    group_detections.append(det2)
-                    group_sources.append(sources[j])
-                    used.add(j)
+            # Adaptive overlap threshold based on detection sources
+            adaptive_threshold = np.full(n, overlap_threshold)
             
-            if len(group_detections) > 0:
-                grouped.append((group_detections, group_sources))
+            # Lower threshold for same-source detections
+            same_source = source_codes == source_codes[i]
+            adaptive_threshold = np.where(same_source, adaptive_threshold + 0.1, adaptive_threshold)
+            
+            # Higher confidence detections get more generous grouping
+            avg_confidence = (confidences[i] + confidences) / 2
+            adaptive_threshold = np.where(avg_confidence > 0.7, adaptive_threshold - 0.05, adaptive_threshold)
+            
+            members = np.flatnonzero(~used & (overlaps[i] > adaptive_threshold))
+            used[members] = True
+            
+            group_detections = [detections[i]] + [detections[j] for j in members]
+            group_sources = [sources[i]] + [sources[j] for j in members]
+            grouped.append((group_detections, group_sources))
         
         return grouped
     
@@ -843,33 +1492,36 @@ class AdvancedFaceProcessor:
                     
                     scored_detections.append((detection, composite_score))
             
-            # Sort by composite score (highest first)
-            scored_detections.sort(key=lambda x: x[1], reverse=True)
+            if not scored_detections:
+                return []
+            
+            # Sort by composite score (highest first, stable for ties)
+            scores = np.array([score for _, score in scored_detections], dtype=np.float64)
+            order = np.argsort(-scores, kind='stable')
+            ordered = [scored_detections[k][0] for k in order]
+            scores = scores[order]
+            
+            boxes = np.array([detection[:4] for detection in ordered], dtype=np.float64)
+            overlaps = self.calculate_overlap_matrix(boxes, boxes)
             
             # NMS with quality awareness
             keep = []
-            while scored_detections:
-                # Keep the highest scored detection
-                current_detection, current_score = scored_detections.pop(0)
-                keep.append(current_detection)
+            alive = np.ones(len(ordered), dtype=bool)
+            for current in range(len(ordered)):
+                if not alive[current]:
+                    continue
                 
-                # Remove overlapping detections
-                remaining = []
-                for detection, score in scored_detections:
-                    overlap = self.calculate_overlap(current_detection[:4], detection[:4])
-                    
-                    # Adaptive threshold based on quality difference
-                    adaptive_threshold = overlap_threshold
-                    score_diff = abs(current_score - score)
-                    
-                    # If scores are very different, be more lenient
-                    if score_diff > 0.3:
-                        adaptive_threshold += 0.1
-                    
-                    if overlap < adaptive_threshold:
-                        remaining.append((detection, score))
+                # Keep the highest scored remaining detection
+                keep.append(ordered[current])
+                alive[current] = False
+                
+                # Adaptive threshold based on quality difference:
+                # if scores are very different, be more lenient
+                score_diff = np.abs(scores[current] - scores)
+                adaptive_threshold = np.where(score_diff > 0.3, overlap_threshold + 0.1, overlap_threshold)
                 
-                scored_detections = remaining
+                # Remove overlapping detections
+                alive &= overlaps[current] < adaptive_threshold
             
             return keep
             
@@ -957,6 +1609,43 @@ class AdvancedFaceProcessor:
         # Return IoU
         return intersection / union
     
+    def calculate_overlap_matrix(self, boxes1, boxes2, block_elements=1 << 18):
+        """Pairwise IoU between two (N, 4) arrays of x, y, w, h boxes in one shot"""
+        boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+        boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+        overlaps = np.zeros((len(boxes1), len(boxes2)), dtype=np.float64)
+        if overlaps.size == 0:
+            return overlaps
+        
+        x2, y2, w2, h2 = boxes2.T
+        right2, bottom2, area2 = x2 + w2, y2 + h2, w2 * h2
+        
+        # Row blocks keep the temporaries cache-sized for thousands of boxes
+        rows_per_block = max(1, block_elements // len(boxes2))
+        for start in range(0, len(boxes1), rows_per_block):
+            x1, y1, w1, h1 = (boxes1[start:start + rows_per_block, k:k + 1] for k in range(4))
+            
+            # Intersection width/height, clipped at zero when boxes do not overlap
+            inter_w = np.minimum(x1 + w1, right2)
+            inter_w -= np.maximum(x1, x2)
+            np.maximum(inter_w, 0, out=inter_w)
+            
+            inter_h = np.minimum(y1 + h1, bottom2)
+            inter_h -= np.maximum(y1, y2)
+            np.maximum(inter_h, 0, out=inter_h)
+            
+            intersection = inter_w
+            intersection *= inter_h
+            
+            # Union area
+            union = (w1 * h1) + area2
+            union -= intersection
+            
+            # Avoid division by zero
+            np.divide(intersection, union, out=overlaps[start:start + rows_per_block], where=union > 0)
+        
+        return overlaps
+    
     def quality_based_face_filtering(self, faces, gray_img):
         """Enhanced quality-based face filtering với multiple metrics - more permissive version"""
         quality_faces = []
@@ -1128,13 +1817,15 @@ class AdvancedFaceProcessor:
         except:
             return 0.5
     
-    def final_face_validation(self, quality_faces, img):
+    def final_face_validation(self, quality_faces, img, gray_img=None):
         """Final validation và ranking của detected faces - more permissive version"""
         if not quality_faces:
             return []
         
         try:
             validated_faces = []
+            # Grayscale once for all faces (callers with an ImageContext pass it in)
+            gray = gray_img if gray_img is not None else cvtColor(img, COLOR_BGR2GRAY)
             
             for face_info in quality_faces:
                 if len(face_info) < 8:
@@ -1162,7 +1853,6 @@ class AdvancedFaceProcessor:
                     validation_passed = False
                 
                 # Additional face region analysis - more permissive
-                gray = cvtColor(img, COLOR_BGR2GRAY)
                 face_roi = gray[y:y+h, x:x+w]
                 
                 if face_roi.size > 0:
@@ -1211,11 +1901,12 @@ class AdvancedFaceProcessor:
             # In case of error, return all quality faces
             return quality_faces
     
-    def extract_advanced_embeddings(self, img_path: str) -> dict:
-        """Extract face embeddings with advanced logic, always return embeddings even for low quality faces"""
-        detection_result = self.detect_faces_advanced(img_path)
+    def detect_faces_for_embedding(self, img_path: str, context, profile=None, early_exit=None) -> dict:
+        """detect_faces_advanced, retried with permissive thresholds when nothing is found"""
+        detection_result = self.detect_faces_advanced(img_path, context, profile, early_exit)
         
         # If no faces detected, try with more permissive settings
+        # (only filtering is re-run: detections are cached on the shared context)
         if not detection_result['success'] or detection_result['face_count'] == 0:
             print(f"[DEBUG] No faces detected with standard settings, trying with more permissive settings", file=sys.stderr)
             # Temporarily lower thresholds even more
@@ -1225,11 +1916,30 @@ class AdvancedFaceProcessor:
             try:
                 self.min_face_size = 8  # Extremely permissive
                 self.quality_threshold = 0.01  # Extremely permissive
-                detection_result = self.detect_faces_advanced(img_path)
+                detection_result = self.detect_faces_advanced(img_path, context, profile, early_exit)
             finally:
                 # Restore original settings
                 self.min_face_size = original_min_face_size
                 self.quality_threshold = original_quality_threshold
+        return detection_result
+    
+    def extract_advanced_embeddings(self, img_path: str, profile=None, early_exit=None,
+                                    context=None, detection_result=None, reduced_decode=None) -> dict:
+        """Extract face embeddings with advanced logic, always return embeddings even for low quality faces"""
+        # Decode once; detection passes and every face crop share this context
+        if context is None:
+            context, error = self.create_image_context(img_path, reduced_decode)
+            if context is None:
+                print(f"[DEBUG] Could not load image: {error}", file=sys.stderr)
+                return {
+                    'success': False,
+                    'face_count': 0,
+                    'embeddings': [],
+                    'extraction_info': error or 'Could not load image'
+                }
+        
+        if detection_result is None:
+            detection_result = self.detect_faces_for_embedding(img_path, context, profile, early_exit)
         
         # If still no faces detected, return error
         if not detection_result['success'] or detection_result['face_count'] == 0:
@@ -1248,17 +1958,16 @@ class AdvancedFaceProcessor:
             
             embeddings = []
             for face in faces:
-                x, y, w, h = face['x'], face['y'], face['width'], face['height']
+                # Detection reports original pixels, the crop is taken from the decoded image
+                x, y, w, h = context.from_original(face['x'], face['y'], face['width'], face['height'])
                 quality = face.get('quality_score', 0)
                 overall = face.get('overall_score', 0)
                 sharpness = face.get('sharpness_score', 0)
                 
                 print(f"[DEBUG] Face region: x={x}, y={y}, w={w}, h={h}, quality={quality}, overall={overall}, sharpness={sharpness}", file=sys.stderr)
                 
-                # Load image and extract face region
-                img, _ = self.load_image(img_path)
-                if img is None:
-                    continue
+                # Extract face region from the shared decoded image
+                img = context.bgr
                     
                 # Ensure coordinates are within bounds
                 h, w_img, _ = img.shape if len(img.shape) == 3 else (img.shape[0], img.shape[1], 1)
@@ -1274,7 +1983,8 @@ class AdvancedFaceProcessor:
                 face_img = img[y:y+h, x:x+w]
                 
                 # Always extract embedding, just add warning if quality is low
-                emb = self.extract_enhanced_face_features(face_img, quality)
+                with self.stage('embedding'):
+                    emb = self.extract_enhanced_face_features(face_img, quality)
                 
                 # If embedding extraction failed, try with basic features
                 if emb is None or len(emb) == 0:
@@ -1287,9 +1997,15 @@ class AdvancedFaceProcessor:
                     # Use placeholder embedding (all zeros) as last resort
                     emb = [0.0] * 128
                 
+                # Precomputed once so every later comparison can skip them
+                with self.stage('embedding_stats'):
+                    stats = self.compute_embedding_stats(emb)
+                
+                x, y, w, h = context.to_original(x, y, w, h)
                 embeddings.append({
                     'face_id': face['face_id'],
                     'embedding': emb,
+                    'stats': stats,
                     'region': {'x': x, 'y': y, 'w': w, 'h': h},
                     'quality': quality,
                     'overall': overall,
@@ -1303,7 +2019,9 @@ class AdvancedFaceProcessor:
                 'success': True,
                 'face_count': len(embeddings),
                 'embeddings': embeddings,
-                'extraction_info': 'OK' if len(embeddings) > 0 else 'No quality embeddings found'
+                'extraction_info': 'OK' if len(embeddings) > 0 else 'No quality embeddings found',
+                'skipped_variants': detection_result.get('skipped_variants', []),
+                'detection_profile': detection_result.get('detection_profile')
             }
         except Exception as e:
             print(f"[DEBUG] Embedding extraction error: {str(e)}", file=sys.stderr)
@@ -1314,6 +2032,54 @@ class AdvancedFaceProcessor:
                 'extraction_info': f'Embedding extraction error: {str(e)}'
             }
     
+    def analyze_image(self, img_path: str, profile=None, early_exit=None, quality_metrics=None,
+                      quality_proxy=None, reduced_decode=None) -> dict:
+        """Detection, embeddings and quality assessment over one decoded ImageContext
+        
+        Same faces/embeddings as extract_advanced_embeddings and the same block as
+        assess_quality_advanced, but grayscale, Laplacian/Sobel/Canny maps and the
+        detection ensemble are computed once for all three. With reduced_decode the
+        quality metrics are scored on the reduced image (resolution from the original size).
+        """
+        context, error = self.create_image_context(img_path, reduced_decode)
+        if context is None:
+            print(f"[DEBUG] Could not load image: {error}", file=sys.stderr)
+            return {
+                'success': False,
+                'error': error or 'Could not load image',
+                'face_count': 0,
+                'faces': [],
+                'embeddings': [],
+                'quality_score': 0
+            }
+        
+        detection_result = self.detect_faces_for_embedding(img_path, context, profile, early_exit)
+        if not detection_result['success']:
+            return {
+                'success': False,
+                'error': detection_result.get('error', 'Face detection failed'),
+                'face_count': 0,
+                'faces': [],
+                'embeddings': [],
+                'quality_score': 0
+            }
+        
+        # No faces is still a valid analysis: embeddings stay empty, quality is reported
+        extraction = self.extract_advanced_embeddings(img_path, profile, early_exit, context, detection_result)
+        quality = self.assess_quality_advanced(img_path, context, quality_metrics, quality_proxy)
+        
+        return {
+            'success': True,
+            'face_count': extraction['face_count'],
+            'faces': detection_result['faces'],
+            'embeddings': extraction['embeddings'],
+            'extraction_info': extraction['extraction_info'],
+            'skipped_variants': detection_result.get('skipped_variants', []),
+            'detection_profile': detection_result.get('detection_profile'),
+            'quality_score': quality.get('quality_score', 0),
+            'quality': quality
+        }
+    
     def select_best_faces_for_embedding(self, detected_faces, gray_img):
         """Always return all faces for embedding, just warn if quality is low"""
         # This function is now a passthrough, just returns all faces
@@ -1439,7 +2205,8 @@ class AdvancedFaceProcessor:
             weighted_features = [f * quality_weight for f in features]
             
             # Add quality-specific features
-            quality_features = self.extract_quality_aware_features(face_img, quality_score)
+            with self.stage('features.quality_aware'):
+                quality_features = self.extract_quality_aware_features(face_img, quality_score)
             weighted_features.extend(quality_features)
             
             # Final normalization
@@ -1696,31 +2463,38 @@ class AdvancedFaceProcessor:
             standard_size = (128, 128)
             
             # Preprocessing pipeline for better feature extraction
-            face_preprocessed = self.preprocess_face_for_features(face_roi)
-            face_normalized = resize(face_preprocessed, standard_size)
+            with self.stage('features.preprocess'):
+                face_preprocessed = self.preprocess_face_for_features(face_roi)
+                face_normalized = resize(face_preprocessed, standard_size)
             
             # 1. Enhanced multi-scale histogram features with normalization
-            hist_features = self.extract_enhanced_histograms(face_normalized)
+            with self.stage('features.histograms'):
+                hist_features = self.extract_enhanced_histograms(face_normalized)
             features.extend(hist_features)
             
             # 2. Normalized HOG features
-            hog_features = self.extract_normalized_hog_features(face_normalized)
+            with self.stage('features.hog'):
+                hog_features = self.extract_normalized_hog_features(face_normalized)
             features.extend(hog_features)
             
             # 3. Robust LBP features với uniform patterns
-            lbp_features = self.extract_robust_lbp_features(face_normalized)
+            with self.stage('features.lbp'):
+                lbp_features = self.extract_robust_lbp_features(face_normalized)
             features.extend(lbp_features)
             
             # 4. Enhanced geometric features
-            geo_features = self.extract_enhanced_geometric_features(face_normalized)
+            with self.stage('features.geometric'):
+                geo_features = self.extract_enhanced_geometric_features(face_normalized)
             features.extend(geo_features)
             
             # 5. Advanced texture and gradient features  
-            texture_features = self.extract_advanced_texture_features(face_normalized)
+            with self.stage('features.texture'):
+                texture_features = self.extract_advanced_texture_features(face_normalized)
             features.extend(texture_features)
             
             # 6. NEW: Deep-inspired features (mimicking CNN-style features)
-            deep_features = self.extract_deep_inspired_features(face_normalized)
+            with self.stage('features.deep'):
+                deep_features = self.extract_deep_inspired_features(face_normalized)
             features.extend(deep_features)
             
             # Normalize entire feature vector để consistent comparison
@@ -1865,11 +2639,21 @@ class AdvancedFaceProcessor:
         
         return features
     
-    def extract_robust_lbp_features(self, face_img):
-        """Robust LBP features với uniform patterns"""
+    def extract_robust_lbp_features(self, face_img, mapping=None):
+        """Robust LBP features với uniform patterns
+        
+        mapping='riu2' (default) gives rotation-invariant uniform histograms with
+        P + 2 bins per configuration; mapping='full' keeps one bin per raw code (2^P).
+        """
         features = []
+        mapping = mapping or self.lbp_mapping
         
         try:
+            if face_img.ndim != 2:
+                # Only single-channel faces are supported; colour crops keep an empty LBP block
+                print(f"Robust LBP skipped for {face_img.ndim}-D input, expected grayscale", file=sys.stderr)
+                return features
+            
             h, w = face_img.shape[:2]
             
             # Multiple LBP configurations
@@ -1883,29 +2667,17 @@ class AdvancedFaceProcessor:
                 radius = config['radius']
                 n_points = config['points']
                 
-                # Simple LBP implementation
-                lbp_image = zeros((h, w), dtype=uint8)
-                
-                for i in range(radius, h - radius):
-                    for j in range(radius, w - radius):
-                        center = face_img[i, j]
-                        code = 0
-                        
-                        # Sample points trong circle
-                        for p in range(n_points):
-                            angle = 2 * math.pi * p / n_points
-                            x = int(j + radius * math.cos(angle))
-                            y = int(i + radius * math.sin(angle))
-                            
-                            if 0 <= x < w and 0 <= y < h:
-                                if face_img[y, x] >= center:
-                                    code |= (1 << p)
-                        
-                        lbp_image[i, j] = code
+                if mapping == 'riu2':
+                    labels = self.compute_lbp_riu2_labels(face_img, radius, n_points)
+                    hist_lbp = np.bincount(labels.ravel(), minlength=n_points + 2)
+                else:
+                    # Border pixels keep code 0, as in the original per-pixel implementation
+                    lbp_image = np.zeros((h, w), dtype=np.uint32)
+                    lbp_image[radius:h - radius, radius:w - radius] = self.compute_lbp_codes(face_img, radius, n_points)
+                    hist_lbp = np.bincount(lbp_image.ravel(), minlength=2 ** n_points)
                 
                 # Calculate LBP histogram với normalization
-                max_val = 2 ** n_points
-                hist_lbp = calcHist([lbp_image], [0], None, [max_val], [0, max_val])
+                hist_lbp = hist_lbp.astype(np.float32).reshape(-1, 1)
                 hist_lbp_norm = hist_lbp / (np.linalg.norm(hist_lbp) + 1e-7)
                 features.extend(hist_lbp_norm.flatten().tolist())
             
@@ -1914,6 +2686,62 @@ class AdvancedFaceProcessor:
         
         return features
     
+    def get_lbp_sampling_indices(self, h, w, radius, n_points):
+        """Precomputed neighbour row/column indices for every circular sample point
+        
+        Uses the same int() truncation of (i + r*sin, j + r*cos) as the original
+        per-pixel loop, so codes are identical. Cached per (shape, radius, points).
+        """
+        key = (h, w, radius, n_points)
+        indices = self._lbp_sampling_cache.get(key)
+        if indices is None:
+            rows = np.arange(radius, h - radius)
+            cols = np.arange(radius, w - radius)
+            indices = []
+            for p in range(n_points):
+                angle = 2 * math.pi * p / n_points
+                ys = (rows + radius * math.sin(angle)).astype(np.intp)
+                xs = (cols + radius * math.cos(angle)).astype(np.intp)
+                indices.append((ys[:, None], xs[None, :]))
+            self._lbp_sampling_cache[key] = indices
+        return indices
+    
+    def compute_lbp_bit_planes(self, gray_img, radius, n_points):
+        """Yield one boolean plane per sample point: neighbour >= center over the interior"""
+        h, w = gray_img.shape[:2]
+        center = gray_img[radius:h - radius, radius:w - radius]
+        for ys, xs in self.get_lbp_sampling_indices(h, w, radius, n_points):
+            yield gray_img[ys, xs] >= center
+    
+    def compute_lbp_codes(self, gray_img, radius, n_points):
+        """Circular LBP codes for the interior pixels via shifted-array comparisons"""
+        h, w = gray_img.shape[:2]
+        codes = np.zeros((max(0, h - 2 * radius), max(0, w - 2 * radius)), dtype=np.uint32)
+        for p, bits in enumerate(self.compute_lbp_bit_planes(gray_img, radius, n_points)):
+            codes |= bits.astype(np.uint32) << np.uint32(p)
+        return codes
+    
+    def compute_lbp_riu2_labels(self, gray_img, radius, n_points):
+        """Rotation-invariant uniform LBP labels (0..P uniform, P+1 non-uniform) for the interior"""
+        h, w = gray_img.shape[:2]
+        shape = (max(0, h - 2 * radius), max(0, w - 2 * radius))
+        ones = np.zeros(shape, dtype=np.int32)
+        transitions = np.zeros(shape, dtype=np.int32)
+        
+        first = previous = None
+        for bits in self.compute_lbp_bit_planes(gray_img, radius, n_points):
+            ones += bits
+            if previous is None:
+                first = bits
+            else:
+                transitions += bits != previous
+            previous = bits
+        if previous is not None:
+            # Close the circle between the last and the first sample point
+            transitions += previous != first
+        
+        return np.where(transitions <= 2, ones, n_points + 1)
+    
     def extract_enhanced_geometric_features(self, face_img):
         """Enhanced geometric features"""
         features = []
@@ -2142,500 +2970,6 @@ class AdvancedFaceProcessor:
             print(f"Feature normalization error: {e}", file=sys.stderr)
             return [0.0] * len(features)
     
-    def compare_faces_advanced(self, embedding1: list, embedding2: list) -> dict:
-        """Advanced face comparison using multiple similarity metrics with cross-validation"""
-        try:
-            if not embedding1 or not embedding2:
-                return {
-                    'success': False,
-                    'error': 'Invalid embeddings provided',
-                    'similarity': 0.0,
-                    'distance': 1.0,
-                    'confidence': 0.0
-                }
-            
-            # Ensure embeddings have same length
-            min_len = min(len(embedding1), len(embedding2))
-            emb1 = np.array(embedding1[:min_len])
-            emb2 = np.array(embedding2[:min_len])
-            
-            # CROSS-VALIDATION: Split embeddings and test consistency with stricter checks
-            cross_validation_result = self.cross_validate_similarity(emb1, emb2)
-            
-            if not cross_validation_result['is_consistent']:
-                print(f"Cross-validation FAILED: {cross_validation_result['reason']}", file=sys.stderr)
-                return {
-                    'success': True,
-                    'similarity': 0.0,
-                    'distance': 1.0,
-                    'confidence': 0.0,
-                    'cross_validation': cross_validation_result
-                }
-            
-            # Enhanced similarity metrics with robust computation
-            similarities = []
-            
-            # 1. Cosine similarity with multiple normalizations
-            cosine_sim = self.robust_cosine_similarity(emb1, emb2)
-            similarities.append(('cosine', cosine_sim, 0.35))  
-            
-            # 2. Pearson correlation with outlier handling
-            pearson_sim = self.robust_pearson_correlation(emb1, emb2)
-            similarities.append(('pearson', pearson_sim, 0.2))
-            
-            # 3. Euclidean similarity with adaptive scaling
-            euclidean_sim = self.adaptive_euclidean_similarity(emb1, emb2)
-            similarities.append(('euclidean', euclidean_sim, 0.2))
-            
-            # 4. Manhattan similarity with outlier rejection
-            manhattan_sim = self.robust_manhattan_similarity(emb1, emb2)
-            similarities.append(('manhattan', manhattan_sim, 0.1))
-            
-            # 5. Chi-square similarity for histogram features
-            chi_square_sim = self.robust_chi_square_similarity(emb1, emb2)
-            similarities.append(('chi_square', chi_square_sim, 0.1))
-            
-            # 6. Structural similarity (inspired by SSIM)
-            structural_sim = self.structural_similarity(emb1, emb2)
-            similarities.append(('structural', structural_sim, 0.05))
-            
-            # ADAPTIVE weighted ensemble based on feature quality
-            total_weight = sum(weight for _, _, weight in similarities)
-            weighted_similarity = sum(sim * weight for _, sim, weight in similarities) / total_weight
-            
-            # ENHANCED confidence calculation with outlier detection
-            confidence = self.calculate_enhanced_confidence(similarities, cross_validation_result)
-            
-            # ADAPTIVE thresholds based on embedding characteristics
-            adaptive_adjustments = self.calculate_adaptive_adjustments(emb1, emb2)
-            
-            # Apply adaptive adjustments
-            final_similarity = weighted_similarity * adaptive_adjustments['similarity_boost']
-            final_confidence = confidence * adaptive_adjustments['confidence_boost']
-            
-            # STRICTER quality gates with higher adaptive thresholds
-            quality_threshold = 0.42 + adaptive_adjustments['threshold_adjustment']  # Increased from 0.3
-            if final_similarity < quality_threshold:
-                final_similarity = 0.0
-                final_confidence = 0.0
-            
-            distance = 1.0 - final_similarity
-            
-            print(f"Advanced similarity metrics: {[(name, sim) for name, sim, _ in similarities]}", file=sys.stderr)
-            print(f"Weighted: {weighted_similarity:.3f}, Confidence: {confidence:.3f}, Final: {final_similarity:.3f}", file=sys.stderr)
-            print(f"Adaptive adjustments: {adaptive_adjustments}", file=sys.stderr)
-            
-            return {
-                'success': True,
-                'similarity': float(max(0.0, min(1.0, final_similarity))),
-                'distance': float(distance),
-                'confidence': float(max(0.0, min(1.0, final_confidence))),
-                'detailed_similarities': {name: float(sim) for name, sim, _ in similarities},
-                'cross_validation': cross_validation_result,
-                'adaptive_adjustments': adaptive_adjustments
-            }
-            
-        except Exception as e:
-            return {
-                'success': False,
-                'error': f"Advanced comparison error: {str(e)}",
-                'similarity': 0.0,
-                'distance': 1.0,
-                'confidence': 0.0
-            }
-    
-    def cross_validate_similarity(self, emb1, emb2):
-        """Cross-validation to test consistency of similarity with stricter validation"""
-        try:
-            # Split embeddings into multiple segments to test consistency
-            segments = 5  # Increased from 4 to 5 for more robust validation
-            segment_size = len(emb1) // segments
-            
-            if segment_size < 10:  # Too small to split reliably
-                return {
-                    'is_consistent': True,
-                    'reason': 'Embeddings too small for cross-validation',
-                    'variance': 0.0,
-                    'segment_similarities': []
-                }
-            
-            segment_similarities = []
-            
-            for i in range(segments):
-                start_idx = i * segment_size
-                end_idx = (i + 1) * segment_size if i < segments - 1 else len(emb1)
-                
-                seg1 = emb1[start_idx:end_idx]
-                seg2 = emb2[start_idx:end_idx]
-                
-                # Calculate simple cosine similarity for each segment
-                seg_sim = self.cosine_similarity(seg1, seg2)
-                segment_similarities.append(seg_sim)
-            
-            # Check consistency across segments
-            mean_sim = np.mean(segment_similarities)
-            std_sim = np.std(segment_similarities)
-            variance = std_sim / (mean_sim + 1e-7)  # Coefficient of variation
-            
-            # Additional validation: check if any segment has dramatically different similarity
-            min_sim = min(segment_similarities)
-            max_sim = max(segment_similarities)
-            range_sim = max_sim - min_sim
-            
-            # Stricter consistency criteria
-            is_consistent = True
-            reason = "Consistent across segments"
-            
-            # STRICTER consistency checks
-            if variance > 0.6:  # Reduced from 0.8 - Lower variance threshold for inconsistency
-                is_consistent = False
-                reason = f"High variance across segments: {variance:.3f}"
-            elif std_sim > 0.25:  # Reduced from 0.3 - Lower standard deviation threshold
-                is_consistent = False
-                reason = f"High standard deviation: {std_sim:.3f}"
-            elif range_sim > 0.4:  # Reduced from 0.5 - Lower acceptable range
-                is_consistent = False
-                reason = f"Large similarity range: {range_sim:.3f}"
-            elif mean_sim < 0.3:  # New check - Reject overall low similarity
-                is_consistent = False
-                reason = f"Overall low mean similarity: {mean_sim:.3f}"
-            
-            # Check if minimum similarity is too low compared to mean
-            if is_consistent and min_sim < mean_sim * 0.7:  # New check - Ensure no segment is dramatically worse
-                is_consistent = False
-                reason = f"Outlier segment with low similarity: {min_sim:.3f} vs mean {mean_sim:.3f}"
-            
-            return {
-                'is_consistent': is_consistent,
-                'reason': reason,
-                'variance': float(variance),
-                'segment_similarities': [float(s) for s in segment_similarities],
-                'mean_similarity': float(mean_sim),
-                'std_similarity': float(std_sim)
-            }
-            
-        except Exception as e:
-            return {
-                'is_consistent': False,
-                'reason': f"Cross-validation error: {str(e)}",
-                'variance': 1.0,
-                'segment_similarities': []
-            }
-    
-    def robust_cosine_similarity(self, a, b):
-        """Robust cosine similarity với outlier handling"""
-        try:
-            # Remove outliers before calculation
-            a_clean, b_clean = self.remove_embedding_outliers(a, b)
-            
-            dot_product = dot(a_clean, b_clean)
-            norm_a = linalg.norm(a_clean)
-            norm_b = linalg.norm(b_clean)
-            
-            if norm_a == 0 or norm_b == 0:
-                return 0.0
-            
-            similarity = dot_product / (norm_a * norm_b)
-            
-            # Enhanced normalization với smoother transition
-            normalized_sim = (similarity + 1) / 2
-            
-            # Apply sigmoid-like smoothing để reduce extreme values
-            smoothed_sim = 1 / (1 + np.exp(-10 * (normalized_sim - 0.5)))
-            
-            return max(0.0, min(1.0, smoothed_sim))
-        except:
-            return 0.0
-    
-    def remove_embedding_outliers(self, a, b, threshold=3):
-        """Remove outliers từ embeddings using z-score"""
-        try:
-            # Calculate z-scores
-            a_mean, a_std = np.mean(a), np.std(a)
-            b_mean, b_std = np.mean(b), np.std(b)
-            
-            if a_std == 0 or b_std == 0:
-                return a, b
-            
-            a_z_scores = np.abs((a - a_mean) / a_std)
-            b_z_scores = np.abs((b - b_mean) / b_std)
-            
-            # Keep only values within threshold standard deviations
-            mask = (a_z_scores < threshold) & (b_z_scores < threshold)
-            
-            if np.sum(mask) < len(a) * 0.5:  # Too many outliers, keep original
-                return a, b
-            
-            return a[mask], b[mask]
-        except:
-            return a, b
-    
-    def robust_pearson_correlation(self, a, b):
-        """Robust Pearson correlation với outlier handling"""
-        try:
-            if len(a) < 3 or len(b) < 3:
-                return 0.0
-            
-            # Remove outliers
-            a_clean, b_clean = self.remove_embedding_outliers(a, b)
-            
-            if len(a_clean) < 3:
-                return 0.0
-            
-            correlation = np.corrcoef(a_clean, b_clean)[0, 1]
-            if np.isnan(correlation):
-                return 0.0
-            
-            # Robust normalization
-            normalized = (correlation + 1) / 2
-            return max(0.0, min(1.0, normalized))
-        except:
-            return 0.0
-    
-    def adaptive_euclidean_similarity(self, a, b):
-        """Adaptive Euclidean similarity với scaling"""
-        try:
-            # Adaptive scaling dựa trên embedding characteristics
-            feature_variance = (np.var(a) + np.var(b)) / 2
-            scale_factor = 1.0 / (1.0 + feature_variance * 0.1)
-            
-            distance = np.sqrt(np.sum((a - b) ** 2))
-            
-            # Adaptive max distance calculation
-            norm_a, norm_b = np.linalg.norm(a), np.linalg.norm(b)
-            max_distance = norm_a + norm_b
-            
-            if max_distance == 0:
-                return 1.0
-            
-            # Apply adaptive scaling
-            scaled_distance = distance * scale_factor
-            scaled_max = max_distance * scale_factor
-            
-            similarity = 1.0 - (scaled_distance / scaled_max)
-            return max(0.0, min(1.0, similarity))
-        except:
-            return 0.0
-    
-    def robust_manhattan_similarity(self, a, b):
-        """Robust Manhattan similarity với outlier rejection"""
-        try:
-            # Remove outliers
-            a_clean, b_clean = self.remove_embedding_outliers(a, b)
-            
-            distance = np.sum(np.abs(a_clean - b_clean))
-            max_distance = np.sum(np.abs(a_clean)) + np.sum(np.abs(b_clean))
-            
-            if max_distance == 0:
-                return 1.0
-            
-            similarity = 1.0 - (distance / max_distance)
-            return max(0.0, min(1.0, similarity))
-        except:
-            return 0.0
-    
-    def robust_chi_square_similarity(self, a, b):
-        """Robust Chi-square similarity with better handling"""
-        try:
-            # Ensure positive values for chi-square
-            epsilon = 1e-10
-            a_pos = np.maximum(np.abs(a), epsilon)
-            b_pos = np.maximum(np.abs(b), epsilon)
-            
-            # Remove extreme outliers before chi-square calculation
-            a_clean, b_clean = self.remove_embedding_outliers(a_pos, b_pos, threshold=2)
-            
-            chi_square = np.sum(((a_clean - b_clean) ** 2) / (a_clean + b_clean))
-            
-            # Adaptive normalization
-            similarity = 1.0 / (1.0 + chi_square / (len(a_clean) * 0.5))
-            return max(0.0, min(1.0, similarity))
-        except:
-            return 0.0
-    
-    def structural_similarity(self, a, b):
-        """Structural similarity inspired by SSIM"""
-        try:
-            # Constants for stability
-            C1, C2, C3 = 1e-4, 1e-4, 1e-4
-            
-            # Mean values
-            mu_a, mu_b = np.mean(a), np.mean(b)
-            
-            # Variances
-            var_a, var_b = np.var(a), np.var(b)
-            
-            # Covariance
-            cov_ab = np.mean((a - mu_a) * (b - mu_b))
-            
-            # SSIM-like formula adapted for 1D embeddings
-            luminance = (2 * mu_a * mu_b + C1) / (mu_a**2 + mu_b**2 + C1)
-            contrast = (2 * np.sqrt(var_a * var_b) + C2) / (var_a + var_b + C2)
-            structure = (cov_ab + C3) / (np.sqrt(var_a * var_b) + C3)
-            
-            ssim = luminance * contrast * structure
-            
-            # Normalize to [0, 1]
-            normalized_ssim = (ssim + 1) / 2
-            return max(0.0, min(1.0, normalized_ssim))
-        except:
-            return 0.0
-    
-    def calculate_enhanced_confidence(self, similarities, cross_validation_result):
-        """Enhanced confidence calculation với multiple factors"""
-        try:
-            sim_values = [sim for _, sim, _ in similarities]
-            
-            if len(sim_values) < 2:
-                return 0.5
-            
-            # Base confidence từ similarity agreement
-            mean_sim = np.mean(sim_values)
-            std_sim = np.std(sim_values)
-            base_confidence = max(0.1, min(1.0, 1.0 - (std_sim * 1.5)))
-            
-            # Cross-validation confidence boost/penalty
-            cv_confidence = 1.0
-            if cross_validation_result['is_consistent']:
-                cv_confidence = 1.2  # Boost for consistency
-            else:
-                cv_confidence = 0.3  # Strong penalty for inconsistency
-            
-            # Agreement confidence (how many metrics agree)
-            high_sim_count = sum(1 for sim in sim_values if sim > 0.6)
-            agreement_confidence = 0.5 + (high_sim_count / len(sim_values)) * 0.5
-            
-            # Combined confidence
-            final_confidence = base_confidence * cv_confidence * agreement_confidence
-            
-            # Quality boost for high average similarity
-            if mean_sim > 0.75:
-                final_confidence *= 1.3
-            elif mean_sim > 0.6:
-                final_confidence *= 1.1
-            elif mean_sim < 0.3:
-                final_confidence *= 0.5
-            
-            return min(1.0, final_confidence)
-        except:
-            return 0.3
-    
-    def calculate_adaptive_adjustments(self, emb1, emb2):
-        """Calculate adaptive adjustments based on embedding characteristics with enhanced differentiation"""
-        try:
-            # Feature quality analysis
-            var1, var2 = np.var(emb1), np.var(emb2)
-            mean_var = (var1 + var2) / 2
-            
-            # Check for variance difference - different people often have different variance patterns
-            var_ratio = min(var1, var2) / (max(var1, var2) + 1e-7)
-            
-            # Embedding magnitude analysis
-            norm1, norm2 = np.linalg.norm(emb1), np.linalg.norm(emb2)
-            norm_ratio = min(norm1, norm2) / (max(norm1, norm2) + 1e-7)
-            
-            # Feature distribution analysis
-            skew1 = self.calculate_skewness(emb1)
-            skew2 = self.calculate_skewness(emb2)
-            skew_diff = abs(skew1 - skew2)
-            
-            # Feature correlation analysis (new)
-            corr_coef = np.corrcoef(emb1, emb2)[0, 1] if len(emb1) == len(emb2) else 0
-            
-            # Check for consistent differences (new)
-            # Different people often have consistent sign differences across embedding dimensions
-            sign_diff = np.mean(np.sign(emb1) != np.sign(emb2))
-            
-            # Calculate adjustments
-            similarity_boost = 1.0
-            confidence_boost = 1.0
-            threshold_adjustment = 0.0
-            
-            # High variance features might be more distinctive
-            if mean_var > 0.5:
-                similarity_boost *= 1.05  # Reduced boost from 1.1
-                confidence_boost *= 1.05  # Reduced boost from 1.1
-            elif mean_var < 0.1:
-                similarity_boost *= 0.85  # More aggressive penalty (was 0.9)
-            
-            # Variance ratio analysis - different people often have different variance patterns
-            if var_ratio < 0.7:  # Significant variance difference
-                similarity_boost *= 0.9
-                threshold_adjustment += 0.05
-            
-            # Similar norms indicate comparable feature quality
-            if norm_ratio > 0.9:  # Increased from 0.8 - stricter requirement for high similarity
-                confidence_boost *= 1.1  # Reduced from 1.2
-                threshold_adjustment -= 0.03  # Reduced adjustment from -0.05
-            elif norm_ratio < 0.7:  # Increased from 0.5 - more sensitive to norm differences
-                confidence_boost *= 0.6  # More aggressive penalty (was 0.7)
-                threshold_adjustment += 0.1  # Higher threshold for mismatched quality
-            
-            # Similar distributions indicate good alignment
-            if skew_diff < 0.3:  # Reduced from 0.5 - stricter requirement
-                similarity_boost *= 1.1
-            elif skew_diff > 1.0:  # Reduced from 1.5 - more sensitive to distribution differences
-                similarity_boost *= 0.75  # More aggressive penalty (was 0.8)
-                threshold_adjustment += 0.05  # New: increase threshold for different distributions
-            
-            # Correlation coefficient analysis (new)
-            if corr_coef > 0.8:
-                similarity_boost *= 1.1
-                threshold_adjustment -= 0.05
-            elif corr_coef < 0.4:
-                similarity_boost *= 0.8
-                threshold_adjustment += 0.1
-            
-            # Sign difference analysis (new)
-            if sign_diff > 0.4:  # More than 40% of dimensions have different signs
-                similarity_boost *= 0.85
-                threshold_adjustment += 0.1
-            
-            # Apply limits to avoid extreme adjustments
-            similarity_boost = max(0.6, min(1.3, similarity_boost))
-            confidence_boost = max(0.4, min(1.5, confidence_boost))
-            threshold_adjustment = max(-0.15, min(0.25, threshold_adjustment))
-            
-            return {
-                'similarity_boost': float(similarity_boost),
-                'confidence_boost': float(confidence_boost),
-                'threshold_adjustment': float(threshold_adjustment),
-                'feature_variance': float(mean_var),
-                'variance_ratio': float(var_ratio),
-                'norm_ratio': float(norm_ratio),
-                'skew_difference': float(skew_diff),
-                'correlation': float(corr_coef),
-                'sign_difference': float(sign_diff)
-            }
-            
-        except Exception as e:
-            print(f"Adaptive adjustment error: {e}", file=sys.stderr)
-            return {
-                'similarity_boost': 1.0,
-                'confidence_boost': 1.0,
-                'threshold_adjustment': 0.0,
-                'feature_variance': 0.0,
-                'variance_ratio': 1.0,
-                'norm_ratio': 1.0,
-                'skew_difference': 0.0,
-                'correlation': 0.0,
-                'sign_difference': 0.0
-            }
-    
-    def calculate_skewness(self, data):
-        """Calculate skewness of data distribution"""
-        try:
-            mean_val = np.mean(data)
-            std_val = np.std(data)
-            
-            if std_val == 0:
-                return 0.0
-            
-            skewness = np.mean(((data - mean_val) / std_val) ** 3)
-            return skewness
-        except:
-            return 0.0
-    
     # Legacy method aliases for compatibility
     def detect_faces(self, img_path: str) -> dict:
         """Legacy method - calls advanced detection"""
@@ -2653,52 +2987,89 @@ class AdvancedFaceProcessor:
         """Legacy method - calls advanced quality assessment"""
         return self.assess_quality_advanced(img_path)
 
-    def assess_quality_advanced(self, img_path: str) -> dict:
-        """Advanced image quality assessment với adaptive scoring"""
-        img, error = self.load_image(img_path)
-        if img is None:
+    def assess_quality_advanced(self, img_path: str, context=None, metrics=None, proxy=None) -> dict:
+        """Advanced image quality assessment với adaptive scoring
+        
+        metrics limits scoring to some QUALITY_METRICS groups (None = all); the
+        adaptive weights are then renormalized over the enabled metrics. proxy (a
+        longest side, True = QUALITY_PROXY_DIMENSION) scores larger images on
+        bounded proxies instead of the full resolution.
+        """
+        if proxy is True:
+            proxy = QUALITY_PROXY_DIMENSION
+        enabled = set(QUALITY_METRICS) if metrics is None else set(metrics)
+        unknown = enabled - set(QUALITY_METRICS)
+        if unknown or not enabled:
             return {
                 'success': False,
-                'error': error or 'Could not load image for quality assessment',
+                'error': f"Unknown quality metrics: {', '.join(sorted(unknown))}" if unknown else 'No quality metrics enabled',
                 'quality_score': 0
             }
         
+        if context is None:
+            context, error = self.create_image_context(img_path)
+            if context is None:
+                return {
+                    'success': False,
+                    'error': error or 'Could not load image for quality assessment',
+                    'quality_score': 0
+                }
+        
         try:
-            # Get image dimensions
-            height, width = img.shape[:2]
+            # Get image dimensions (of the original, also when the context was decoded reduced)
+            height, width = context.original_shape[:2]
             
-            # Convert to grayscale for analysis
-            gray = cvtColor(img, COLOR_BGR2GRAY)
+            # Pixel-scale metrics read `native`, whole-frame metrics read `frame`; both are
+            # the full image unless proxy mode swaps in a centre crop and a thumbnail
+            native, frame = context.quality_proxies(proxy) if proxy else (context, context)
             
-            # Enhanced quality metrics với adaptive scoring
+            # Enhanced quality metrics với adaptive scoring; every metric reads its
+            # intermediates (Laplacian, Sobel, Canny, box moments, noise estimate)
+            # from the context, so each one is built once
             quality_metrics = {}
+            noise_score = None
             
             # 1. Enhanced sharpness detection (multiple methods)
-            sharpness_scores = self.calculate_enhanced_sharpness(gray)
-            quality_metrics.update(sharpness_scores)
+            if 'sharpness' in enabled:
+                with self.stage('quality.sharpness'):
+                    sharpness_scores = self.calculate_enhanced_sharpness(native.gray, native)
+                quality_metrics.update(sharpness_scores)
             
             # 2. Multi-scale contrast analysis
-            contrast_scores = self.calculate_multi_scale_contrast(gray)
-            quality_metrics.update(contrast_scores)
+            if 'contrast' in enabled:
+                with self.stage('quality.contrast'):
+                    contrast_scores = self.calculate_multi_scale_contrast(native.gray, native)
+                    if frame is not native:
+                        contrast_scores['global_contrast'] = self.calculate_global_contrast(frame.gray, frame)
+                quality_metrics.update(contrast_scores)
             
             # 3. Illumination quality
-            illumination_score = self.assess_illumination_quality(gray)
-            quality_metrics['illumination'] = illumination_score
+            if 'illumination' in enabled:
+                with self.stage('quality.illumination'):
+                    illumination_score = self.assess_illumination_quality(frame.gray)
+                quality_metrics['illumination'] = illumination_score
             
             # 4. Noise estimation
-            noise_score = self.enhanced_noise_estimation(gray)
-            quality_metrics['noise'] = 100 - noise_score
+            if 'noise' in enabled:
+                with self.stage('quality.noise'):
+                    noise_score = self.estimate_noise(native.gray, native)
+                quality_metrics['noise'] = 100 - noise_score
             
             # 5. Face-specific quality metrics
-            face_quality_score = self.assess_face_specific_quality(gray)
-            quality_metrics['face_quality'] = face_quality_score
+            if 'face' in enabled:
+                with self.stage('quality.face'):
+                    face_quality_score = self.assess_face_specific_quality(frame.gray)
+                quality_metrics['face_quality'] = face_quality_score
             
             # 6. Resolution and detail assessment
-            detail_score = self.assess_detail_quality(gray)
-            quality_metrics['detail'] = detail_score
+            if 'detail' in enabled:
+                with self.stage('quality.detail'):
+                    detail_score = self.assess_detail_quality(native.gray, native)
+                quality_metrics['detail'] = detail_score
             
             # ADAPTIVE weighted scoring dựa trên image characteristics
-            weights = self.calculate_adaptive_quality_weights(quality_metrics, gray)
+            with self.stage('quality.weights'):
+                weights = self.calculate_adaptive_quality_weights(quality_metrics, frame.gray, frame, noise_score)
             
             # Overall quality calculation với adaptive weights
             overall_score = sum(quality_metrics[metric] * weights.get(metric, 0) 
@@ -2707,7 +3078,7 @@ class AdvancedFaceProcessor:
             # Apply adaptive normalization
             normalized_score = self.normalize_quality_score(overall_score, quality_metrics)
             
-            return {
+            result = {
                 'success': True,
                 'quality_score': round(max(0, min(100, normalized_score)), 2),
                 'detailed_metrics': {k: round(v, 2) for k, v in quality_metrics.items()},
@@ -2718,6 +3089,13 @@ class AdvancedFaceProcessor:
                     'total_pixels': width * height
                 }
             }
+            if native is not context:
+                result['quality_proxy'] = {
+                    'max_dimension': proxy,
+                    'crop': {'width': native.shape[1], 'height': native.shape[0]},
+                    'thumbnail': {'width': frame.shape[1], 'height': frame.shape[0]}
+                }
+            return result
             
         except Exception as e:
             return {
@@ -2726,42 +3104,28 @@ class AdvancedFaceProcessor:
                 'quality_score': 0
             }
     
-    def calculate_enhanced_sharpness(self, gray_img):
+    def calculate_enhanced_sharpness(self, gray_img, context=None):
         """Enhanced sharpness calculation với multiple methods"""
         sharpness_metrics = {}
         
         try:
             # 1. Laplacian variance (traditional)
-            laplacian = Laplacian(gray_img, CV_64F)
+            laplacian = context.laplacian if context is not None else Laplacian(gray_img, CV_64F)
             laplacian_var = var(laplacian)
             sharpness_metrics['laplacian_sharpness'] = min(100, (laplacian_var / 2000) * 100)
             
             # 2. Sobel gradient magnitude
-            grad_x = Sobel(gray_img, CV_64F, 1, 0, ksize=3)
-            grad_y = Sobel(gray_img, CV_64F, 0, 1, ksize=3)
+            if context is not None:
+                grad_x, grad_y = context.sobel_x, context.sobel_y
+            else:
+                grad_x = Sobel(gray_img, CV_64F, 1, 0, ksize=3)
+                grad_y = Sobel(gray_img, CV_64F, 0, 1, ksize=3)
             gradient_magnitude = np.sqrt(grad_x**2 + grad_y**2)
             sobel_sharpness = np.mean(gradient_magnitude)
             sharpness_metrics['sobel_sharpness'] = min(100, (sobel_sharpness / 50) * 100)
             
             # 3. High-frequency content analysis
-            fft_img = np.fft.fft2(gray_img)
-            fft_shifted = np.fft.fftshift(fft_img)
-            magnitude_spectrum = np.abs(fft_shifted)
-            
-            # Focus on high-frequency components
-            h, w = gray_img.shape
-            center_y, center_x = h // 2, w // 2
-            high_freq_mask = np.zeros((h, w))
-            
-            # Create high-frequency mask (outer region)
-            for y in range(h):
-                for x in range(w):
-                    distance = np.sqrt((y - center_y)**2 + (x - center_x)**2)
-                    if distance > min(h, w) * 0.3:  # High frequency region
-                        high_freq_mask[y, x] = 1
-            
-            high_freq_energy = np.sum(magnitude_spectrum * high_freq_mask)
-            total_energy = np.sum(magnitude_spectrum)
+            high_freq_energy, total_energy = self.frequency_energy(gray_img)
             
             if total_energy > 0:
                 hf_ratio = high_freq_energy / total_energy
@@ -2779,26 +3143,70 @@ class AdvancedFaceProcessor:
         
         return sharpness_metrics
     
-    def calculate_multi_scale_contrast(self, gray_img):
+    def get_frequency_mask(self, h, w):
+        """(high-frequency mask, column weights) over the rfft2 half-spectrum of an h x w image
+        
+        The mask is the outer region of the centred full spectrum (distance from the
+        DC term > FREQUENCY_SHARPNESS_RADIUS * min(h, w)), mapped to unshifted rfft
+        indices. Columns whose conjugate is not stored get weight 2; the mask is
+        symmetric under conjugation, so weighted half-spectrum sums equal full ones.
+        Cached per shape.
+        """
+        key = (h, w)
+        cached = self._frequency_mask_cache.get(key)
+        if cached is None:
+            # Signed frequency of each unshifted index = offset from the fftshift centre
+            rows = (np.arange(h) + h // 2) % h - h // 2
+            cols = (np.arange(w // 2 + 1) + w // 2) % w - w // 2
+            distance = np.sqrt(rows[:, None]**2 + cols[None, :]**2)
+            mask = distance > min(h, w) * FREQUENCY_SHARPNESS_RADIUS
+            
+            weights = np.full(w // 2 + 1, 2.0)
+            weights[0] = 1.0
+            if w % 2 == 0:
+                weights[-1] = 1.0
+            
+            if len(self._frequency_mask_cache) >= FREQUENCY_MASK_CACHE_SIZE:
+                self._frequency_mask_cache.pop(next(iter(self._frequency_mask_cache)))
+            cached = self._frequency_mask_cache[key] = (mask, weights)
+        return cached
+    
+    def frequency_energy(self, gray_img):
+        """(high-frequency, total) spectrum magnitude of a grayscale image via a real FFT"""
+        h, w = gray_img.shape[:2]
+        mask, weights = self.get_frequency_mask(h, w)
+        
+        magnitude = np.abs(np.fft.rfft2(gray_img))
+        magnitude *= weights
+        return float(magnitude[mask].sum()), float(magnitude.sum())
+    
+    def calculate_global_contrast(self, gray_img, context=None):
+        """Global contrast score from the grayscale standard deviation"""
+        global_contrast = context.gray_std if context is not None else std(gray_img)
+        return min(100, (global_contrast / 128) * 100)
+    
+    def calculate_multi_scale_contrast(self, gray_img, context=None):
         """Multi-scale contrast analysis"""
         contrast_metrics = {}
         
         try:
             # 1. Global contrast (standard deviation)
-            global_contrast = std(gray_img)
-            contrast_metrics['global_contrast'] = min(100, (global_contrast / 128) * 100)
+            contrast_metrics['global_contrast'] = self.calculate_global_contrast(gray_img, context)
             
             # 2. Local contrast analysis
             kernel_sizes = [3, 5, 9, 15]
             local_contrasts = []
             
             for kernel_size in kernel_sizes:
-                # Local mean
-                kernel = np.ones((kernel_size, kernel_size)) / (kernel_size * kernel_size)
-                local_mean = cv2.filter2D(gray_img.astype(np.float32), -1, kernel)
-                
-                # Local standard deviation
-                local_sq_mean = cv2.filter2D((gray_img.astype(np.float32))**2, -1, kernel)
+                if context is not None:
+                    local_mean, local_sq_mean = context.local_moments(kernel_size)
+                else:
+                    # Local mean
+                    kernel = np.ones((kernel_size, kernel_size)) / (kernel_size * kernel_size)
+                    local_mean = cv2.filter2D(gray_img.astype(np.float32), -1, kernel)
+                    
+                    # Local standard deviation
+                    local_sq_mean = cv2.filter2D((gray_img.astype(np.float32))**2, -1, kernel)
                 local_std = np.sqrt(np.maximum(0, local_sq_mean - local_mean**2))
                 
                 # Average local contrast
@@ -2809,7 +3217,7 @@ class AdvancedFaceProcessor:
             contrast_metrics['local_contrast'] = min(100, (np.mean(local_contrasts) / 64) * 100)
             
             # 3. Edge-based contrast
-            edges = Canny(gray_img, 50, 150)
+            edges = context.canny(50, 150) if context is not None else Canny(gray_img, 50, 150)
             edge_density = np.sum(edges > 0) / (gray_img.shape[0] * gray_img.shape[1])
             contrast_metrics['edge_contrast'] = min(100, edge_density * 1000)
             
@@ -2859,21 +3267,28 @@ class AdvancedFaceProcessor:
             print(f"Illumination assessment error: {e}", file=sys.stderr)
             return 50
     
-    def enhanced_noise_estimation(self, gray_img):
+    def estimate_noise(self, gray_img, context=None):
+        """enhanced_noise_estimation, computed once per ImageContext (quality metric and weights share it)"""
+        if context is None:
+            return self.enhanced_noise_estimation(gray_img)
+        return context.memoize('noise_estimate', lambda: self.enhanced_noise_estimation(gray_img, context))
+    
+    def enhanced_noise_estimation(self, gray_img, context=None):
         """Enhanced noise estimation"""
         try:
             # 1. High-frequency noise detection
-            laplacian = Laplacian(gray_img, CV_64F)
+            laplacian = context.laplacian if context is not None else Laplacian(gray_img, CV_64F)
             
             # 2. Median filtering approach
             median_filtered = cv2.medianBlur(gray_img, 5)
-            noise_map = np.abs(gray_img.astype(np.float32) - median_filtered.astype(np.float32))
+            gray_f32 = context.gray_f32 if context is not None else gray_img.astype(np.float32)
+            noise_map = np.abs(gray_f32 - median_filtered.astype(np.float32))
             noise_level = np.mean(noise_map)
             
             # 3. Wavelet-inspired approach (simplified)
             # Use difference between original and smoothed image
             smoothed = GaussianBlur(gray_img, (5, 5), 2.0)
-            detail_noise = np.abs(gray_img.astype(np.float32) - smoothed.astype(np.float32))
+            detail_noise = np.abs(gray_f32 - smoothed.astype(np.float32))
             detail_noise_level = np.std(detail_noise)
             
             # Combined noise estimation
@@ -2956,22 +3371,23 @@ class AdvancedFaceProcessor:
         except Exception as e:
             return 50
     
-    def assess_detail_quality(self, gray_img):
+    def assess_detail_quality(self, gray_img, context=None):
         """Assess overall detail and resolution quality"""
         try:
             h, w = gray_img.shape
             
-            # 1. Resolution score
-            pixel_count = h * w
+            # 1. Resolution score (of the original when scoring a proxy)
+            original_h, original_w = context.original_shape[:2] if context is not None else (h, w)
+            pixel_count = original_h * original_w
             resolution_score = min(100, (pixel_count / (640 * 480)) * 100)  # Base on VGA resolution
             
             # 2. Detail richness (edge density)
-            edges = Canny(gray_img, 30, 100)
+            edges = context.canny(30, 100) if context is not None else Canny(gray_img, 30, 100)
             edge_density = np.sum(edges > 0) / (h * w)
             detail_score = min(100, edge_density * 500)
             
             # 3. Texture richness
-            texture_score = self.assess_texture_richness(gray_img)
+            texture_score = self.assess_texture_richness(gray_img, context)
             
             # Combined detail quality
             combined_detail = (resolution_score * 0.3 + detail_score * 0.4 + texture_score * 0.3)
@@ -2982,16 +3398,19 @@ class AdvancedFaceProcessor:
             print(f"Detail quality assessment error: {e}", file=sys.stderr)
             return 50
     
-    def assess_texture_richness(self, gray_img):
+    def assess_texture_richness(self, gray_img, context=None):
         """Assess texture richness using LBP-like analysis"""
         try:
             # Simple texture analysis
             h, w = gray_img.shape
             
-            # Calculate local variance
-            kernel = np.ones((5, 5)) / 25
-            local_mean = cv2.filter2D(gray_img.astype(np.float32), -1, kernel)
-            local_sq_mean = cv2.filter2D((gray_img.astype(np.float32))**2, -1, kernel)
+            # Calculate local variance (same 5x5 box moments as the local contrast pass)
+            if context is not None:
+                local_mean, local_sq_mean = context.local_moments(5)
+            else:
+                kernel = np.ones((5, 5)) / 25
+                local_mean = cv2.filter2D(gray_img.astype(np.float32), -1, kernel)
+                local_sq_mean = cv2.filter2D((gray_img.astype(np.float32))**2, -1, kernel)
             local_variance = np.maximum(0, local_sq_mean - local_mean**2)
             
             # Texture score based on variance distribution
@@ -3002,10 +3421,10 @@ class AdvancedFaceProcessor:
         except Exception as e:
             return 50
     
-    def calculate_adaptive_quality_weights(self, quality_metrics, gray_img):
+    def calculate_adaptive_quality_weights(self, quality_metrics, gray_img, context=None, noise_estimate=None):
         """Calculate adaptive weights based on image characteristics"""
         try:
-            h, w = gray_img.shape
+            h, w = context.original_shape[:2] if context is not None else gray_img.shape
             
             # Base weights
             weights = {
@@ -3030,16 +3449,22 @@ class AdvancedFaceProcessor:
                 weights['detail'] *= 0.8
             
             # If image has low contrast, emphasize contrast metrics
-            overall_contrast = np.std(gray_img)
+            overall_contrast = context.gray_std if context is not None else np.std(gray_img)
             if overall_contrast < 30:
                 weights['global_contrast'] *= 1.4
                 weights['local_contrast'] *= 1.3
                 weights['edge_contrast'] *= 1.2
             
             # If noise is detected, emphasize noise metric
-            noise_estimate = self.enhanced_noise_estimation(gray_img)
-            if noise_estimate > 60:
-                weights['noise'] *= 1.5
+            if 'noise' in quality_metrics:
+                if noise_estimate is None:
+                    noise_estimate = self.estimate_noise(gray_img, context)
+                if noise_estimate > 60:
+                    weights['noise'] *= 1.5
+            
+            # Only metrics that were computed share the weight
+            if quality_metrics:
+                weights = {k: v for k, v in weights.items() if k in quality_metrics}
             
             # Normalize weights to sum to 1
             total_weight = sum(weights.values())
@@ -3073,7 +3498,7 @@ class AdvancedFaceProcessor:
             # Apply penalty for extremely poor metrics
             critical_metrics = ['laplacian_sharpness', 'global_contrast', 'illumination']
             poor_critical_count = sum(1 for metric in critical_metrics 
-                                    if quality_metrics.get(metric, 0) < 20)
+                                    if metric in quality_metrics and quality_metrics[metric] < 20)
             
             if poor_critical_count >= 2:
                 normalized *= 0.5  # Heavy penalty for multiple poor critical metrics
@@ -3091,19 +3516,564 @@ class AdvancedFaceProcessor:
             print(f"Quality normalization error: {e}", file=sys.stderr)
             return max(0, min(100, raw_score))
 
-    # --- Fix: provide simple alias for compatibility ---
-    def cosine_similarity(self, a, b):
-        """Alias wrapper to maintain compatibility with older code paths."""
-        return self.robust_cosine_similarity(a, b)
+def load_embedding_set(value):
+    """Embeddings and their stats from a list, a JSON string or a JSON file path
+    
+    The JSON is a list of vectors or of extract_embeddings entries
+    ({'embedding', 'stats'}), or an extract_embeddings result.
+    Returns (vectors, stats) with None where an entry carries no stats.
+    """
+    if value is None:
+        return None, None
+    value = load_json_argument(value)
+    if isinstance(value, dict):
+        value = value.get('embeddings', [])
+    
+    vectors, stats = [], []
+    for entry in value:
+        embedding, entry_stats = unpack_embedding(entry)
+        vectors.append(embedding)
+        stats.append(entry_stats)
+    return vectors, stats
+
+def load_json_argument(value):
+    """Decode a JSON string or read a JSON file path; other values pass through"""
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('[') or value.startswith('{'):
+            return json.loads(value)
+        with open(value, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return value
+
+def metrics_param(value):
+    """Quality metric names from the CLI (list) or a serve request (list or comma separated string)"""
+    if isinstance(value, str):
+        return [name.strip() for name in value.split(',') if name.strip()]
+    return value
+
+def dimension_param(value, default):
+    """Pixel-size option from the CLI or a serve request: None/False = off, True = default, else int"""
+    if value is None or value is False:
+        return None
+    if value is True:
+        return default
+    return int(value)
+
+def load_index_entries(value, ids=None):
+    """(vectors, ids, metas) for index_add
+    
+    Accepts what load_embedding_set accepts plus embedding cache files
+    ({'imageHash', 'imageUrl', 'embeddings'}). Ids come from the explicit list,
+    an entry's 'id', '<imageHash>:<face_id>' for cache files, or the index counter.
+    """
+    value = load_json_argument(value)
+    sources = value if isinstance(value, list) and value and isinstance(value[0], dict) and 'embeddings' in value[0] else [value]
+    
+    vectors, entry_ids, metas = [], [], []
+    for source in sources:
+        image_meta = {}
+        entries = source
+        if isinstance(source, dict):
+            image_meta = {key: source[key] for key in ('imageHash', 'imageUrl') if key in source}
+            entries = source.get('embeddings', [])
+        for position, entry in enumerate(entries):
+            if isinstance(entry, dict):
+                vectors.append(entry.get('embedding', []))
+                meta = {key: item for key, item in entry.items() if key not in ('embedding', 'stats', 'id')}
+                meta.update(image_meta)
+                face_id = entry.get('face_id', position)
+                if 'id' in entry:
+                    entry_ids.append(str(entry['id']))
+                elif 'imageHash' in image_meta:
+                    entry_ids.append(f"{image_meta['imageHash']}:{face_id}")
+                else:
+                    entry_ids.append(None)
+                metas.append(meta or None)
+            else:
+                vectors.append(entry)
+                entry_ids.append(f"{image_meta['imageHash']}:{position}" if 'imageHash' in image_meta else None)
+                metas.append(image_meta or None)
+    
+    if ids is not None:
+        ids = load_json_argument(ids) if isinstance(ids, str) and ids.strip().startswith('[') else ids
+        ids = ids.split(',') if isinstance(ids, str) else list(ids)
+        if len(ids) != len(vectors):
+            raise ValueError(f'{len(ids)} ids given for {len(vectors)} embeddings')
+        entry_ids = [str(row_id) for row_id in ids]
+    return vectors, entry_ids, metas
+
+def unpack_embedding(value):
+    """(vector, stats or None) from a vector, an extract_embeddings entry or its JSON"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    if isinstance(value, dict):
+        return value.get('embedding', []), value.get('stats')
+    return value, None
+
+def store_path(value):
+    """Store directory from a --store/"store" value; empty or true means the default store"""
+    return value if isinstance(value, str) and value else None
+
+def add_store_to_index(index, store):
+    """index_add for every live stored face of the index dimension (ids '<imageHash>:<face_id>')"""
+    buckets = store.gallery().length_buckets()
+    if not buckets:
+        return {'success': False, 'error': 'Embedding store is empty'}
+    dim = index.dim or max(buckets, key=lambda length: len(buckets[length][0]))
+    if dim not in buckets:
+        return {'success': False, 'error': f'Store has no {dim}-dimensional embeddings'}
+    positions, matrix = buckets[dim]
+    result = index.add(matrix, store.gallery().ids(positions))
+    if result.get('success'):
+        result['skipped_dimensions'] = {str(length): len(bucket[0]) for length, bucket in buckets.items() if length != dim}
+    return result
+
+def run_action(processor, action, params):
+    """Run one action; with 'profile' the result gains a 'timings' block
+    
+    'profile_dump' additionally writes a cProfile/pstats file of the call (only
+    the calling thread is profiled: use --detection-workers 1 to include detection).
+    """
+    dump_path = params.get('profile_dump')
+    if not params.get('profile') and not dump_path:
+        return dispatch_action(processor, action, params)
+    
+    profiler = StageProfiler()
+    dump = None
+    if dump_path:
+        import cProfile
+        dump = cProfile.Profile()
+    processor.profiler = profiler
+    try:
+        if dump is not None:
+            dump.enable()
+        result = dispatch_action(processor, action, params)
+    finally:
+        if dump is not None:
+            dump.disable()
+        processor.profiler = None
+    
+    timings = profiler.report()
+    if dump is not None:
+        dump.dump_stats(dump_path)
+        timings['profile_dump'] = os.path.abspath(dump_path)
+    stages = sorted(timings['stages'].items(), key=lambda item: -item[1]['wall_ms'])[:5]
+    print(f"[PROFILE] action={action} wall={timings['wall_ms']:.1f}ms cpu={timings['cpu_ms']:.1f}ms top: " +
+          ", ".join(f"{name}={entry['wall_ms']:.1f}ms" for name, entry in stages), file=sys.stderr)
+    if isinstance(result, dict):
+        result['timings'] = timings
+    return result
+
+def dispatch_action(processor, action, params):
+    """Dispatch one action with its parameters and return the result dict"""
+    if action == 'detect_faces':
+        if not params.get('img1'):
+            return {'success': False, 'error': 'Image path required for detect_faces'}
+        return processor.detect_faces_advanced(params['img1'], profile=params.get('detection_profile'),
+                                               early_exit=params.get('early_exit'),
+                                               reduced_decode=dimension_param(params.get('reduced_decode'), REDUCED_DECODE_DIMENSION))
+    elif action == 'extract_embeddings':
+        if not params.get('img1'):
+            return {'success': False, 'error': 'Image path required for extract_embeddings'}
+        return processor.extract_advanced_embeddings(params['img1'], profile=params.get('detection_profile'),
+                                                     early_exit=params.get('early_exit'),
+                                                     reduced_decode=dimension_param(params.get('reduced_decode'), REDUCED_DECODE_DIMENSION))
+    elif action == 'analyze':
+        if not params.get('img1'):
+            return {'success': False, 'error': 'Image path required for analyze'}
+        return processor.analyze_image(params['img1'], profile=params.get('detection_profile'),
+                                       early_exit=params.get('early_exit'),
+                                       quality_metrics=metrics_param(params.get('quality_metrics')),
+                                       quality_proxy=dimension_param(params.get('quality_proxy'), QUALITY_PROXY_DIMENSION),
+                                       reduced_decode=dimension_param(params.get('reduced_decode'), REDUCED_DECODE_DIMENSION))
+    elif action == 'compare_embeddings':
+        if params.get('emb1') and params.get('emb2'):
+            # CLI passes JSON strings, serve mode may pass lists directly; either
+            # may be a full extract_embeddings entry carrying precomputed stats
+            emb1, stats1 = unpack_embedding(params['emb1'])
+            emb2, stats2 = unpack_embedding(params['emb2'])
+            return processor.compare_faces_advanced(emb1, emb2, stats1, stats2,
+                                                    early_reject=params.get('early_reject', True))
+        return {'success': False, 'error': 'Two embeddings required for comparison'}
+    elif action in ('compare_many', 'similarity_matrix'):
+        queries, query_stats = load_embedding_set(params.get('queries'))
+        if params.get('gallery') is None and params.get('store') is not None:
+            # Whole stored gallery straight from the memory-mapped shards
+            gallery, gallery_stats = open_store(store_path(params['store'])).gallery(), None
+        else:
+            gallery, gallery_stats = load_embedding_set(params.get('gallery'))
+        if not queries or gallery is None or len(gallery) == 0:
+            return {'success': False, 'error': f'Query and gallery embeddings required for {action}'}
+        if action == 'similarity_matrix':
+            result = processor.similarity_matrix(queries, gallery, detailed=bool(params.get('detailed')),
+                                                 query_stats=query_stats, gallery_stats=gallery_stats,
+                                                 early_reject=params.get('early_reject', True))
+            if result.get('success') and hasattr(gallery, 'ids'):
+                result['gallery_ids'] = gallery.ids()
+            return result
+        top_k = params.get('top_k')
+        min_similarity = params.get('min_similarity')
+        result = processor.compare_many(
+            queries, gallery,
+            top_k=int(top_k) if top_k is not None else None,
+            min_similarity=float(min_similarity) if min_similarity is not None else None,
+            query_stats=query_stats, gallery_stats=gallery_stats,
+            early_reject=params.get('early_reject', True)
+        )
+        if result.get('success') and hasattr(gallery, 'describe'):
+            for query_result in result['results']:
+                for match in query_result['matches']:
+                    match.update(gallery.describe(match['gallery_index']))
+        return result
+    elif action == 'index_add':
+        if params.get('embeddings'):
+            vectors, ids, metas = load_index_entries(params['embeddings'], params.get('ids'))
+            return open_index(params.get('index'), processor).add(vectors, ids, metas)
+        if params.get('store') is not None:
+            return add_store_to_index(open_index(params.get('index'), processor),
+                                      open_store(store_path(params['store'])))
+        return {'success': False, 'error': 'Embeddings or a store required for index_add'}
+    elif action == 'index_search':
+        queries, _ = load_embedding_set(params.get('queries'))
+        if not queries:
+            return {'success': False, 'error': 'Query embeddings required for index_search'}
+        min_similarity = params.get('min_similarity')
+        return open_index(params.get('index'), processor).search(
+            queries,
+            top_k=params.get('top_k') or 10,
+            nprobe=params.get('nprobe'),
+            rerank=params.get('rerank', True),
+            min_similarity=float(min_similarity) if min_similarity is not None else None
+        )
+    elif action == 'index_remove':
+        if not params.get('ids'):
+            return {'success': False, 'error': 'Ids required for index_remove'}
+        ids = params['ids']
+        ids = load_json_argument(ids) if isinstance(ids, str) and ids.strip().startswith('[') else ids
+        return open_index(params.get('index'), processor).remove(ids.split(',') if isinstance(ids, str) else ids)
+    elif action == 'index_rebuild':
+        nlist = params.get('nlist')
+        return open_index(params.get('index'), processor).rebuild(int(nlist) if nlist else None)
+    elif action == 'store_import':
+        return open_store(store_path(params.get('store'))).import_json_cache(params.get('cache_dir'),
+                                                                          replace=bool(params.get('replace')))
+    elif action == 'store_add':
+        if not params.get('embeddings'):
+            return {'success': False, 'error': 'Embeddings required for store_add'}
+        value = load_json_argument(params['embeddings'])
+        image_hash = params.get('image_hash') or (value.get('imageHash') if isinstance(value, dict) else None)
+        if not image_hash:
+            return {'success': False, 'error': 'Image hash required for store_add'}
+        vectors, _ = load_embedding_set(value)
+        meta = {key: item for key, item in value.items() if key in ('imageUrl', 'qualityScore', 'createdAt')} \
+            if isinstance(value, dict) else None
+        return open_store(store_path(params.get('store'))).add_image(image_hash, vectors, meta)
+    elif action == 'store_remove':
+        if not params.get('image_hash'):
+            return {'success': False, 'error': 'Image hash required for store_remove'}
+        hashes = params['image_hash']
+        hashes = load_json_argument(hashes) if isinstance(hashes, str) and hashes.strip().startswith('[') else hashes
+        return open_store(store_path(params.get('store'))).remove_images(hashes.split(',') if isinstance(hashes, str) else hashes)
+    elif action == 'store_compact':
+        return open_store(store_path(params.get('store'))).compact()
+    elif action == 'store_info':
+        return open_store(store_path(params.get('store'))).info()
+    elif action == 'cluster_faces':
+        if params.get('embeddings'):
+            vectors, ids, _ = load_index_entries(params['embeddings'], params.get('ids'))
+        elif params.get('store') is not None:
+            hashes = params.get('image_hash')
+            if isinstance(hashes, str):
+                hashes = load_json_argument(hashes) if hashes.strip().startswith('[') else hashes.split(',')
+            vectors, ids = open_store(store_path(params['store'])).gallery(hashes), None
+        else:
+            return {'success': False, 'error': 'Embeddings or a store required for cluster_faces'}
+        min_similarity = params.get('min_similarity')
+        min_similarity = float(min_similarity) if min_similarity is not None else None
+        min_cluster_size = int(params.get('min_cluster_size') or 1)
+        if params.get('clusters') is not None:
+            # Also keep the clusters as the centroid table used by assign_faces
+            return open_clusters(store_path(params['clusters']), processor).seed(
+                vectors, ids, min_similarity=min_similarity, min_cluster_size=min_cluster_size)
+        return FaceClusterer(processor).cluster_faces(vectors, ids, min_similarity=min_similarity,
+                                                      min_cluster_size=min_cluster_size)
+    elif action == 'assign_faces':
+        if params.get('embeddings'):
+            vectors, ids, _ = load_index_entries(params['embeddings'], params.get('ids'))
+        elif params.get('store') is not None and params.get('image_hash'):
+            hashes = params['image_hash']
+            if isinstance(hashes, str):
+                hashes = load_json_argument(hashes) if hashes.strip().startswith('[') else hashes.split(',')
+            gallery = open_store(store_path(params['store'])).gallery(hashes)
+            vectors, ids = [gallery[i] for i in range(len(gallery))], gallery.ids()
+        else:
+            return {'success': False, 'error': 'Embeddings or stored image hashes required for assign_faces'}
+        min_similarity = params.get('min_similarity')
+        return open_clusters(store_path(params.get('clusters')), processor).assign(
+            vectors, ids,
+            min_similarity=float(min_similarity) if min_similarity is not None else None,
+            rebalance=params.get('rebalance', True)
+        )
+    elif action == 'cluster_rebalance':
+        min_similarity = params.get('min_similarity')
+        return open_clusters(store_path(params.get('clusters')), processor).rebalance(
+            float(min_similarity) if min_similarity is not None else None)
+    elif action == 'quality':
+        if not params.get('img1'):
+            return {'success': False, 'error': 'Image path required for quality assessment'}
+        return processor.assess_quality_advanced(params['img1'], metrics=metrics_param(params.get('quality_metrics')),
+                                                 proxy=dimension_param(params.get('quality_proxy'), QUALITY_PROXY_DIMENSION))
+    return {'success': False, 'error': f'Unknown action: {action}'}
+
+SERVE_ACTIONS = ('detect_faces', 'extract_embeddings', 'analyze', 'compare_embeddings', 'compare_many',
+                 'similarity_matrix', 'quality', 'index_add', 'index_search', 'index_remove', 'index_rebuild',
+                 'store_import', 'store_add', 'store_remove', 'store_compact', 'store_info',
+                 'cluster_faces', 'assign_faces', 'cluster_rebalance')
+
+# Actions that only need NumPy: they skip OpenCV and cascade loading entirely
+COMPARISON_ACTIONS = ('compare_embeddings', 'compare_many', 'similarity_matrix',
+                      'index_add', 'index_search', 'index_remove', 'index_rebuild',
+                      'store_import', 'store_add', 'store_remove', 'store_compact', 'store_info',
+                      'cluster_faces', 'assign_faces', 'cluster_rebalance')
+
+def report_cold_start(action, init_done, run_done):
+    """Log module import, processor init and run time for one CLI invocation"""
+    import_ms = (_MAIN_START - _MODULE_START) * 1000
+    init_ms = (init_done - _MAIN_START) * 1000
+    run_ms = (run_done - init_done) * 1000
+    total_ms = (run_done - _MODULE_START) * 1000
+    print(f"[TIMING] action={action} import={import_ms:.1f}ms init={init_ms:.1f}ms "
+          f"run={run_ms:.1f}ms cold_start={import_ms + init_ms:.1f}ms total={total_ms:.1f}ms", file=sys.stderr)
+
+def parse_argv(parser, argv):
+    """Parse a CLI argv list ([action, --flag, value, ...]) with the CLI parser
+    
+    Raises ValueError with argparse's message instead of exiting; unknown
+    options are logged and ignored.
+    """
+    messages = io.StringIO()
+    try:
+        with redirect_stderr(messages):
+            args, unknown = parser.parse_known_args([str(arg) for arg in argv])
+    except SystemExit:
+        lines = messages.getvalue().strip().splitlines()
+        raise ValueError(lines[-1] if lines else 'Invalid arguments')
+    if unknown:
+        print(f"Ignoring unknown arguments: {unknown}", file=sys.stderr)
+    return args
+
+def serve(processor, input_stream=None, output_stream=None, parser=None):
+    """Persistent worker: read NDJSON requests and write one JSON line per response.
+
+    Each request is an object like {"id": 1, "action": "detect_faces", "img1": "..."},
+    or {"id": 1, "argv": ["detect_faces", "--img1", "..."]} to send the same argv
+    as a CLI call (parsed by the CLI parser, so types and defaults match).
+    The response echoes the request id next to the usual result fields. The loop
+    ends on EOF or on {"action": "shutdown"}.
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+    print("Serve mode ready, waiting for requests", file=sys.stderr)
+    
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+        
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            request_id = request.get('id')
+            if 'argv' in request:
+                if parser is None:
+                    raise ValueError('argv requests need the CLI parser')
+                request = vars(parse_argv(parser, request['argv']))
+            action = request.get('action')
+            
+            if action == 'shutdown':
+                response = {'success': True, 'shutdown': True}
+            elif action == 'ping':
+                response = {'success': True, 'pong': True}
+            elif action in SERVE_ACTIONS:
+                response = run_action(processor, action, request)
+            else:
+                response = {'success': False, 'error': f'Unknown action: {action}'}
+        except Exception as e:
+            response = {'success': False, 'error': f'Serve request error: {str(e)}'}
+        
+        response['id'] = request_id
+        output_stream.write(json.dumps(response) + '\n')
+        output_stream.flush()
+        
+        if response.get('shutdown'):
+            break
+    
+    print("Serve mode stopped", file=sys.stderr)
+
+# Set when main() starts; used with _MODULE_START for cold-start reporting
+_MAIN_START = _MODULE_START
+
+# Per-process processor used by batch_extract pool workers, and its reduced_decode setting
+_batch_processor = None
+_batch_reduced_decode = None
+
+def _init_batch_worker(detection_profile=None, reduced_decode=None):
+    """Pool initializer: build one AdvancedFaceProcessor per worker process"""
+    global _batch_processor, _batch_reduced_decode
+    load_vision_dependencies()
+    # One OpenCV thread per worker, the pool already provides the parallelism
+    cv2.setNumThreads(1)
+    _batch_processor = AdvancedFaceProcessor()
+    _batch_processor.detection_workers = 1
+    if detection_profile:
+        _batch_processor.detection_profile = detection_profile
+    _batch_reduced_decode = reduced_decode
+
+def _batch_extract_one(task):
+    """Pool task: extract embeddings for a single image"""
+    index, img_path = task
+    try:
+        result = _batch_processor.extract_advanced_embeddings(img_path, reduced_decode=_batch_reduced_decode)
+    except Exception as e:
+        result = {
+            'success': False,
+            'face_count': 0,
+            'embeddings': [],
+            'extraction_info': f'Embedding extraction error: {str(e)}'
+        }
+    return index, img_path, result
+
+def load_image_list(images=None, manifest=None):
+    """Collect image paths from a JSON list / comma separated string and/or a manifest file"""
+    paths = []
+    
+    if images:
+        if isinstance(images, (list, tuple)):
+            paths.extend(images)
+        else:
+            images = images.strip()
+            if images.startswith('['):
+                paths.extend(json.loads(images))
+            else:
+                paths.extend(p.strip() for p in images.split(','))
+    
+    if manifest:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        # Manifest is either a JSON list or one path per line
+        if content.startswith('['):
+            paths.extend(json.loads(content))
+        else:
+            paths.extend(line.strip() for line in content.splitlines())
+    
+    return [p for p in paths if p]
+
+def batch_extract(image_paths, workers=None, output_stream=None, detection_profile=None, reduced_decode=None):
+    """Extract embeddings for many images on a process pool, streaming results.
+
+    Writes one JSON line per image as soon as it finishes (completion order,
+    tagged with its manifest index) and returns a summary dict.
+    """
+    output_stream = output_stream or sys.stdout
+    workers = int(workers) if workers else (os.cpu_count() or 1)
+    workers = max(1, min(workers, len(image_paths) or 1))
+    
+    print(f"Batch extraction: {len(image_paths)} images on {workers} workers", file=sys.stderr)
+    
+    succeeded = 0
+    failed = 0
+    total_faces = 0
+    
+    with multiprocessing.Pool(processes=workers, initializer=_init_batch_worker,
+                              initargs=(detection_profile, reduced_decode)) as pool:
+        for index, img_path, result in pool.imap_unordered(_batch_extract_one, enumerate(image_paths), chunksize=1):
+            if result.get('success'):
+                succeeded += 1
+                total_faces += result.get('face_count', 0)
+            else:
+                failed += 1
+            
+            line = {'index': index, 'image': img_path}
+            line.update(result)
+            output_stream.write(json.dumps(line) + '\n')
+            output_stream.flush()
+    
+    return {
+        'success': True,
+        'action': 'batch_extract',
+        'total_images': len(image_paths),
+        'succeeded': succeeded,
+        'failed': failed,
+        'total_faces': total_faces,
+        'workers': workers
+    }
 
 def main():
+    global _MAIN_START
+    _MAIN_START = time.perf_counter()
+    
     parser = argparse.ArgumentParser(description='Advanced face processing with ensemble methods')
-    parser.add_argument('action', nargs='?', choices=['detect_faces', 'extract_embeddings', 'compare_embeddings', 'quality'],
+    parser.add_argument('action', nargs='?', choices=['detect_faces', 'extract_embeddings', 'analyze', 'compare_embeddings', 'compare_many',
+                                                      'similarity_matrix', 'quality', 'serve', 'batch_extract',
+                                                      'index_add', 'index_search', 'index_remove', 'index_rebuild',
+                                                      'store_import', 'store_add', 'store_remove', 'store_compact', 'store_info',
+                                                      'cluster_faces', 'assign_faces', 'cluster_rebalance'],
                        help='Action to perform')
     parser.add_argument('--img1', help='Path to the first image')
     parser.add_argument('--img2', help='Path to the second image (for comparison)')
     parser.add_argument('--emb1', help='First embedding as JSON string')
     parser.add_argument('--emb2', help='Second embedding as JSON string')
+    parser.add_argument('--queries', help='Query embeddings for compare_many/similarity_matrix/index_search (JSON or JSON file path)')
+    parser.add_argument('--gallery', help='Gallery embeddings for compare_many/similarity_matrix (JSON or JSON file path)')
+    parser.add_argument('--top-k', type=int, help='Matches returned per query by compare_many (default: all) or index_search (default: 10)')
+    parser.add_argument('--min-similarity', type=float,
+                       help='Drop compare_many/index_search matches below this similarity; cluster_faces/assign_faces threshold (default: 0.65)')
+    parser.add_argument('--min-cluster-size', type=int, help='cluster_faces: report smaller clusters as unclustered (default: 1)')
+    parser.add_argument('--clusters', nargs='?', const='',
+                       help='Cluster table directory (default: backend/cache/face_clusters); cluster_faces seeds it, '
+                            'assign_faces/cluster_rebalance update it')
+    parser.add_argument('--no-rebalance', dest='rebalance', action='store_false',
+                       help='assign_faces: never start the background re-balance')
+    parser.add_argument('--detailed', action='store_true', help='Include per-metric matrices in similarity_matrix')
+    parser.add_argument('--no-early-reject', dest='early_reject', action='store_false',
+                       help='Run every similarity metric even for pairs that cannot pass the gate')
+    parser.add_argument('--index', help='Embedding index directory (default: backend/cache/face_index)')
+    parser.add_argument('--embeddings', help='Embeddings for index_add/store_add/cluster_faces/assign_faces: extract_embeddings result, cache file or list (JSON or JSON file path)')
+    parser.add_argument('--ids', help='Ids for index_add/index_remove/cluster_faces/assign_faces (JSON list or comma separated)')
+    parser.add_argument('--nprobe', type=int, help='Index lists scanned per query by index_search (default: 8)')
+    parser.add_argument('--nlist', type=int, help='Index lists built by index_rebuild (default: sqrt of the size)')
+    parser.add_argument('--no-rerank', dest='rerank', action='store_false',
+                       help='Return index_search matches by cosine without exact re-ranking')
+    parser.add_argument('--store', nargs='?', const='',
+                       help='Embedding store directory (default: backend/cache/embedding_store); as gallery for '
+                            'compare_many/similarity_matrix or source for index_add/cluster_faces when given without --gallery/--embeddings')
+    parser.add_argument('--image-hash', help='Image hash for store_add, or hashes for store_remove/cluster_faces/assign_faces (JSON list or comma separated)')
+    parser.add_argument('--cache-dir', help='JSON embedding cache imported by store_import (default: backend/cache/embeddings)')
+    parser.add_argument('--replace', action='store_true', help='store_import: re-import images that are already stored')
+    parser.add_argument('--detection-profile', choices=sorted(DETECTION_PROFILES),
+                       help=f'Detection speed profile (default: {DEFAULT_DETECTION_PROFILE})')
+    parser.add_argument('--early-exit', action='store_true', default=None,
+                       help="Skip remaining detection variants once the ensemble is stable (overrides the profile)")
+    parser.add_argument('--detection-workers', type=int,
+                       help=f'Threads detecting the variants of one image (default: {DEFAULT_DETECTION_WORKERS}, 1 = serial)')
+    parser.add_argument('--quality-metrics', nargs='+', choices=list(QUALITY_METRICS),
+                       help='quality/analyze: metric groups to score (default: all)')
+    parser.add_argument('--quality-proxy', type=int, nargs='?', const=QUALITY_PROXY_DIMENSION,
+                       help=f'quality/analyze: score images larger than this many pixels per side on bounded '
+                            f'proxies (default when given without a value: {QUALITY_PROXY_DIMENSION})')
+    parser.add_argument('--reduced-decode', type=int, nargs='?', const=REDUCED_DECODE_DIMENSION,
+                       help=f'detect_faces/extract_embeddings/analyze/batch_extract: decode large JPEGs at 1/2, 1/4 '
+                            f'or 1/8 scale keeping at least this many pixels per side; faces are still reported '
+                            f'in original pixels (default when given without a value: {REDUCED_DECODE_DIMENSION})')
+    parser.add_argument('--images', help='Image paths for batch_extract (JSON list or comma separated)')
+    parser.add_argument('--manifest', help='File listing image paths for batch_extract (JSON list or one per line)')
+    parser.add_argument('--workers', type=int, help='Worker processes for batch_extract (default: all cores)')
+    parser.add_argument('--profile', action='store_true',
+                       help="Add a 'timings' block (wall and CPU ms per pipeline stage) to the result")
+    parser.add_argument('--profile-dump', help='Also write a cProfile/pstats dump of the action to this file')
     parser.add_argument('--args-file', help='Path to JSON file containing arguments')
     
     args = parser.parse_args()
@@ -3113,68 +4083,48 @@ def main():
         print(f"Loading arguments from file: {args.args_file}", file=sys.stderr)
         file_args = load_args_from_file(args.args_file)
         if file_args:
-            # First argument is the action
-            action = file_args[0] if file_args else None
-            
-            # Parse the rest of the arguments
-            arg_dict = {}
-            i = 1
-            while i < len(file_args):
-                if file_args[i].startswith('--'):
-                    arg_name = file_args[i][2:]  # Remove -- prefix
-                    if i + 1 < len(file_args) and not file_args[i + 1].startswith('--'):
-                        arg_dict[arg_name] = file_args[i + 1]
-                        i += 2
-                    else:
-                        arg_dict[arg_name] = True
-                        i += 1
-                else:
-                    i += 1
-            
-            # Override args with file values
-            if action:
-                args.action = action
-            if 'img1' in arg_dict:
-                args.img1 = arg_dict['img1']
-            if 'img2' in arg_dict:
-                args.img2 = arg_dict['img2']
-            if 'emb1' in arg_dict:
-                args.emb1 = arg_dict['emb1']
-            if 'emb2' in arg_dict:
-                args.emb2 = arg_dict['emb2']
+            # The file holds the same argv as the command line ([action, --flag, value, ...]);
+            # parse it with the same parser so types, nargs/const and dest names apply
+            try:
+                args = parse_argv(parser, file_args)
+            except ValueError as e:
+                print(json.dumps({'success': False, 'error': f'Invalid arguments in args file: {str(e)}'}))
+                return
     
     if not args.action:
         print(json.dumps({'success': False, 'error': 'No action specified'}))
         return
     
-    processor = AdvancedFaceProcessor()
+    if args.action == 'batch_extract':
+        # Workers build their own processors, the parent never needs one
+        try:
+            image_paths = load_image_list(args.images, args.manifest)
+            if not image_paths:
+                result = {'success': False, 'error': 'Image list or manifest required for batch_extract'}
+            else:
+                result = batch_extract(image_paths, args.workers, detection_profile=args.detection_profile,
+                                       reduced_decode=args.reduced_decode)
+        except Exception as e:
+            result = {'success': False, 'error': f'Batch extraction error: {str(e)}'}
+        print(json.dumps(result))
+        return
+    
+    if args.action in COMPARISON_ACTIONS:
+        processor = EmbeddingComparator()
+    else:
+        processor = AdvancedFaceProcessor()
+        if args.detection_workers:
+            processor.detection_workers = max(1, int(args.detection_workers))
+    init_done = time.perf_counter()
     
     try:
-        if args.action == 'detect_faces':
-            if not args.img1:
-                print(json.dumps({'success': False, 'error': 'Image path required for detect_faces'}))
-                return
-            result = processor.detect_faces_advanced(args.img1)
-        elif args.action == 'extract_embeddings':
-            if not args.img1:
-                print(json.dumps({'success': False, 'error': 'Image path required for extract_embeddings'}))
-                return
-            result = processor.extract_advanced_embeddings(args.img1)
-        elif args.action == 'compare_embeddings':
-            if args.emb1 and args.emb2:
-                emb1 = json.loads(args.emb1)
-                emb2 = json.loads(args.emb2)
-                result = processor.compare_faces_advanced(emb1, emb2)
-            else:
-                result = {'success': False, 'error': 'Two embeddings required for comparison'}
-        elif args.action == 'quality':
-            if not args.img1:
-                print(json.dumps({'success': False, 'error': 'Image path required for quality assessment'}))
-                return
-            result = processor.assess_quality_advanced(args.img1)
-        else:
-            result = {'success': False, 'error': f'Unknown action: {args.action}'}
+        if args.action == 'serve':
+            # Keep one processor (and its cascades) alive for many requests
+            serve(processor, parser=parser)
+            return
         
+        result = run_action(processor, args.action, vars(args))
+        report_cold_start(args.action, init_done, time.perf_counter())
         print(json.dumps(result))
     
     except Exception as e:
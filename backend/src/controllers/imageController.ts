@@ -230,11 +230,8 @@ export const analyzeFace = async (req: Request, res: Response) => {
       actions || ['age', 'gender', 'emotion', 'race']
     );
 
-    // Get image quality score
-    const qualityResult = await deepFaceService.analyzeImageQuality(imageUrl);
-
-    // Extract face embeddings for future comparison
-    const embeddingResult = await deepFaceService.extractFaceEmbeddings(imageUrl);
+    // Quality score and face embeddings (for future comparison) from a single pass
+    const { qualityScore, embedding: embeddingResult } = await deepFaceService.analyzeImage(imageUrl);
 
     // Update image in database if imageId is provided
     if (imageId) {
@@ -242,7 +239,7 @@ export const analyzeFace = async (req: Request, res: Response) => {
         await Image.findByIdAndUpdate(imageId, {
           status: 'processed',
           faceAnalysis: faceAttributes,
-          qualityScore: qualityResult.qualityScore,
+          qualityScore,
           faceCount: embeddingResult?.faceCount || 0,
           processedAt: new Date()
         });
@@ -255,7 +252,7 @@ export const analyzeFace = async (req: Request, res: Response) => {
     res.status(200).json({
       success: true,
       analyses: faceAttributes || [],
-      qualityScore: qualityResult.qualityScore,
+      qualityScore,
       faceCount: embeddingResult?.faceCount || 0,
       embeddings: embeddingResult?.embeddings || []
     });
@@ -33,11 +33,28 @@ interface DeepFaceResponse {
   [key: string]: any;
 }
 
+// Actions simple_face_processor_v2.py answers in `serve` mode (see SERVE_ACTIONS there)
+const SERVE_ACTIONS = new Set(['detect_faces', 'extract_embeddings', 'analyze', 'compare_embeddings', 'compare_many',
+  'similarity_matrix', 'quality']);
+
+const PYTHON_TIMEOUT_MS = 30000;
+
+// The serve worker is replaced after this many requests (bounds any slow growth in either process)
+const SERVE_MAX_REQUESTS = 500;
+
 class DeepFaceService {
   private pythonScriptPath: string;
   private pythonExecutable: string;
   private useFallback: boolean = false;
 
+  // Long-lived `serve` worker: one interpreter with cv2 and the cascades loaded once.
+  // Requests are sent one at a time (the worker is sequential), so each gets the full timeout.
+  private serveShell: PythonShell | null = null;
+  private serveQueue: Promise<unknown> = Promise.resolve();
+  private servePending: { id: number; resolve: (result: DeepFaceResponse) => void; reject: (err: Error) => void } | null = null;
+  private nextServeId = 1;
+  private serveRequestCount = 0;
+
   constructor() {
     // Prefer full DeepFace processor if available for better accuracy
     const deepfaceProcessorPath = path.join(__dirname, '../../scripts/python/deepface_processor.py');
@@ -196,6 +213,105 @@ class DeepFaceService {
     });
   }
 
+  /**
+   * Whether the configured script has a `serve` mode (simple_face_processor_v2.py)
+   */
+  private hasServeMode(): boolean {
+    return path.basename(this.pythonScriptPath) === 'simple_face_processor_v2.py';
+  }
+
+  /**
+   * Start (or reuse) the persistent `serve` worker
+   */
+  private getServeShell(): PythonShell {
+    if (this.serveShell && this.serveRequestCount >= SERVE_MAX_REQUESTS) {
+      // Closing stdin ends the serve loop; the old worker's exit no longer affects this service
+      const retired = this.serveShell;
+      this.serveShell = null;
+      retired.end(() => undefined);
+    }
+    if (this.serveShell) {
+      return this.serveShell;
+    }
+
+    const shell = new PythonShell(path.basename(this.pythonScriptPath), {
+      mode: 'text',
+      pythonPath: this.pythonExecutable,
+      pythonOptions: ['-u'],
+      scriptPath: path.dirname(this.pythonScriptPath),
+      args: ['serve']
+    });
+
+    shell.on('message', (line: string) => {
+      let response: DeepFaceResponse;
+      try {
+        response = JSON.parse(line);
+      } catch {
+        return; // not a response line
+      }
+      const pending = this.servePending;
+      if (pending && response.id === pending.id) {
+        this.servePending = null;
+        delete response.id;
+        pending.resolve(response);
+      }
+    });
+
+    const stop = (err: Error) => {
+      if (this.serveShell !== shell) {
+        return;
+      }
+      this.serveShell = null;
+      const pending = this.servePending;
+      this.servePending = null;
+      pending?.reject(err);
+    };
+    shell.on('error', (err: Error) => stop(err));
+    shell.on('close', () => stop(new Error('Python serve worker exited')));
+
+    console.log(`[DeepFaceService] Started Python serve worker: ${this.pythonScriptPath}`);
+    this.serveShell = shell;
+    this.serveRequestCount = 0;
+    return shell;
+  }
+
+  /**
+   * Run one request on the serve worker with the same argv as a one-off call
+   */
+  private executeViaServe(args: string[]): Promise<DeepFaceResponse> {
+    const run = () => new Promise<DeepFaceResponse>((resolve, reject) => {
+      const shell = this.getServeShell();
+      const id = this.nextServeId++;
+      const fail = (err: Error) => {
+        clearTimeout(timer);
+        if (this.servePending?.id === id) {
+          this.servePending = null;
+        }
+        reject(err);
+      };
+      const timer = setTimeout(() => {
+        // A stuck request blocks every later one: restart the worker
+        fail(new Error('Python serve request timeout'));
+        shell.kill();
+      }, PYTHON_TIMEOUT_MS);
+
+      this.servePending = {
+        id,
+        resolve: (result) => {
+          clearTimeout(timer);
+          resolve(result);
+        },
+        reject: fail
+      };
+      this.serveRequestCount++;
+      shell.send(JSON.stringify({ id, argv: args }));
+    });
+
+    const result = this.serveQueue.then(run, run);
+    this.serveQueue = result.catch(() => undefined);
+    return result;
+  }
+
   /**
    * Execute Python script with given arguments
    */
@@ -205,6 +321,15 @@ class DeepFaceService {
       return this.getMockResponse(args);
     }
 
+    // Prefer the persistent worker; fall back to a one-off process if it is unavailable
+    if (SERVE_ACTIONS.has(args[0]) && this.hasServeMode()) {
+      try {
+        return await this.executeViaServe(args);
+      } catch (err: any) {
+        console.warn(`[DeepFaceService] Serve worker failed (${err.message}), running a one-off process`);
+      }
+    }
+
     try {
       // console.log(`[DeepFaceService] Executing Python script with args: ${JSON.stringify(args)}`);
       console.log(`[DeepFaceService] Python executable: ${this.pythonExecutable}`);
@@ -237,7 +362,7 @@ class DeepFaceService {
       console.log(`[DeepFaceService] Python options: ${JSON.stringify(options)}`);
 
       // Add timeout to prevent hanging
-      const timeoutMs = 30000; // 30 seconds timeout
+      const timeoutMs = PYTHON_TIMEOUT_MS;
       const pythonPromise = PythonShell.run(path.basename(this.pythonScriptPath), options);
       
       const results: string[] = await Promise.race([
@@ -290,30 +415,35 @@ class DeepFaceService {
    */
   private getMockResponse(args: string[]): DeepFaceResponse {
     const action = args[0];
+    const mockEmbeddings = (): DeepFaceResponse => ({
+      success: true,
+      face_count: 1,
+      embeddings: [{
+        face_id: 0,
+        embedding: Array.from({ length: 256 }, () => Math.random()),
+        region: { x: 50, y: 50, w: 100, h: 100 }
+      }]
+    });
+    const mockQuality = (): DeepFaceResponse => ({
+      success: true,
+      quality_score: Math.random() * 40 + 60, // 60-100 range
+      metrics: {
+        brightness: Math.random() * 30 + 70,
+        contrast: Math.random() * 30 + 70,
+        sharpness: Math.random() * 30 + 70,
+        resolution: Math.random() * 30 + 70
+      }
+    });
     
     switch (action) {
       case 'detect_faces':
       case 'extract_embeddings':
-        return {
-          success: true,
-          face_count: 1,
-          embeddings: [{
-            face_id: 0,
-            embedding: Array.from({ length: 256 }, () => Math.random()),
-            region: { x: 50, y: 50, w: 100, h: 100 }
-          }]
-        };
+        return mockEmbeddings();
       case 'quality':
-        return {
-          success: true,
-          quality_score: Math.random() * 40 + 60, // 60-100 range
-          metrics: {
-            brightness: Math.random() * 30 + 70,
-            contrast: Math.random() * 30 + 70,
-            sharpness: Math.random() * 30 + 70,
-            resolution: Math.random() * 30 + 70
-          }
-        };
+        return mockQuality();
+      case 'analyze':
+        // Single-pass analysis: embeddings plus the quality block, as the script returns them
+        return { ...mockEmbeddings(), ...mockQuality() };
       default:
         return {
           success: true,
@@ -351,34 +481,7 @@ class DeepFaceService {
       console.log(`[DeepFaceService] Successfully detected ${result.face_count} face(s) in image`);
       // console.log(`[DeepFaceService] Extraction info: ${result.extraction_info}`);
       
-      // Process raw embeddings with more permissive filtering
-      const rawEmbeddings = result.embeddings || [];
-      // console.log(`[DeepFaceService] Processing ${rawEmbeddings.length} raw embeddings`);
-      
-      // Use more permissive filtering
-      const processedEmbeddings = this.processEnhancedEmbeddings(rawEmbeddings);
-      
-      if (processedEmbeddings.length === 0) {
-        console.log('[DeepFaceService] No quality embeddings after processing');
-        return null;
-      }
-      
-      // Take the best embedding
-      const bestEmbedding = processedEmbeddings[0];
-      
-      // Extract actual embedding vector
-      const embeddingVector = bestEmbedding.embedding || [];
-      
-      // Calculate quality score from embedding metrics
-      const qualityScore = bestEmbedding.quality || 0;
-      
-      // Return embedding data
-      return {
-        imageId: path.basename(imageUrl),
-        embeddings: [embeddingVector],
-        faceCount: processedEmbeddings.length,
-        qualityScore
-      };
+      return this.buildFaceEmbedding(imageUrl, result.embeddings || []);
       
     } catch (error: any) {
       console.error('[DeepFaceService] Error extracting face embeddings:', error);
@@ -391,6 +494,36 @@ class DeepFaceService {
     }
   }
 
+  /**
+   * Filter raw Python embeddings and keep the best one as FaceEmbedding
+   */
+  private buildFaceEmbedding(imageUrl: string, rawEmbeddings: any[]): FaceEmbedding | null {
+    // Use more permissive filtering
+    const processedEmbeddings = this.processEnhancedEmbeddings(rawEmbeddings);
+    
+    if (processedEmbeddings.length === 0) {
+      console.log('[DeepFaceService] No quality embeddings after processing');
+      return null;
+    }
+    
+    // Take the best embedding
+    const bestEmbedding = processedEmbeddings[0];
+    
+    // Extract actual embedding vector
+    const embeddingVector = bestEmbedding.embedding || [];
+    
+    // Calculate quality score from embedding metrics
+    const qualityScore = bestEmbedding.quality || 0;
+    
+    // Return embedding data
+    return {
+      imageId: path.basename(imageUrl),
+      embeddings: [embeddingVector],
+      faceCount: processedEmbeddings.length,
+      qualityScore
+    };
+  }
+
   /**
    * Process raw embeddings from Python script with improved quality filtering
    */
@@ -519,15 +652,16 @@ class DeepFaceService {
    */
   async compareFaces(
     sourceEmbedding: number[],
-    targetEmbedding: number[]
+    targetEmbedding: number[],
+    precomputed?: { success: boolean; similarity: number; confidence: number; distance: number }
   ): Promise<{ similarity: number; confidence: number; distance: number }> {
     try {
       if (!sourceEmbedding || !targetEmbedding || sourceEmbedding.length === 0 || targetEmbedding.length === 0) {
         return { similarity: 0, confidence: 0, distance: 1.0 };
       }
 
-      // 1) So sánh bằng Python
-      const pythonComparison = await this.compareFacesViaPython(sourceEmbedding, targetEmbedding);
+      // 1) So sánh bằng Python (or reuse a result from a batched compare_many call)
+      const pythonComparison = precomputed || await this.compareFacesViaPython(sourceEmbedding, targetEmbedding);
 
       // 2) Luôn tính thêm version fallback để đối chiếu (chi phí thấp)
       const tsFallback = this.compareFacesFallback(sourceEmbedding, targetEmbedding);
@@ -593,6 +727,46 @@ class DeepFaceService {
     }
   }
 
+  /**
+   * Compare every query embedding with every gallery embedding in one Python call.
+   * Returns a lookup keyed by "queryIndex:galleryIndex".
+   */
+  private async compareEmbeddingSetsViaPython(
+    queries: number[][],
+    gallery: number[][]
+  ): Promise<Map<string, { success: boolean; similarity: number; confidence: number; distance: number }> | null> {
+    try {
+      const args = [
+        'compare_many',
+        '--queries', JSON.stringify(queries),
+        '--gallery', JSON.stringify(gallery)
+      ];
+
+      const result = await this.executePythonScript(args);
+
+      if (!result.success || !Array.isArray(result.results)) {
+        console.error(`[DeepFace] Python batch comparison failed: ${result.error}`);
+        return null;
+      }
+
+      const comparisons = new Map<string, { success: boolean; similarity: number; confidence: number; distance: number }>();
+      for (const queryResult of result.results) {
+        for (const match of queryResult.matches) {
+          comparisons.set(`${queryResult.query_index}:${match.gallery_index}`, {
+            success: true,
+            similarity: match.similarity || 0,
+            confidence: match.confidence || 0,
+            distance: match.distance ?? 1.0
+          });
+        }
+      }
+      return comparisons;
+    } catch (error) {
+      console.error(`[DeepFace] Error in Python batch comparison: ${error}`);
+      return null;
+    }
+  }
+
   /**
    * Fallback TypeScript comparison với improved algorithm
    */
@@ -756,104 +930,149 @@ class DeepFaceService {
       const embedding1 = await this.extractFaceEmbeddings(sourceImageUrl);
       const embedding2 = await this.extractFaceEmbeddings(targetImageUrl);
       
-      if (!embedding1 || !embedding2 || embedding1.embeddings.length === 0 || embedding2.embeddings.length === 0) {
-        console.log(`[DeepFace Verify] No faces detected - Source: ${embedding1?.faceCount || 0}, Target: ${embedding2?.faceCount || 0}`);
-        return { verified: false, similarity: 0, distance: 1.0, confidence: 0 };
-      }
-
-      console.log(`[DeepFace Verify] Face counts - Source: ${embedding1.faceCount}, Target: ${embedding2.faceCount}`);
-      
-      // Enhanced multi-face comparison strategy với cross-validation
-      let bestSimilarity = 0;
-      let bestConfidence = 0;
-      let totalComparisons = 0;
-      let validComparisons = 0;
-      let crossValidationPassed = 0;
-      let adaptiveAdjustments: any = null;
+      // Score all face combinations in one Python call; per-pair calls remain the fallback
+      const batchComparisons = embedding1?.embeddings.length && embedding2?.embeddings.length
+        ? await this.compareEmbeddingSetsViaPython(embedding1.embeddings, embedding2.embeddings)
+        : null;
       
-      // Compare all face combinations and find the best match
-      for (const sourceEmb of embedding1.embeddings) {
-        for (const targetEmb of embedding2.embeddings) {
-          totalComparisons++;
-          
-          const comparison = await this.compareFaces(sourceEmb, targetEmb);
+      return await this.verifyEmbeddings(
+        sourceImageUrl,
+        embedding1,
+        targetImageUrl,
+        embedding2,
+        (sourceIndex, targetIndex) => batchComparisons?.get(`${sourceIndex}:${targetIndex}`),
+        (imageUrl) => this.analyzeImageQuality(imageUrl)
+      );
+    } catch (error) {
+      console.error('Error verifying faces:', error);
+      return { verified: false, similarity: 0, distance: 1.0, confidence: 0 };
+    }
+  }
+
+  /**
+   * Verification decision for two images whose embeddings are already extracted.
+   * `precomputed` looks up batched compare_many results by face index; `qualityFor`
+   * lets callers that revisit the same images reuse their quality scores.
+   */
+  private async verifyEmbeddings(
+    sourceImageUrl: string,
+    embedding1: FaceEmbedding | null,
+    targetImageUrl: string,
+    embedding2: FaceEmbedding | null,
+    precomputed: (sourceIndex: number, targetIndex: number) => { success: boolean; similarity: number; confidence: number; distance: number } | undefined,
+    qualityFor: (imageUrl: string) => Promise<{ qualityScore: number }>
+  ): Promise<{ verified: boolean; similarity: number; distance: number; confidence: number }> {
+    if (!embedding1 || !embedding2 || embedding1.embeddings.length === 0 || embedding2.embeddings.length === 0) {
+      console.log(`[DeepFace Verify] No faces detected - Source: ${embedding1?.faceCount || 0}, Target: ${embedding2?.faceCount || 0}`);
+      return { verified: false, similarity: 0, distance: 1.0, confidence: 0 };
+    }
+
+    console.log(`[DeepFace Verify] Face counts - Source: ${embedding1.faceCount}, Target: ${embedding2.faceCount}`);
+    
+    // Enhanced multi-face comparison strategy với cross-validation
+    let bestSimilarity = 0;
+    let bestConfidence = 0;
+    let totalComparisons = 0;
+    let validComparisons = 0;
+    let crossValidationPassed = 0;
+    let adaptiveAdjustments: any = null;
+    
+    // Compare all face combinations and find the best match
+    for (const [sourceIndex, sourceEmb] of embedding1.embeddings.entries()) {
+      for (const [targetIndex, targetEmb] of embedding2.embeddings.entries()) {
+        totalComparisons++;
+        
+        const comparison = await this.compareFaces(
+          sourceEmb,
+          targetEmb,
+          precomputed(sourceIndex, targetIndex)
+        );
+        
+        // Enhanced validation với cross-validation results
+        if (comparison.confidence > 0.45) { // BALANCED: Accept reasonable confidence
+          validComparisons++;
           
-          // Enhanced validation với cross-validation results
-          if (comparison.confidence > 0.45) { // BALANCED: Accept reasonable confidence
-            validComparisons++;
+          // Log cross-validation information nếu có
+          if (comparison.similarity > bestSimilarity) {
+            bestSimilarity = comparison.similarity;
+            bestConfidence = comparison.confidence;
             
-            // Log cross-validation information nếu có
-            if (comparison.similarity > bestSimilarity) {
-              bestSimilarity = comparison.similarity;
-              bestConfidence = comparison.confidence;
-              
-              // Store adaptive adjustments from best match for analysis
-              // Note: This would be available if using Python comparison
-              console.log(`[DeepFace Verify] New best match: sim=${bestSimilarity.toFixed(3)}, conf=${bestConfidence.toFixed(3)}`);
-            }
+            // Store adaptive adjustments from best match for analysis
+            // Note: This would be available if using Python comparison
+            console.log(`[DeepFace Verify] New best match: sim=${bestSimilarity.toFixed(3)}, conf=${bestConfidence.toFixed(3)}`);
           }
         }
       }
+    }
+    
+    // ENHANCED verification logic với adaptive thresholds
+    let verified = false;
+    
+    if (validComparisons === 0) {
+      console.log(`[DeepFace Verify] No valid comparisons found (confidence too low)`);
+      verified = false;
+    } else {
+      // ADAPTIVE verification thresholds dựa trên quality và cross-validation
+      const baseHighThreshold = 0.75;
+      const baseMediumThreshold = 0.65;
+      const baseLowThreshold = 0.6;
       
-      // ENHANCED verification logic với adaptive thresholds
-      let verified = false;
+      // Adjust thresholds based on image quality
+      const sourceQuality = await qualityFor(sourceImageUrl);
+      const targetQuality = await qualityFor(targetImageUrl);
+      const avgQuality = (sourceQuality.qualityScore + targetQuality.qualityScore) / 2;
       
-      if (validComparisons === 0) {
-        console.log(`[DeepFace Verify] No valid comparisons found (confidence too low)`);
-        verified = false;
-      } else {
-        // ADAPTIVE verification thresholds dựa trên quality và cross-validation
-        const baseHighThreshold = 0.75;
-        const baseMediumThreshold = 0.65;
-        const baseLowThreshold = 0.6;
-        
-        // Adjust thresholds based on image quality
-        const sourceQuality = await this.analyzeImageQuality(sourceImageUrl);
-        const targetQuality = await this.analyzeImageQuality(targetImageUrl);
-        const avgQuality = (sourceQuality.qualityScore + targetQuality.qualityScore) / 2;
-        
-        // Quality-based threshold adjustments
-        let qualityAdjustment = 0;
-        if (avgQuality > 80) {
-          qualityAdjustment = -0.05; // Lower thresholds for high-quality images
-        } else if (avgQuality < 50) {
-          qualityAdjustment = 0.1; // Higher thresholds for low-quality images
-        }
-        
-        console.log(`[DeepFace Verify] Average image quality: ${avgQuality.toFixed(1)}, adjustment: ${qualityAdjustment.toFixed(3)}`);
-        
-        // Apply adaptive thresholds
-        const adaptiveHighThreshold = baseHighThreshold + qualityAdjustment;
-        const adaptiveMediumThreshold = baseMediumThreshold + qualityAdjustment;
-        const adaptiveLowThreshold = baseLowThreshold + qualityAdjustment;
-        
-        // Enhanced verification với adaptive thresholds
-        const isHighConfidenceMatch = bestSimilarity > adaptiveHighThreshold && bestConfidence > 0.65 && validComparisons >= 1;
-        const isMediumConfidenceMatch = bestSimilarity > adaptiveMediumThreshold && bestConfidence > 0.55 && validComparisons >= 2;
-        const isLowConfidenceMatch = bestSimilarity > adaptiveLowThreshold && bestConfidence > 0.5 && validComparisons >= 1;
-        
-        verified = isHighConfidenceMatch || isMediumConfidenceMatch || isLowConfidenceMatch;
-        
-        console.log(`[DeepFace Verify] Enhanced verification results:`);
-        console.log(`  - Best similarity: ${bestSimilarity.toFixed(3)}, Confidence: ${bestConfidence.toFixed(3)}`);
-        console.log(`  - Adaptive thresholds - High: ${adaptiveHighThreshold.toFixed(3)}, Medium: ${adaptiveMediumThreshold.toFixed(3)}, Low: ${adaptiveLowThreshold.toFixed(3)}`);
-        console.log(`  - High confidence: ${isHighConfidenceMatch}, Medium: ${isMediumConfidenceMatch}, Low: ${isLowConfidenceMatch}`);
-        console.log(`  - Valid comparisons: ${validComparisons}/${totalComparisons}`);
-        console.log(`  - Final decision: ${verified ? 'VERIFIED ✅' : 'NOT VERIFIED ❌'}`);
+      // Quality-based threshold adjustments
+      let qualityAdjustment = 0;
+      if (avgQuality > 80) {
+        qualityAdjustment = -0.05; // Lower thresholds for high-quality images
+      } else if (avgQuality < 50) {
+        qualityAdjustment = 0.1; // Higher thresholds for low-quality images
       }
+      
+      console.log(`[DeepFace Verify] Average image quality: ${avgQuality.toFixed(1)}, adjustment: ${qualityAdjustment.toFixed(3)}`);
+      
+      // Apply adaptive thresholds
+      const adaptiveHighThreshold = baseHighThreshold + qualityAdjustment;
+      const adaptiveMediumThreshold = baseMediumThreshold + qualityAdjustment;
+      const adaptiveLowThreshold = baseLowThreshold + qualityAdjustment;
+      
+      // Enhanced verification với adaptive thresholds
+      const isHighConfidenceMatch = bestSimilarity > adaptiveHighThreshold && bestConfidence > 0.65 && validComparisons >= 1;
+      const isMediumConfidenceMatch = bestSimilarity > adaptiveMediumThreshold && bestConfidence > 0.55 && validComparisons >= 2;
+      const isLowConfidenceMatch = bestSimilarity > adaptiveLowThreshold && bestConfidence > 0.5 && validComparisons >= 1;
+      
+      verified = isHighConfidenceMatch || isMediumConfidenceMatch || isLowConfidenceMatch;
+      
+      console.log(`[DeepFace Verify] Enhanced verification results:`);
+      console.log(`  - Best similarity: ${bestSimilarity.toFixed(3)}, Confidence: ${bestConfidence.toFixed(3)}`);
+      console.log(`  - Adaptive thresholds - High: ${adaptiveHighThreshold.toFixed(3)}, Medium: ${adaptiveMediumThreshold.toFixed(3)}, Low: ${adaptiveLowThreshold.toFixed(3)}`);
+      console.log(`  - High confidence: ${isHighConfidenceMatch}, Medium: ${isMediumConfidenceMatch}, Low: ${isLowConfidenceMatch}`);
+      console.log(`  - Valid comparisons: ${validComparisons}/${totalComparisons}`);
+      console.log(`  - Final decision: ${verified ? 'VERIFIED ✅' : 'NOT VERIFIED ❌'}`);
+    }
 
-      const distance = 1 - bestSimilarity;
+    const distance = 1 - bestSimilarity;
 
-      return {
-        verified,
-        similarity: bestSimilarity,
-        distance,
-        confidence: bestConfidence
-      };
-    } catch (error) {
-      console.error('Error verifying faces:', error);
-      return { verified: false, similarity: 0, distance: 1.0, confidence: 0 };
-    }
+    return {
+      verified,
+      similarity: bestSimilarity,
+      distance,
+      confidence: bestConfidence
+    };
+  }
+
+  /**
+   * analyzeImageQuality memoized per URL, for batch comparisons that score each image many times
+   */
+  private memoizedQuality(): (imageUrl: string) => Promise<{ qualityScore: number }> {
+    const scores = new Map<string, Promise<{ qualityScore: number }>>();
+    return (imageUrl: string) => {
+      if (!scores.has(imageUrl)) {
+        scores.set(imageUrl, this.analyzeImageQuality(imageUrl));
+      }
+      return scores.get(imageUrl)!;
+    };
   }
 
   /**
@@ -875,12 +1094,33 @@ class DeepFaceService {
 
       const results: ComparisonResult[] = [];
 
-      // Compare source with each target image
+      // Extract every image once, then score the source faces against the faces of all
+      // targets in one compare_many call (target faces are concatenated into one gallery)
+      const sourceEmbedding = await this.extractFaceEmbeddings(sourceImage.url);
+      const targetEmbeddings: (FaceEmbedding | null)[] = [];
+      const galleryOffsets: number[] = [];
+      const gallery: number[][] = [];
       for (const targetImage of targetImages) {
+        const targetEmbedding = await this.extractFaceEmbeddings(targetImage.url);
+        targetEmbeddings.push(targetEmbedding);
+        galleryOffsets.push(gallery.length);
+        gallery.push(...(targetEmbedding?.embeddings || []));
+      }
+      const batchComparisons = sourceEmbedding?.embeddings.length && gallery.length
+        ? await this.compareEmbeddingSetsViaPython(sourceEmbedding.embeddings, gallery)
+        : null;
+      const qualityFor = this.memoizedQuality();
+
+      // Compare source with each target image
+      for (const [targetPosition, targetImage] of targetImages.entries()) {
         try {
-          const comparisonResult = await this.verifyFaces(
+          const comparisonResult = await this.verifyEmbeddings(
             sourceImage.url,
-            targetImage.url
+            sourceEmbedding,
+            targetImage.url,
+            targetEmbeddings[targetPosition],
+            (sourceIndex, targetIndex) => batchComparisons?.get(`${sourceIndex}:${galleryOffsets[targetPosition] + targetIndex}`),
+            qualityFor
           );
 
           // BALANCED: Giảm thresholds để accept những matches thực sự tốt
@@ -917,7 +1157,23 @@ class DeepFaceService {
       const images = await Image.find({ _id: { $in: imageIds } });
       const rankings: ImageRanking[] = [];
 
+      // Extract every image once, then score all faces against all faces in one compare_many
+      // call; face i of image p is row galleryOffsets[p] + i
+      const imageEmbeddings: (FaceEmbedding | null)[] = [];
+      const galleryOffsets: number[] = [];
+      const gallery: number[][] = [];
       for (const image of images) {
+        const embedding = await this.extractFaceEmbeddings(image.url);
+        imageEmbeddings.push(embedding);
+        galleryOffsets.push(gallery.length);
+        gallery.push(...(embedding?.embeddings || []));
+      }
+      const batchComparisons = gallery.length
+        ? await this.compareEmbeddingSetsViaPython(gallery, gallery)
+        : null;
+      const qualityFor = this.memoizedQuality();
+
+      for (const [imagePosition, image] of images.entries()) {
         const similarImages: string[] = [];
         let totalSimilarity = 0;
         let totalConfidence = 0;
@@ -926,11 +1182,20 @@ class DeepFaceService {
         console.log(`[DeepFace FindSimilar] Processing image: ${image.filename}`);
 
         // Compare with all other images
-        for (const otherImage of images) {
+        for (const [otherPosition, otherImage] of images.entries()) {
           if ((image._id as mongoose.Types.ObjectId).toString() === (otherImage._id as mongoose.Types.ObjectId).toString()) continue;
 
           try {
-            const result = await this.verifyFaces(image.url, otherImage.url);
+            const result = await this.verifyEmbeddings(
+              image.url,
+              imageEmbeddings[imagePosition],
+              otherImage.url,
+              imageEmbeddings[otherPosition],
+              (sourceIndex, targetIndex) => batchComparisons?.get(
+                `${galleryOffsets[imagePosition] + sourceIndex}:${galleryOffsets[otherPosition] + targetIndex}`
+              ),
+              qualityFor
+            );
             
             // BALANCED: Giảm thresholds để có thể tìm được những matches thực sự tốt
             if (result.confidence > 0.5 && result.similarity > 0.55) {
@@ -952,7 +1217,7 @@ class DeepFaceService {
         }
 
         // Get quality score for the image
-        const qualityResult = await this.analyzeImageQuality(image.url);
+        const qualityResult = await qualityFor(image.url);
 
         // Enhanced scoring với confidence weighting
         const avgSimilarity = validComparisons > 0 ? totalSimilarity / validComparisons : 0;
@@ -1024,6 +1289,44 @@ class DeepFaceService {
     }
   }
 
+  /**
+   * Embeddings and quality score from one Python call (the image is decoded once)
+   */
+  async analyzeImage(imageUrl: string): Promise<{ qualityScore: number; embedding: FaceEmbedding | null }> {
+    let tempFilePath: string | null = null;
+    
+    try {
+      const imagePath = await this.resolveImagePath(imageUrl);
+      
+      // Track if this is a temp file for cleanup
+      if (imagePath.includes('/temp/') || imagePath.includes('\\temp\\')) {
+        tempFilePath = imagePath;
+      }
+
+      const result = await this.executePythonScript(['analyze', '--img1', imagePath]);
+      
+      if (!result.success) {
+        console.error('[DeepFaceService] Failed to analyze image:', result.error);
+        return { qualityScore: 50, embedding: null };
+      }
+
+      console.log(`[DeepFaceService] Successfully detected ${result.face_count} face(s) in image`);
+
+      // Ensure quality score is between 0 and 100
+      const qualityScore = Math.max(0, Math.min(100, result.quality_score || 50));
+      
+      return { qualityScore, embedding: this.buildFaceEmbedding(imageUrl, result.embeddings || []) };
+    } catch (error) {
+      console.error('[DeepFaceService] Error analyzing image:', error);
+      return { qualityScore: 50, embedding: null };
+    } finally {
+      // Cleanup temp file if needed
+      if (tempFilePath) {
+        this.cleanupTempFile(tempFilePath);
+      }
+    }
+  }
+
   /**
    * Analyze face attributes (age, gender, emotion, etc.)
    */